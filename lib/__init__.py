@@ -26,7 +26,8 @@ Public submodules are:
        and registring resource handlers
 
      These modules contain data which change for each HTTP request.
-     They are used by some of the services decorators.
+     They are used by some of the services decorators. Each thread
+     sees the data for the request it is handling.
   request - information about an incoming HTTP query
   response - data for the outgoing HTTP response
 
@@ -37,19 +37,119 @@ information about returned HTTP headers.   If any errors occur
 
 The cache does not record HTTP errors.  Only the results of 
 successful requests (200 OK) are stored.
+
+Memory tier:
+
+Each cache entry is a file in the module cache directory, shared by
+all of the server processes.  A cache can also keep recently used
+entries in the memory of each server process, so a hit for a popular
+entry doesn't need any filesystem calls:
+
+    PRICE_CACHE = cache("http://myservices.com/bookprice",
+                        memory_size=4*1024*1024)
+
+memory_size is the number of bytes of response bodies to keep.  When
+that is exceeded the least recently used entries are dropped.  A hit
+from memory returns a MemoryCacheFile, which has the same methods as
+a CacheFile.  PRICE_CACHE.memory_stats() reports how well it works.
+
+Eviction:
+
+By default each of the 256 cache subdirectories holds at most
+maxentries/256 files.  When one is full, the oldest file in it (by
+modification time) is removed, which means a listdir() and a stat()
+of every file in the subdirectory for each miss.  Instead, a cache
+can keep an SQLite index of its entries, shared by all the server
+processes, and use it to choose what to remove:
+
+    PRICE_CACHE = cache("http://myservices.com/bookprice",
+                        eviction="lru", max_bytes=100*1024*1024)
+
+eviction is "lru" (remove the least recently used entry) or "lfu"
+(remove the least frequently used entry).  Expired entries are always
+removed first.  maxentries is then a limit on the number of entries
+for the whole cache, and max_bytes (optional) limits the total size
+of the cache files.  The index is built from the files already in the
+cache directory when it is first used, and again if it is lost or
+damaged.  If the index can't be updated (say, it is locked for too
+long) the request goes on and a warning is logged.
+
+A hit costs a dictionary update: uses are counted in each server
+process and written to the index every USES_INTERVAL seconds (5), or
+when an entry is added, so "least recently used" is only as exact as
+that.  Hits from the memory tier are not counted as uses.
+
+In-process opener:
+
+A miss normally makes an HTTP request back to this Akara server, which
+uses a socket and another server process.  Since the service is
+registered in this process too, the cache can call it directly:
+
+    PRICE_CACHE = cache("http://myservices.com/bookprice",
+                        opener=in_process_opener)
+
+in_process_opener(url) calls the service mounted at the URL's path
+with a WSGI environ made from the URL and returns what urlopen() would:
+the body as a file-like object, with info(), geturl() and getcode().
+A response other than 2xx raises urllib2.HTTPError.  Redirects are not
+followed and the call is not in the access log.
+
+Misses:
+
+When an entry is missing (or expired), one server process fetches it
+and the others which want it at the same time wait for that to finish,
+then use the new cache entry.  The same goes for the threads of one
+process, even with more than one cache object for the cache directory.  They wait for at most lock_timeout
+seconds (default 10), after which each one fetches the entry itself.
+Use lock_timeout=0 to always fetch without waiting.
+
+Expired entries:
+
+An expired entry is fetched again with a conditional GET, using its
+ETag (If-None-Match) and Last-Modified (If-Modified-Since) headers.
+If the service answers "304 Not Modified" the stored body is kept, with
+a new expiry time, and the ETag, Last-Modified, Date, Expires and
+Cache-Control headers of the 304 response replace the stored ones.
+The request headers need a urllib2.Request, so this is only done with
+urllib2.urlopen and in_process_opener, which accept one.  An
+alternative opener which also accepts a Request can use it with
+revalidate=True.  Two options let a cache use expired entries:
+
+    PRICE_CACHE = cache("http://myservices.com/bookprice",
+                        stale_while_revalidate=60, stale_if_error=3600)
+
+For stale_while_revalidate seconds after an entry expires, a request
+for it gets the expired entry at once, while a thread refreshes it.
+Only one server process refreshes an entry at a time.  For
+stale_if_error seconds after an entry expires, it is used if the
+service can't be reached or answers with a 5xx error.  Both default
+to 0.
 """
 
 import urllib, urllib2
+import httplib
+import urlparse
+import errno
+import fcntl
 import os
 import shutil
 import sys
 import base64
 import hashlib
+import itertools
 import cPickle as pickle
 import time
+import thread
+import threading
+import traceback
+from collections import OrderedDict
+from StringIO import StringIO
+from wsgiref.util import shift_path_info
 
+from akara import logger
 from akara import registry
 from akara import global_config
+from akara import request, response
 
 # File object returned to clients on cache hit.  A real file, but with an info() method
 # to mimic that operation on file-like objects returned by urlopen().
@@ -68,6 +168,481 @@ class CacheFile(file):
     def info(self):
         return self.headers
 
+# File-like object returned on a hit from the memory tier.
+
+class MemoryCacheFile(StringIO):
+    def __init__(self, body, url, headers):
+        StringIO.__init__(self, body)
+        self.headers = headers
+        self.code = 200
+        self.url = url
+        self.msg = "OK"
+    def getcode(self):
+        return self.code
+    def geturl(self):
+        return self.url
+    def info(self):
+        return self.headers
+
+# The memory tier of a cache.  Maps the query string to the entry's
+# (timestamp, url, headers, body), least recently used first.  Server
+# threads share it, hence the lock.
+class _MemoryTier(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, query, oldest_timestamp):
+        self.lock.acquire()
+        try:
+            try:
+                entry = self.entries.pop(query)
+            except KeyError:
+                self.misses += 1
+                return None
+            timestamp, url, headers, body = entry
+            if timestamp <= oldest_timestamp:
+                # Expired
+                self.size -= len(query) + len(body)
+                self.misses += 1
+                return None
+            # Now the most recently used
+            self.entries[query] = entry
+            self.hits += 1
+        finally:
+            self.lock.release()
+        return MemoryCacheFile(body, url, headers)
+
+    def add(self, query, timestamp, url, headers, body):
+        size = len(query) + len(body)
+        if size > self.maxsize:
+            return
+        self.lock.acquire()
+        try:
+            old_entry = self.entries.pop(query, None)
+            if old_entry is not None:
+                self.size -= len(query) + len(old_entry[3])
+            while self.entries and self.size + size > self.maxsize:
+                old_query, old_entry = self.entries.popitem(last=False)
+                self.size -= len(old_query) + len(old_entry[3])
+            self.entries[query] = (timestamp, url, headers, body)
+            self.size += size
+        finally:
+            self.lock.release()
+
+# The eviction index of a cache, in the file "index.sqlite" of its
+# cache directory.  The keys are the cache file names, relative to the
+# cache directory.  The "totals" table (kept up to date by triggers)
+# holds the number and total size of the entries, so the limits can be
+# checked without a scan.
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL,
+    uses INTEGER NOT NULL,
+    expires REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+CREATE INDEX IF NOT EXISTS entries_uses ON entries (uses, atime);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE TABLE IF NOT EXISTS totals (count INTEGER NOT NULL, bytes INTEGER NOT NULL);
+INSERT INTO totals SELECT 0, 0 WHERE NOT EXISTS (SELECT * FROM totals);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE totals SET count = count + 1, bytes = bytes + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE totals SET count = count - 1, bytes = bytes - OLD.size;
+END;
+"""
+
+_EVICTION_ORDER = {
+    "lru": "atime",
+    "lfu": "uses, atime",
+    }
+
+# Uses of entries (hits) are counted in memory and written to the index
+# at most every USES_INTERVAL seconds, or before an entry is added.
+USES_INTERVAL = 5.0
+MAX_PENDING_USES = 1000
+
+class _EvictionIndex(object):
+    """The index of the entries in a cache directory
+
+    'scan' is a function which returns (key, size, atime, expires) for
+    each of the files in the directory.  It is used to build the index
+    when there isn't one yet (like when eviction is enabled for an
+    existing cache), or when the index file was lost or damaged.
+
+    The index only helps to choose what to remove, so a problem with it
+    is logged and the request goes on without it.
+    """
+    def __init__(self, cachedir, policy, maxentries, max_bytes, scan):
+        self.filename = os.path.join(cachedir, "index.sqlite")
+        self.order = _EVICTION_ORDER[policy]
+        self.maxentries = maxentries
+        self.max_bytes = max_bytes
+        self.scan = scan
+        self.lock = threading.Lock()
+        # A connection can't be used after a fork, so each server
+        # process opens its own
+        self._conn = None
+        self._pid = None
+        self._ino = None
+        self._uses = {}
+        self._next_uses_write = 0
+
+    def _connect(self):
+        # Another server replaces the file if it was damaged
+        try:
+            ino = os.stat(self.filename).st_ino
+        except OSError:
+            ino = None
+        if self._conn is not None and self._pid == os.getpid() and self._ino == ino:
+            return self._conn
+        if self._pid != os.getpid():
+            # Written by the parent process
+            self._uses = {}
+        self._conn = None
+        import sqlite3
+        # Transactions are started and ended by _execute()
+        conn = sqlite3.connect(self.filename, timeout=10,
+                               check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_INDEX_SCHEMA)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # user_version is 0 for a new index, 1 once it is built
+            if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+                logger.info("Building the cache index %r" % (self.filename,))
+                conn.execute("DELETE FROM entries")
+                conn.executemany("INSERT INTO entries (key, size, atime, uses, expires) "
+                                 "VALUES (?, ?, ?, 1, ?)", self.scan())
+                conn.execute("PRAGMA user_version = 1")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self._conn = conn
+        self._pid = os.getpid()
+        self._ino = os.stat(self.filename).st_ino
+        return conn
+
+    # Remove a damaged index.  The next use builds a new one.
+    def _discard(self):
+        self._conn = None
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.filename + suffix)
+            except OSError:
+                pass
+
+    def _execute(self, func, *args):
+        import sqlite3
+        self.lock.acquire()
+        try:
+            try:
+                conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    result = func(conn, *args)
+                except:
+                    conn.execute("ROLLBACK")
+                    raise
+                conn.execute("COMMIT")
+                return result
+            except sqlite3.OperationalError, err:
+                # Likely busy for longer than the timeout
+                logger.warn("Cache index %r not updated: %s" % (self.filename, err))
+            except sqlite3.DatabaseError, err:
+                logger.warn("Cache index %r is damaged and will be rebuilt: %s" %
+                            (self.filename, err))
+                self._discard()
+        finally:
+            self.lock.release()
+        return None
+
+    def touch(self, key):
+        "Record a use of the entry"
+        self.lock.acquire()
+        try:
+            self._uses[key] = self._uses.get(key, 0) + 1
+            if (len(self._uses) < MAX_PENDING_USES and
+                time.time() < self._next_uses_write):
+                return
+        finally:
+            self.lock.release()
+        self._execute(self._write_uses, time.time())
+
+    # Called with self.lock held
+    def _write_uses(self, conn, now):
+        uses = self._uses
+        self._uses = {}
+        self._next_uses_write = now + USES_INTERVAL
+        conn.executemany("UPDATE entries SET atime = ?, uses = uses + ? WHERE key = ?",
+                         [(now, count, key) for (key, count) in uses.iteritems()])
+
+    def oldest(self, count):
+        "Return the keys of up to 'count' entries, in eviction order"
+        return self._execute(self._oldest, count) or []
+
+    def _oldest(self, conn, count):
+        return [key for (key,) in conn.execute(
+            "SELECT key FROM entries ORDER BY " + self.order + " LIMIT ?", (count,))]
+
+    def remove(self, keys):
+        self._execute(self._remove, keys)
+
+    def _remove(self, conn, keys):
+        conn.executemany("DELETE FROM entries WHERE key = ?",
+                         [(key,) for key in keys])
+
+    def add(self, key, size, expires):
+        """Add (or replace) an entry.  Returns the keys of the entries
+           to remove to stay within the limits, which are no longer in
+           the index."""
+        return self._execute(self._add, key, size, expires, time.time()) or []
+
+    def _add(self, conn, key, size, expires, now):
+        self._write_uses(conn, now)
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        conn.execute("INSERT INTO entries (key, size, atime, uses, expires) "
+                     "VALUES (?, ?, ?, 1, ?)", (key, size, now, expires))
+        count, total = conn.execute("SELECT count, bytes FROM totals").fetchone()
+        extra_count = count - self.maxentries
+        if self.max_bytes is None:
+            extra_bytes = 0
+        else:
+            extra_bytes = total - self.max_bytes
+        victims = []
+        if extra_count <= 0 and extra_bytes <= 0:
+            return victims
+        # Expired entries go first, then by the eviction policy.  The
+        # cursors only step through as many rows as needed.
+        candidates = itertools.chain(
+            conn.execute("SELECT key, size FROM entries WHERE expires <= ? "
+                         "ORDER BY expires", (now,)),
+            conn.execute("SELECT key, size FROM entries ORDER BY " + self.order))
+        seen = set([key])
+        for victim, victim_size in candidates:
+            if extra_count <= 0 and extra_bytes <= 0:
+                break
+            if victim in seen:
+                continue
+            seen.add(victim)
+            victims.append(victim)
+            extra_count -= 1
+            extra_bytes -= victim_size
+        conn.executemany("DELETE FROM entries WHERE key = ?",
+                         [(victim,) for victim in victims])
+        return victims
+
+# Locks so that only one server process, and one thread in it, fetches
+# a missing entry.  A lock is a byte of the "locks" file in the cache
+# directory, at an offset given by the entry's hash, locked with
+# fcntl.lockf().  A POSIX lock belongs to the process, not to a thread
+# or to an open file, so one table for the whole process keeps the
+# (cachedir, offset) pairs it holds, whichever cache object took them.
+# Threads (or greenlets) waiting for a lock held in this process are
+# woken by the condition when it is released.  A lock held by another
+# process can only be polled for.
+class _MissLocks(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.held = set()
+        self._fds = {}
+        self._pid = None
+
+    # Locks aren't inherited by a forked server, so it starts afresh
+    def _get_fd(self, cachedir):
+        if self._pid != os.getpid():
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds = {}
+            self.held = set()
+            self._pid = os.getpid()
+        fd = self._fds.get(cachedir)
+        if fd is None:
+            fd = os.open(os.path.join(cachedir, "locks"), os.O_RDWR | os.O_CREAT, 0644)
+            self._fds[cachedir] = fd
+        return fd
+
+    # Called with the condition held
+    def _try_acquire(self, key):
+        cachedir, offset = key
+        fd = self._get_fd(cachedir)
+        if key in self.held:
+            return False
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+        except IOError, err:
+            if err.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+        self.held.add(key)
+        return True
+
+    def acquire(self, cachedir, offset, timeout=0):
+        """Get the lock, waiting for up to 'timeout' seconds.  Returns
+        False if someone else still has it"""
+        key = (os.path.abspath(cachedir), offset)
+        deadline = time.time() + timeout
+        delay = 0.005
+        self.condition.acquire()
+        try:
+            while not self._try_acquire(key):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if key in self.held:
+                    # Notified by release()
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait(min(delay, remaining))
+                    delay = min(delay * 2, 0.1)
+            return True
+        finally:
+            self.condition.release()
+
+    def release(self, cachedir, offset):
+        key = (os.path.abspath(cachedir), offset)
+        self.condition.acquire()
+        try:
+            fcntl.lockf(self._get_fd(key[0]), fcntl.LOCK_UN, 1, offset)
+            self.held.discard(key)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+_miss_locks = _MissLocks()
+
+# Opener which calls the service in this process instead of making an
+# HTTP request.  See "In-process opener" above.  As with urlopen(), 'url'
+# can also be a urllib2.Request, for its headers.
+def in_process_opener(url):
+    if isinstance(url, urllib2.Request):
+        request_headers = url.header_items()
+        url = url.get_full_url()
+    else:
+        request_headers = []
+    parts = urlparse.urlsplit(url)
+    scheme, netloc, path, query, fragment = parts
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": urllib.unquote(path) or "/",
+        "QUERY_STRING": query,
+        "SERVER_NAME": parts.hostname or "localhost",
+        "SERVER_PORT": str(parts.port or 80),
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": netloc,
+        "HTTP_USER_AGENT": "Python-urllib/%s" % (urllib2.__version__,),
+        "REMOTE_ADDR": "127.0.0.1",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": StringIO(""),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        }
+    for name, value in request_headers:
+        environ["HTTP_" + name.upper().replace("-", "_")] = value
+    mount_point = shift_path_info(environ)
+
+    captured = []
+    body = []
+    def start_response(status, headers, exc_info=None):
+        captured[:] = [status, headers]
+        return body.append
+
+    # The service replaces akara.request and akara.response, which
+    # belong to the request being handled.  Put them back afterwards.
+    saved_environ = request.environ
+    saved_code = response.code
+    saved_headers = response.headers
+    try:
+        try:
+            service = registry.get_service(mount_point)
+        except KeyError:
+            captured[:] = ["404 Not Found", [("Content-Type", "text/plain")]]
+            body.append("No service is mounted at %r\n" % (mount_point,))
+        else:
+            try:
+                result = service.handler(environ, start_response)
+                try:
+                    for chunk in result:
+                        body.append(chunk)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+                if not captured:
+                    raise AssertionError("start_response() was never called")
+            except Exception:
+                # What the server would do
+                logger.error("Uncaught exception from %r (%r)\n%s" %
+                             (mount_point, service.ident, traceback.format_exc()))
+                captured[:] = ["500 Internal Server Error",
+                               [("Content-Type", "text/plain")]]
+                body[:] = ["Internal server error\n"]
+    finally:
+        request.environ = saved_environ
+        response.code = saved_code
+        response.headers = saved_headers
+
+    status, headers = captured
+    code, msg = (status.split(None, 1) + [""])[:2]
+    code = int(code)
+    # The same kind of headers object as from urlopen().  httplib
+    # sets its fp to None, which also lets the cache pickle it.
+    headers = httplib.HTTPMessage(StringIO(
+        "".join("%s: %s\r\n" % (name, value) for (name, value) in headers)), 0)
+    headers.fp = None
+    fp = StringIO("".join(body))
+    if not (200 <= code < 300):
+        raise urllib2.HTTPError(url, code, msg, headers, fp)
+    u = urllib.addinfourl(fp, headers, url, code)
+    u.msg = msg
+    return u
+
+# The request headers for a conditional GET of an entry with the given
+# response headers
+def _conditional_headers(headers):
+    validators = {}
+    if headers is None:
+        return validators
+    etag = headers.get("ETag")
+    if etag:
+        validators["If-None-Match"] = etag
+    last_modified = headers.get("Last-Modified")
+    if last_modified:
+        validators["If-Modified-Since"] = last_modified
+    return validators
+
+# The headers of a "304 Not Modified" response which replace those
+# stored with the entry
+_REVALIDATION_HEADERS = ("ETag", "Last-Modified", "Date", "Expires", "Cache-Control")
+
+def _update_headers(headers, new_headers):
+    if headers is None or new_headers is None:
+        return headers
+    for name in _REVALIDATION_HEADERS:
+        value = new_headers.get(name)
+        if value:
+            headers[name] = value
+    return headers
+
+# Count the hits and misses of the request being handled, for the
+# "cache" field of the structured access log
+def _count_lookup(key):
+    environ = request.environ
+    if environ is not None:
+        environ[key] = environ.get(key, 0) + 1
+
 # Utility function to remove the oldest entry from a cache directory.
 # Look at the modification dates for metadata files
 def remove_oldest(cachedir):
@@ -80,24 +655,87 @@ def remove_oldest(cachedir):
     os.remove(path)
     
 class cache(object):
-    def __init__(self,ident,maxentries=65536,expires=15*60,opener=None):
+    def __init__(self,ident,maxentries=65536,expires=15*60,opener=None,memory_size=0,
+                 eviction=None,max_bytes=None,lock_timeout=10,
+                 stale_while_revalidate=0,stale_if_error=0,revalidate=None):
         """Create a cache for another Akara service.
 
            ident is the Akara service ID
-           maxentries is the maximum number of cache entries (approximate)
+           maxentries is the maximum number of cache entries (approximate
+           unless there is an eviction policy)
            expires is the time in seconds after which entries expire
            opener is an alternative URL opener.  By default urllib2.urlopen is used.
+           memory_size is the number of bytes of entries each server process
+           also keeps in memory (0 = no memory tier)
+           eviction is None (remove the oldest file of a full subdirectory),
+           "lru" or "lfu" (use an index of the entries)
+           max_bytes is the maximum total size of the cache files.  It
+           needs an eviction policy.
+           lock_timeout is the maximum time in seconds to wait for another
+           server process to fetch a missing entry (0 = don't wait)
+           stale_while_revalidate is the time in seconds after an entry
+           expires during which it is used while being refreshed
+           stale_if_error is the time in seconds after an entry expires
+           during which it is used if the service fails
+           revalidate is True to fetch expired entries with a conditional
+           GET, which passes a urllib2.Request to the opener.  The default
+           (None) does so only for urllib2.urlopen and in_process_opener.
         """
+        if eviction is not None and eviction not in _EVICTION_ORDER:
+            raise ValueError("Unknown cache eviction policy %r" % (eviction,))
+        if max_bytes is not None and eviction is None:
+            raise ValueError("A cache with max_bytes needs an eviction policy")
 
         self.ident = ident
         if opener is None:
             opener = urllib2.urlopen
         self.opener = opener
+        if revalidate is None:
+            revalidate = opener in (urllib2.urlopen, in_process_opener)
+        self.revalidate = revalidate
         self.maxentries = maxentries
         self.expires = expires
         self.maxperdirectory = maxentries / 256
+        self.eviction = eviction
+        self.max_bytes = max_bytes
+        self.index = None
+        self.lock_timeout = lock_timeout
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
         self.serv = None
         self.initialized = False
+        if memory_size:
+            self.memory = _MemoryTier(memory_size)
+        else:
+            self.memory = None
+
+    def memory_stats(self):
+        """Return a dictionary describing the memory tier, or None if
+           the cache doesn't have one"""
+        memory = self.memory
+        if memory is None:
+            return None
+        lookups = memory.hits + memory.misses
+        if lookups:
+            hit_ratio = float(memory.hits) / lookups
+        else:
+            hit_ratio = 0.0
+        return dict(hits = memory.hits,
+                    misses = memory.misses,
+                    hit_ratio = hit_ratio,
+                    entries = len(memory.entries),
+                    size = memory.size,
+                    maxsize = memory.maxsize)
+
+    # Keep an entry read from the disk in the memory tier too.  Returns
+    # the file-like object to give to the client.
+    def _remember(self, query, timestamp, f):
+        if os.fstat(f.fileno()).st_size - f.tell() + len(query) > self.memory.maxsize:
+            return f
+        body = f.read()
+        f.close()
+        self.memory.add(query, timestamp, f.url, f.headers, body)
+        return MemoryCacheFile(body, f.url, f.headers)
 
     # Internal method that locates the Akara service description and sets up a
     # base-URL for making requests.   This can not be done in __init__() since
@@ -138,6 +776,33 @@ class cache(object):
                 # Multiple server instances might enter here at the same time and try to create directory
                 pass
             assert os.path.exists(self.cachedir), "Failed to make module cache directory %s" % self.cachedir
+        self._open_shared_files()
+
+    # Method that sets up the files in the cache directory which are
+    # shared by the server processes: the eviction index, if the cache
+    # has one.  (The miss locks are opened when first used.)
+    def _open_shared_files(self):
+        if self.eviction is not None:
+            self.index = _EvictionIndex(self.cachedir, self.eviction,
+                                        self.maxentries, self.max_bytes,
+                                        self._scan_entries)
+
+    # The existing entries, for building the eviction index.  The file's
+    # modification time is close enough to the entry's timestamp.
+    def _scan_entries(self):
+        for subdir in os.listdir(self.cachedir):
+            cache_subdir = os.path.join(self.cachedir, subdir)
+            if len(subdir) != 2 or not os.path.isdir(cache_subdir):
+                continue
+            for name in os.listdir(cache_subdir):
+                if not name.endswith(".p"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(cache_subdir, name))
+                except OSError:
+                    continue   # Removed by another server
+                yield (subdir + "/" + name, st.st_size, st.st_mtime,
+                       st.st_mtime + self.expires)
 
     # Method that initializes the cache if needed
     def _init_cache(self):
@@ -158,10 +823,6 @@ class cache(object):
         if not self.initialized:
             self._init_cache()
 
-        # This is a sanity check.  If the cache is gone, might have to rebuild it
-        if not os.path.exists(self.cachedir):
-            self._make_cache()
-
         #  Make a canonical query string from the arguments (guaranteed
         #  to be the same even if the keyword argumenst are specified in
         #  in an arbitrary order)
@@ -169,6 +830,17 @@ class cache(object):
         
         query = "&".join(name+"="+urllib.quote(str(value)) for name,value in sorted(kwargs.items()))
 
+        # The memory tier, if there is one, is checked before going to the disk
+        if self.memory is not None:
+            f = self.memory.get(query, time.time() - self.expires)
+            if f is not None:
+                _count_lookup("akara.cache_hits")
+                return f
+
+        # This is a sanity check.  If the cache is gone, might have to rebuild it
+        if not os.path.exists(self.cachedir):
+            self._make_cache()
+
         # Take the query string and make a SHA hash key pair out of it.  The general idea here
         # is to come up with an identifier that has a reasonable number of bits, but which is extremely
         # unlikely to collide with other identifiers.  It would be extremely unlikely that the query
@@ -202,63 +874,204 @@ class cache(object):
             
         # Check for existence of cache file
         cache_file= os.path.join(cache_subdir,filename+".p")
-        if os.path.exists(cache_file):
-            # A cache hit. Load the metadata file to get the cache information and return it.
-            f = CacheFile(cache_file,"rb")
-            metaquery,timestamp,url,headers = pickle.load(f)
-
-            # Check to make sure the query string exactly matches the meta data
-            # and that the cache data is not too old
-            if metaquery == query and (timestamp + self.expires > time.time()):
-                # A cache hit and the query matches.  Just return the file we opened.
-                # the file pointer should be set to imemdiately after the pickled
-                # metadata at the front
-                f.headers = headers
-                f.url = url
+        index_key = subdir + "/" + filename + ".p"
+        lock_offset = int(identifier[:12], 16)
+        stale = self._open_entry(cache_file, query, index_key)
+        if stale is not None:
+            f, timestamp = stale
+            now = time.time()
+            if now < timestamp + self.expires:
+                return self._hit(f, query, timestamp, index_key)
+            if now < timestamp + self.expires + self.stale_while_revalidate:
+                # Use the expired entry and refresh it in the background
+                self._revalidate_in_background(cache_subdir, cache_file, query,
+                                               index_key, lock_offset)
+                _count_lookup("akara.cache_hits")
                 return f
-
-            # There was a cache hit, but the cache metadata is for a different query (a collision)
-            # or the timestamp is out of date.   We're going to remove the cache file and 
-            # proceed as if there was a cache miss
-            try:
-                os.remove(cache_file)
-            except OSError:
-                pass   # Ignore.  If the files don't exist, who cares?
+            # Otherwise the expired entry is only used to revalidate it
+            # and, within stale_if_error, if the service fails.
             
         # Cache miss
+        # When several server processes (or threads) miss the same entry at
+        # the same time, only one of them makes the request.  The others wait
+        # for up to lock_timeout seconds for it to fill the cache.
+        locked = False
+        try:
+            if self.lock_timeout:
+                locked = _miss_locks.acquire(self.cachedir, lock_offset,
+                                             self.lock_timeout)
+                if not locked:
+                    logger.warn("Timed out waiting for another server to fetch %s?%s" %
+                                (self.baseurl, query))
+            if locked:
+                # It might have been filled just before getting the lock
+                f = self._read_entry(cache_file, query, index_key)
+                if f is not None:
+                    return f
+            f = self._fill(cache_subdir, cache_file, query, index_key, stale)
+            if stale is not None and f is stale[0]:
+                # Don't close it below
+                stale = None
+            return f
+        finally:
+            if locked:
+                _miss_locks.release(self.cachedir, lock_offset)
+            if stale is not None:
+                stale[0].close()
+
+    # Open the cache file for the query.  Returns the CacheFile, positioned
+    # after the metadata, and the entry's timestamp, or None if there is no
+    # entry for the query
+    def _open_entry(self, cache_file, query, index_key):
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            f = CacheFile(cache_file,"rb")
+        except IOError:
+            return None    # Just removed by another server
+        metaquery,timestamp,f.url,f.headers = pickle.load(f)
+
+        # Check to make sure the query string exactly matches the meta data
+        if metaquery == query:
+            return f, timestamp
+
+        # The cache metadata is for a different query (a collision).  We're going
+        # to remove the cache file and proceed as if there was a cache miss
+        f.close()
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass   # Ignore.  If the files don't exist, who cares?
+        if self.index is not None:
+            self.index.remove([index_key])
+        return None
+
+    # Return the cache entry if it hasn't expired, otherwise None
+    def _read_entry(self, cache_file, query, index_key):
+        entry = self._open_entry(cache_file, query, index_key)
+        if entry is None:
+            return None
+        f, timestamp = entry
+        if timestamp + self.expires > time.time():
+            return self._hit(f, query, timestamp, index_key)
+        f.close()
+        return None
+
+    # A cache hit and the query matches.  Just return the file we opened.
+    # the file pointer should be set to imemdiately after the pickled
+    # metadata at the front
+    def _hit(self, f, query, timestamp, index_key):
+        _count_lookup("akara.cache_hits")
+        if self.index is not None:
+            self.index.touch(index_key)
+        if self.memory is not None:
+            return self._remember(query, timestamp, f)
+        return f
+
+    # Refresh an expired entry in another thread, unless some server is
+    # already fetching it
+    def _revalidate_in_background(self, cache_subdir, cache_file, query,
+                                  index_key, lock_offset):
+        if not _miss_locks.acquire(self.cachedir, lock_offset):
+            return
+        def revalidate():
+            try:
+                stale = self._open_entry(cache_file, query, index_key)
+                try:
+                    self._fill(cache_subdir, cache_file, query, index_key, stale).close()
+                finally:
+                    if stale is not None:
+                        stale[0].close()
+            except Exception:
+                logger.warn("Could not refresh the cache entry for %s?%s\n%s" %
+                            (self.baseurl, query, traceback.format_exc()))
+            finally:
+                _miss_locks.release(self.cachedir, lock_offset)
+        t = threading.Thread(target=revalidate)
+        t.setDaemon(True)
+        t.start()
+
+    # Fetch the entry from the service and store it in the cache.  'stale'
+    # is the expired entry (file and timestamp), or None.  If the entry
+    # has a validator, the request is conditional.  On "304 Not Modified"
+    # the entry is stored again with a new timestamp.
+    def _fill(self, cache_subdir, cache_file, query, index_key, stale):
         # On a miss, a GET request is issued using the cache opener object
         # (by default, urllib2.urlopen).  Any HTTP exceptions are left unhandled
         # for clients to deal with if they want (HTTP errors are not cached)
 
         # Before adding a new cache entry. Check the number of entries in the cache subdirectory.
         # If there are too many entries, remove the oldest entry to make room.
-        if len(os.listdir(cache_subdir)) >= self.maxperdirectory:
+        # (With an eviction index, entries are removed after the new one is added.)
+        if self.index is None and len(os.listdir(cache_subdir)) >= self.maxperdirectory:
             remove_oldest(cache_subdir)
 
         # Make an akara request
+        _count_lookup("akara.cache_misses")
         url = self.baseurl + "?" + query
-        u = self.opener(url)
-        
+        req = url
+        if stale is not None and self.revalidate:
+            validators = _conditional_headers(stale[0].info())
+            if validators:
+                req = urllib2.Request(url, headers=validators)
+        try:
+            u = self.opener(req)
+        except urllib2.HTTPError, err:
+            if err.code == 304 and stale is not None:
+                f, timestamp = stale
+                headers = _update_headers(f.info(), err.info())
+                return self._store(cache_file, query, index_key, f.url, headers, f)
+            if err.code < 500 or not self._can_serve_stale(stale):
+                raise
+            logger.warn("Using the expired cache entry for %s: %s" % (url, err))
+            return stale[0]
+        except (EnvironmentError, httplib.HTTPException), err:
+            if not self._can_serve_stale(stale):
+                raise
+            logger.warn("Using the expired cache entry for %s: %s" % (url, err))
+            return stale[0]
+        return self._store(cache_file, query, index_key, url, u.info(), u)
+
+    def _can_serve_stale(self, stale):
+        return (stale is not None and
+                time.time() < stale[1] + self.expires + self.stale_if_error)
+
+    # Write the entry, with the body from the file-like object 'u'
+    def _store(self, cache_file, query, index_key, url, headers, u):
         # If successful, we'll make it here.  Read data from u and store in the cache
         # This is done by initially creating a file with a different filename, fully
         # populating it, and then renaming it to the correct cache file when done.
-        cache_tempfile = cache_file + ".%d" % os.getpid()
+        # (The name includes the thread, in case a wait for the miss lock timed out.)
+        cache_tempfile = cache_file + ".%d.%d" % (os.getpid(), thread.get_ident())
         f = open(cache_tempfile,"wb")
-        pickle.dump((query,time.time(),url,u.info()),f,-1)
+        timestamp = time.time()
+        pickle.dump((query,timestamp,url,headers),f,-1)
 
         # Write content into the file
         while True:
             chunk = u.read(65536)
             if not chunk: break
             f.write(chunk)
+        size = f.tell()
         f.close()
 
         # Rename the file, open, and return
         shutil.move(cache_tempfile, cache_file)
 
+        # Add the entry to the index, and remove what it says no longer fits
+        if self.index is not None:
+            victims = self.index.add(index_key, size, timestamp + self.expires)
+            for victim in victims:
+                try:
+                    os.remove(os.path.join(self.cachedir, victim))
+                except OSError:
+                    pass
+
         # Return a file-like object back to the client
         f = CacheFile(cache_file,"rb")
         metaquery,timestamp,f.url,f.headers = pickle.load(f)
+        if self.memory is not None:
+            return self._remember(query, timestamp, f)
         return f
 
 
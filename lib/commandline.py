@@ -6,11 +6,14 @@ This is an internal module and should not be called from other libraries.
 
 import sys
 import os
+import math
 import signal
 import shutil
+import time
+import json
 
 from akara.thirdparty import argparse
-from akara import read_config, run
+from akara import read_config, run, scoreboard
 
 def get_pid(args):
     try:
@@ -86,6 +89,175 @@ def status(args):
             print "PID is", pid, "and there is a process with that PID"
             # XXX try to connect to the server?
             print "Akara is running"
+            if getattr(args, "workers", False):
+                print_workers(settings["scoreboard_file"])
+
+def _format_bytes(n):
+    for unit in ("B", "K", "M"):
+        if n < 1024:
+            return "%d%s" % (n, unit)
+        n //= 1024
+    return "%dG" % (n,)
+
+def print_workers(scoreboard_file):
+    print "Scoreboard file:", repr(scoreboard_file)
+    try:
+        workers = scoreboard.read_scoreboard(scoreboard_file)
+    except (IOError, ValueError), err:
+        print "*** Cannot read the scoreboard:", err
+        raise SystemExit(1)
+    now = time.time()
+    print "%7s %-9s %8s %6s %7s %8s %8s  %s" % (
+        "PID", "STATE", "REQUESTS", "ACTIVE", "RSS", "AGE", "REQ TIME", "MOUNT POINT")
+    for worker in sorted(workers, key=lambda w: w["started"]):
+        if worker["active"]:
+            request_time = "%.1fs" % (now - worker["request_start"])
+        else:
+            request_time = "-"
+        print "%7d %-9s %8d %6d %7s %7.0fs %8s  %s" % (
+            worker["pid"], worker["state"], worker["requests"], worker["active"],
+            _format_bytes(worker["rss"]), now - worker["started"],
+            request_time, worker["mount_point"] or "-")
+    print "%d servers, %d busy" % (
+        len(workers), len([w for w in workers if w["active"]]))
+
+# Summarize the structured access log, one pass through the file.
+
+# Times are counted in buckets which are 5% wider than the previous
+# one, so the memory used doesn't depend on the size of the log and
+# the percentiles are within 5% of the actual value.
+_BUCKET_GROWTH = 1.05
+_LOG_BUCKET_GROWTH = math.log(_BUCKET_GROWTH)
+_MIN_TIME = 0.00001
+
+class _TimeHistogram(object):
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+
+    def add(self, seconds):
+        if seconds < _MIN_TIME:
+            bucket = 0
+        else:
+            bucket = int(math.log(seconds / _MIN_TIME) / _LOG_BUCKET_GROWTH) + 1
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+
+    def percentile(self, percent):
+        "The upper edge of the bucket with the given percentile, or None"
+        if not self.total:
+            return None
+        rank = max(1, int(math.ceil(self.total * percent / 100.0)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return _MIN_TIME * _BUCKET_GROWTH ** bucket
+
+class _ServiceStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.server_errors = 0
+        self.bytes = 0
+        self.cache_lookups = 0
+        self.cache_hits = 0
+        self.duration = _TimeHistogram()
+        self.ttfb = _TimeHistogram()
+
+    def add(self, record):
+        self.requests += 1
+        if record.get("status", 500) >= 500:
+            self.server_errors += 1
+        self.bytes += record.get("bytes") or 0
+        if record.get("duration") is not None:
+            self.duration.add(record["duration"])
+        if record.get("ttfb") is not None:
+            self.ttfb.add(record["ttfb"])
+        cache = record.get("cache")
+        if cache is not None:
+            self.cache_lookups += 1
+            if cache == "hit":
+                self.cache_hits += 1
+
+# This function is called by test code.
+# It is not part of the external API.
+def summarize_access_log(lines):
+    """Group the structured access log records by service
+
+    'lines' is an iterator over the lines of the log. Returns a
+    dictionary from the service ident (or the mount point, for
+    requests which weren't handled by a service) to its statistics,
+    and the number of lines which couldn't be parsed.
+    """
+    stats = {}
+    bad_lines = 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # Likely the partial last line of a log being written
+            bad_lines += 1
+            continue
+        key = record.get("service")
+        if key is None:
+            mount = record.get("mount")
+            if mount is None:
+                key = "-"
+            else:
+                key = "/" + mount
+        try:
+            service_stats = stats[key]
+        except KeyError:
+            service_stats = stats[key] = _ServiceStats()
+        service_stats.add(record)
+    return stats, bad_lines
+
+def _format_ms(seconds):
+    if seconds is None:
+        return "-"
+    return "%.1f" % (seconds * 1000,)
+
+def access_stats(args):
+    filename = args.filename
+    if filename is None:
+        try:
+            settings, config = read_config.read_config(args.config_filename)
+        except read_config.Error, err:
+            raise SystemExit(str(err))
+        filename = settings["structured_access_log"]
+        if filename is None:
+            raise SystemExit("No 'StructuredAccessLog' is configured. "
+                             "Set it or use --file")
+    if filename == "-":
+        f = sys.stdin
+    else:
+        try:
+            f = open(filename)
+        except IOError, err:
+            raise SystemExit("Could not open the structured access log: %s" % (err,))
+    try:
+        stats, bad_lines = summarize_access_log(f)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    print "%-40s %8s %5s %8s %8s %8s %8s %7s %6s" % (
+        "SERVICE", "REQUESTS", "5XX", "P50 ms", "P90 ms", "P99 ms",
+        "TTFB P50", "BYTES", "CACHE")
+    for key, s in sorted(stats.items(), key=lambda item: -item[1].requests):
+        if s.cache_lookups:
+            cache = "%.0f%%" % (100.0 * s.cache_hits / s.cache_lookups,)
+        else:
+            cache = "-"
+        print "%-40s %8d %5d %8s %8s %8s %8s %7s %6s" % (
+            key, s.requests, s.server_errors,
+            _format_ms(s.duration.percentile(50)),
+            _format_ms(s.duration.percentile(90)),
+            _format_ms(s.duration.percentile(99)),
+            _format_ms(s.ttfb.percentile(50)),
+            _format_bytes(s.bytes), cache)
+    if bad_lines:
+        print "Skipped %d unreadable line(s)" % (bad_lines,)
 
 
 def setup_config_file():
@@ -207,8 +379,17 @@ parser_restart = subparsers.add_parser("restart", help="restart an Akara server"
 parser_restart.set_defaults(func=restart)
 
 parser_status = subparsers.add_parser("status", help="display a status report")
+parser_status.add_argument("--workers", dest="workers", action="store_true",
+                           help="also show what each server process is doing")
 parser_status.set_defaults(func=status)
 
+parser_stats = subparsers.add_parser("stats",
+                                     help="summarize the structured access log")
+parser_stats.add_argument("--file", dest="filename", metavar="FILE",
+                          help="read FILE instead of the configured "
+                          "StructuredAccessLog ('-' for stdin)")
+parser_stats.set_defaults(func=access_stats)
+
 parser_setup = subparsers.add_parser("setup", help="set up directories and files for Akara")
 parser_setup.set_defaults(func=setup)
 
@@ -0,0 +1,388 @@
+"""gzip and deflate compression of HTTP responses
+
+This is an internal module and should not be called from other libraries.
+
+The dispatcher passes each request through a Compression object
+(when "Compression" is enabled in akara.conf). If the client's
+Accept-Encoding allows gzip or deflate, and the response is a "200 OK"
+with one of the CompressTypes content types and at least
+CompressMinSize bytes, the body is compressed and the Content-Encoding,
+Content-Length and ETag headers are updated. Every response which
+could be compressed gets "Vary: Accept-Encoding", whether or not this
+client asked for compression, so caches keep the two versions apart.
+A HEAD response is only described as compressed when the compressed
+length is known, for a list body or a file with a stored copy (see
+below), so it keeps a Content-Length.
+
+A service can override the content type test with the 'compress'
+parameter of the service decorators: True to always compress, False
+to never compress.
+
+A response body which is a wsgi.file_wrapper for a named file (like a
+static file or a caching.CacheFile hit) is compressed once and stored
+in CompressCacheDir. Later requests send the stored copy, with
+sendfile() if possible. The stored copy is replaced when the original
+file changes size or modification time. The stored copies use at most
+CompressCacheMaxSize bytes; the least recently used ones are removed
+to make room (with the eviction index from akara.caching). Copies of
+files which no longer exist are removed too, a few at a time.
+"""
+
+import fnmatch
+import hashlib
+import os
+import sys
+import time
+import zlib
+from wsgiref.util import FileWrapper
+
+from akara import logger
+
+ENCODINGS = ("gzip", "deflate")
+
+# "deflate" in HTTP is the zlib format; gzip needs the gzip header
+_WBITS = {"gzip": 16 + zlib.MAX_WBITS,
+          "deflate": zlib.MAX_WBITS}
+_ETAG_SUFFIX = {"gzip": "-gz", "deflate": "-zz"}
+
+BLOCK_SIZE = 65536
+
+# How often (seconds) each server looks for stored copies of files
+# which no longer exist, and how many of the least recently used
+# copies it checks
+ORPHAN_CHECK_INTERVAL = 60
+ORPHAN_CHECK_COUNT = 100
+
+def choose_encoding(accept_encoding):
+    """Pick "gzip", "deflate" or None given an Accept-Encoding header
+
+    Follows the q-values, including "q=0" to refuse an encoding and
+    "*" for any encoding not listed. Prefers gzip over deflate.
+    """
+    if not accept_encoding:
+        return None
+    qvalues = {}
+    for term in accept_encoding.split(","):
+        params = term.split(";")
+        coding = params[0].strip().lower()
+        if coding == "x-gzip":
+            coding = "gzip"
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    best = None
+    best_q = 0.0
+    for coding in ENCODINGS:
+        q = qvalues.get(coding, qvalues.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def compress_string(data, encoding, level=6):
+    c = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    return c.compress(data) + c.flush()
+
+def _compress_iter(result, encoding, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    try:
+        for chunk in result:
+            data = c.compress(chunk)
+            if data:
+                yield data
+        yield c.flush()
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+def _get_header(headers, name):
+    name = name.lower()
+    for (k, v) in headers:
+        if k.lower() == name:
+            return v
+    return None
+
+def _set_header(headers, name, value):
+    "Replace the named header (or remove it if value is None)"
+    lname = name.lower()
+    headers[:] = [(k, v) for (k, v) in headers if k.lower() != lname]
+    if value is not None:
+        headers.append((name, value))
+
+def _add_vary(headers):
+    vary = _get_header(headers, "Vary")
+    if vary is None:
+        headers.append(("Vary", "Accept-Encoding"))
+    elif vary.strip() != "*" and "accept-encoding" not in vary.lower():
+        _set_header(headers, "Vary", vary + ", Accept-Encoding")
+
+def _add_etag_suffix(headers, suffix):
+    etag = _get_header(headers, "ETag")
+    if etag is None:
+        return
+    if etag.endswith('"'):
+        etag = etag[:-1] + suffix + '"'
+    else:
+        etag += suffix
+    _set_header(headers, "ETag", etag)
+
+
+class Compression(object):
+    def __init__(self, types, min_size=1024, level=6, cache_dir=None,
+                 cache_max_size=64*1024*1024):
+        self.types = types
+        self.min_size = min_size
+        self.level = level
+        self.cache_dir = cache_dir
+        self.cache_max_size = cache_max_size
+        self._index = None
+        self._next_orphan_check = 0
+
+    # The eviction index of cache_dir
+    def _get_index(self):
+        if self._index is None or self._index_dir != self.cache_dir:
+            from akara.caching import _EvictionIndex
+            _make_dirs(self.cache_dir)
+            self._index = _EvictionIndex(self.cache_dir, "lru", sys.maxint,
+                                         self.cache_max_size, self._scan_copies)
+            self._index_dir = self.cache_dir
+        return self._index
+
+    # The existing copies, for building the index. They don't expire.
+    def _scan_copies(self):
+        for subdir in os.listdir(self.cache_dir):
+            dirname = os.path.join(self.cache_dir, subdir)
+            if len(subdir) != 2 or not os.path.isdir(dirname):
+                continue
+            for name in os.listdir(dirname):
+                if "." in name:
+                    continue   # A copy being written
+                try:
+                    st = os.stat(os.path.join(dirname, name))
+                except OSError:
+                    continue
+                yield (subdir + "/" + name, st.st_size, st.st_mtime, sys.maxint)
+
+    def _remove_copies(self, keys):
+        for key in keys:
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except OSError:
+                pass
+
+    # Remove stored copies whose original file is gone, checking the
+    # least recently used ones. The first line of a copy has the
+    # original's filename.
+    def _remove_orphans(self, index):
+        orphans = []
+        for key in index.oldest(ORPHAN_CHECK_COUNT):
+            try:
+                f = open(os.path.join(self.cache_dir, key), "rb")
+                try:
+                    stamp = f.readline()
+                finally:
+                    f.close()
+            except IOError:
+                orphans.append(key)
+                continue
+            filename = stamp.rstrip("\n").split(" ", 2)[-1]
+            if not os.path.exists(filename):
+                orphans.append(key)
+        if orphans:
+            index.remove(orphans)
+            self._remove_copies(orphans)
+
+    def is_compressible(self, content_type):
+        "Is the content type (possibly with parameters) one of the CompressTypes?"
+        if not content_type:
+            return False
+        media_type = content_type.split(";", 1)[0].strip().lower()
+        for pattern in self.types:
+            if fnmatch.fnmatchcase(media_type, pattern):
+                return True
+        return False
+
+    def __call__(self, environ, start_response, app, compress=None):
+        """Call the WSGI 'app', compressing its response if possible
+
+        'compress' is the service's setting: None to decide by the
+        content type, True to always compress and False to never.
+        """
+        if compress is False:
+            return app(environ, start_response)
+        encoding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING"))
+
+        # A client with the compressed copy sends its ETag back. The
+        # application only knows the uncompressed ETag, so remove the
+        # suffix. A "304 Not Modified" gets the suffix back.
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+        etag_suffix = None
+        if encoding is not None and if_none_match:
+            suffix = _ETAG_SUFFIX[encoding]
+            if suffix + '"' in if_none_match:
+                environ["HTTP_IF_NONE_MATCH"] = if_none_match.replace(
+                    suffix + '"', '"')
+                etag_suffix = suffix
+
+        # Hold on to the status and headers until the response body
+        # is known, unless the application uses the write() callable.
+        captured = []
+        forwarded = []  # the real write() callable, once forwarded
+        def start_response_(status, headers, exc_info=None):
+            if exc_info is not None or forwarded:
+                forwarded[:] = [start_response(status, headers, exc_info)]
+                return forwarded[0]
+            captured[:] = [status, headers]
+            return write
+        def write(data):
+            if not forwarded:
+                forwarded[:] = [start_response(*captured)]
+            forwarded[0](data)
+
+        result = app(environ, start_response_)
+        if forwarded or not captured:
+            # Too late to change anything (or start_response will be
+            # called while iterating through the result)
+            forwarded.append(None)
+            return result
+
+        status, headers = captured
+        headers = list(headers)
+        if status.startswith("304") and etag_suffix is not None:
+            _add_vary(headers)
+            _add_etag_suffix(headers, etag_suffix)
+            start_response(status, headers)
+            return result
+        if (not status.startswith("200") or
+            _get_header(headers, "Content-Encoding") is not None or
+            (compress is None and
+             not self.is_compressible(_get_header(headers, "Content-Type")))):
+            start_response(status, headers)
+            return result
+        _add_vary(headers)
+
+        length = str(_get_header(headers, "Content-Length"))
+        if (encoding is None or
+            (length.isdigit() and int(length) < self.min_size)):
+            start_response(status, headers)
+            return result
+
+        if isinstance(result, (list, tuple)):
+            body = "".join(result)
+            if len(body) < self.min_size:
+                start_response(status, headers)
+                return result
+            result = [compress_string(body, encoding, self.level)]
+            _set_header(headers, "Content-Length", str(len(result[0])))
+        else:
+            cached = None
+            if isinstance(result, FileWrapper) and self.cache_dir:
+                cached = self._open_cached(result.filelike, encoding)
+            if cached is not None:
+                if hasattr(result, "close"):
+                    result.close()
+                result, cached_length = cached
+                _set_header(headers, "Content-Length", str(cached_length))
+                if environ.get("akara.head_request"):
+                    # The dispatcher discards the body of a HEAD
+                    result.close()
+                    result = []
+            elif environ.get("akara.head_request"):
+                # Without compressing the body there is no length to
+                # report, and a HEAD response without one can't be
+                # chunked, so the connection would be closed. Send
+                # the uncompressed headers.
+                start_response(status, headers)
+                return result
+            else:
+                result = _compress_iter(result, encoding, self.level)
+                _set_header(headers, "Content-Length", None)
+
+        _set_header(headers, "Content-Encoding", encoding)
+        # The compressed body is a different entity
+        _add_etag_suffix(headers, _ETAG_SUFFIX[encoding])
+        start_response(status, headers)
+        return result
+
+    def _open_cached(self, f, encoding):
+        """Return (file_wrapper, length) for a compressed copy of the rest of f
+
+        Returns None if f isn't a named file or the copy can't be made.
+        """
+        filename = getattr(f, "name", None)
+        if not isinstance(filename, basestring) or filename.startswith("<"):
+            return None
+        try:
+            offset = f.tell()
+            st = os.fstat(f.fileno())
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        # Identify the original, and what it looked like when compressed
+        filename = os.path.abspath(filename)
+        key = hashlib.sha1("%s\0%d\0%s" % (filename, offset, encoding)).hexdigest()
+        index_key = key[:2] + "/" + key[2:]
+        cache_filename = os.path.join(self.cache_dir, key[:2], key[2:])
+        stamp = "%d %r %s\n" % (st.st_size, st.st_mtime, filename)
+        try:
+            cache_f = open(cache_filename, "rb")
+        except IOError:
+            pass
+        else:
+            if cache_f.readline() == stamp:
+                self._get_index().touch(index_key)
+                return (FileWrapper(cache_f, BLOCK_SIZE),
+                        os.fstat(cache_f.fileno()).st_size - len(stamp))
+            cache_f.close()
+
+        # Not there or out of date. Compress it now.
+        tmp_filename = "%s.%d" % (cache_filename, os.getpid())
+        try:
+            _make_dirs(os.path.dirname(cache_filename))
+            out = open(tmp_filename, "wb")
+            try:
+                out.write(stamp)
+                c = zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[encoding])
+                while 1:
+                    block = f.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    out.write(c.compress(block))
+                out.write(c.flush())
+            finally:
+                out.close()
+            os.rename(tmp_filename, cache_filename)
+            cache_f = open(cache_filename, "rb")
+            index = self._get_index()
+            self._remove_copies(index.add(index_key,
+                                          os.fstat(cache_f.fileno()).st_size,
+                                          sys.maxint))
+            if time.time() >= self._next_orphan_check:
+                self._next_orphan_check = time.time() + ORPHAN_CHECK_INTERVAL
+                self._remove_orphans(index)
+        except (IOError, OSError), err:
+            logger.warn("Unable to store compressed copy of %r in %r: %s" %
+                        (filename, self.cache_dir, err))
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            # Let the caller compress it while sending
+            f.seek(offset)
+            return None
+        cache_f.readline()
+        return (FileWrapper(cache_f, BLOCK_SIZE),
+                os.fstat(cache_f.fileno()).st_size - len(stamp))
+
+def _make_dirs(dirname):
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Another server may have made it at the same time
+            if not os.path.isdir(dirname):
+                raise
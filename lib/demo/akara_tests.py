@@ -34,6 +34,15 @@ try:
 except ValueError, err:
     assert "only supports GET and POST methods" in str(err), err
 
+try:
+    # Conditional GET doesn't apply to a POST
+    @simple_service("POST", "http://example.com/test_args", etag=True)
+    def spam(body, content_type):
+        pass
+    raise AssertionError("etag=True was allowed for POST")
+except ValueError, err:
+    assert "only supported for GET" in str(err), err
+
 try:
     # Slashes are not (yet) allowed in the path
     @service("http://example.com/test_arg", path="service.with/slashes")
@@ -205,6 +214,59 @@ def test_echo_simple_post(query_body, query_content_type, **kwargs):
     yield "Body:\n"
     yield repr(query_body) + "\n"
 
+@simple_service("POST", "http://example.com/test_stream_body", stream_body=True)
+def test_stream_body(query_body, query_content_type):
+    "This reports the size and the start of a POST body read from a file"
+    data = query_body.read()
+    yield "Length: %s\n" % len(data)
+    yield "Start: %r\n" % data[:20]
+
+
+@simple_service("GET", "http://example.com/test_etag", etag=True)
+def test_etag(word="Akara"):
+    "The ETag is a hash of the body"
+    return ("%s! " % (word,)) * 1000
+
+def _test_validator_validator(version="1"):
+    if version == "none":
+        return None
+    return ("v" + version, 1262304000) # 2010-01-01 00:00:00 GMT
+
+@simple_service("GET", "http://example.com/test_validator",
+                validator=_test_validator_validator)
+def test_validator(version="1"):
+    "The ETag and Last-Modified come from the validator"
+    # A conditional GET for this version must not call the function
+    if version == "skip":
+        raise AssertionError("test_validator was called for version 'skip'")
+    return "Version: %s\n" % (version,)
+
+
+def _test_head_head(size="100"):
+    return int(size)
+
+@simple_service("GET", "http://example.com/test_head", content_type="text/plain",
+                head=_test_head_head)
+def test_head(size="100"):
+    "A HEAD request must not call this"
+    assert not request.environ.get("akara.head_request")
+    return "x" * int(size)
+
+@method_dispatcher("http://example.com/test_head", path="test_dispatching_head")
+def test_dispatching_head():
+    pass
+
+def _dispatching_head_head(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain"),
+                              ("X-Akara-Head", "yes")])
+    return ["This is ignored"]
+
+@test_dispatching_head.method("GET", head=_dispatching_head_head)
+def dispatching_head_get(environ, start_response):
+    assert not environ.get("akara.head_request")
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return ["Full body"]
+
 
 @simple_service("POST", "http://echo_request_headers")
 def test_echo_post_headers(query_body, ignore):
@@ -69,7 +69,8 @@ def _need_refresh():
     return False
 
 SERVICE_ID = 'http://purl.org/akara/services/demo/aggregate.atom'
-@simple_service('GET', SERVICE_ID, 'akara.aggregate.atom', str(atomtools.ATOM_IMT))
+@simple_service('GET', SERVICE_ID, 'akara.aggregate.atom', str(atomtools.ATOM_IMT),
+                etag=True)
 def aggregate_atom():
     """Aggregate a set of Atom entries and return as an Atom feed
     
@@ -87,7 +88,8 @@ def aggregate_atom():
 # We love Atom, but for sake of practicality (and JSON fans), here is
 # a transform for general feeds
 SERVICE_ID = 'http://purl.org/akara/services/demo/webfeed.json'
-@simple_service('GET', SERVICE_ID, 'akara.webfeed.json', 'application/json')
+@simple_service('GET', SERVICE_ID, 'akara.webfeed.json', 'application/json',
+                cooperative=True)
 def webfeed_json(url):
     """Convert an Atom feed to Exhibit JSON
     
@@ -558,7 +558,7 @@ def dispatcher():
     __doc__ = SAMPLE_QUERIES_DOC
     return
 
-@dispatcher.method("GET")
+@dispatcher.method("GET", cooperative=True)
 def get_page(environ, start_response):
     req_headers = copy_headers_to_dict(environ,exclude=['HTTP_ACCEPT_ENCODING'])
     wiki_id, base, opener, original_page, wrapped_wiki_base = target(environ)
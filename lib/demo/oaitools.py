@@ -88,7 +88,8 @@ ATOM_ENVELOPE = '''<?xml version="1.0" encoding="UTF-8"?>
 '''
 
 SERVICE_ID = 'http://purl.org/akara/services/demo/oai.json'
-@simple_service('GET', SERVICE_ID, 'akara.oai.atom', 'application/atom+xml')
+@simple_service('GET', SERVICE_ID, 'akara.oai.atom', 'application/atom+xml',
+                cooperative=True)
 def atomize_oai_record(endpoint=None, id=None):
     '''
     endpoint - the OAI request URL, e.g. http://dspace.mit.edu/oai/request
@@ -14,12 +14,16 @@ import os
 import stat
 import mimetypes
 from email.utils import formatdate
+from wsgiref.util import FileWrapper
 import warnings
 
 from akara import registry
 
 SERVICE_ID = 'http://purl.org/akara/services/demo/static'
 
+# Used when the server does not have a wsgi.file_wrapper
+BLOCK_SIZE = 65536
+
 class MediaHandler(object):
 
     __name__ = 'MediaHandler'
@@ -58,18 +62,23 @@ class MediaHandler(object):
         # the Last-Modified header. It makes media files a bit speedier
         # because the files are only read off disk for the first request
         # (assuming the browser/client supports conditional GET).
-        mtime = formatdate(os.stat(filename).st_mtime, usegmt=True)
+        st = os.fstat(fp.fileno())
+        mtime = formatdate(st.st_mtime, usegmt=True)
         headers = [('Last-Modified', mtime)]
         if environ.get('HTTP_IF_MODIFIED_SINCE', None) == mtime:
             status = '304 Not Modified'
             output = ()
+            fp.close()
         else:
             status = '200 OK'
             mime_type = mimetypes.guess_type(filename)[0]
             if mime_type:
                 headers.append(('Content-Type', mime_type))
-            output = [fp.read()]
-            fp.close()
+            headers.append(('Content-Length', str(st.st_size)))
+            # The server can send the file with sendfile(). Otherwise
+            # it's read in blocks, not all at once.
+            file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+            output = file_wrapper(fp, BLOCK_SIZE)
         start_response(status, headers)
         return output
 
@@ -107,7 +107,10 @@ def bot_check(match_info):
 
 
 SERVICE_ID = 'http://purl.org/akara/services/demo/wwwlog.json'
-@simple_service('POST', SERVICE_ID, 'akara.wwwlog.json', 'application/json')
+# Logs can be large. Read the body from a (possibly on disk) file
+# instead of getting it all as one string.
+@simple_service('POST', SERVICE_ID, 'akara.wwwlog.json', 'application/json',
+                stream_body=True)
 def wwwlog2json(body, ctype, maxrecords=None, nobots=False):
     '''
     Convert Apache log info to Exhibit JSON
@@ -119,7 +122,8 @@ def wwwlog2json(body, ctype, maxrecords=None, nobots=False):
     if maxrecords:
         maxrecords = int(maxrecords)
     entries = []
-    for count, line in enumerate(body.splitlines()):
+    for count, line in enumerate(body):
+        line = line.rstrip("\r\n")
         if maxrecords and count >= maxrecords:
             break
         match_info = COMBINED_LOGLINE_PAT.match(line)
@@ -13,6 +13,9 @@ server_root            : Akara root directory (e.g., ~/.local/lib/akara)
 pid_file               : Location of the PID file
 error_log              : Filename of the Akara error log
 access_log             : Filename of the Akara access log
+access_log_buffer_size : Bytes of access log lines kept before writing (0 = none)
+access_log_flush_interval: Max seconds an access log line is kept before writing
+structured_access_log  : Filename of the JSON lines access log, or None
 module_dir             : Akara module directory
 module_cache           : Module cache directory
 log_level              : Logging level
@@ -20,6 +23,30 @@ max_servers            : Maximum number of servers
 min_spare_servers      : Min spare servers
 max_spare_servers      : Max spare servers
 max_requests_per_server: Max requests per server
+preload_modules        : Import extension modules in the master process
+accept_strategy        : How the servers share the listening socket
+accept_lock_file       : Lock file used by the "lock" accept strategy
+threads_per_server     : Number of request threads in each server
+thread_kill_limit      : Seconds before a hung request thread is killed
+worker_type            : "sync" or "gevent" (event loop) servers
+connections_per_server : Max connections handled by a "gevent" server
+scoreboard_file        : Shared file where the servers report their status
+status_mount_point     : Mount point for the local-only status service
+scaling_policy         : "spare" or "load"; how the number of servers changes
+target_utilization     : Fraction of busy servers aimed for by "load" scaling
+max_spawn_rate         : Max new servers per second with "load" scaling
+scale_down_delay       : Seconds of low load before "load" scaling stops servers
+max_server_rss         : Restart a server using more memory (bytes; 0 = no limit)
+max_server_age         : Restart a server older than this (seconds; 0 = no limit)
+write_buffer_size      : Response writes smaller than this are sent together
+request_parser         : "fast" or "standard" HTTP request header parsing
+spool_body_size        : Larger stream_body request bodies are kept on disk
+compression            : Compress responses with gzip or deflate if accepted
+compress_types         : Content types (glob patterns) which are compressed
+compress_min_size      : Smaller responses are not compressed
+compress_level         : zlib compression level (1-9)
+compress_cache_dir     : Directory for compressed copies of files ("" = none)
+compress_cache_max_size: Max bytes of compressed copies kept in compress_cache_dir
 
 The primary purpose of this module is to make configuration parameters
 available to various library modules that make up the Akara core. 
@@ -24,7 +24,11 @@ Note: for a recipe for filtering the log entries, see:
 
 """
 
+import atexit
+import os
 import sys
+import threading
+import time
 import logging
 
 from cStringIO import StringIO
@@ -128,11 +132,155 @@ _access_log_formatter = logging.Formatter("%(message)s")
 
 _access_handler = None
 
-def set_access_logfile(f):
-    global _access_handler
-    new_access_handler = logging.FileHandler(f)
-    new_access_handler.setFormatter(_access_log_formatter)
-    _access_logger.addHandler(new_access_handler)
-    if _access_handler is not None:
-        _access_logger.removeHandler(_access_handler)
-    _access_handler = new_access_handler
+# The faster alternative to the logging module, when the access log
+# is buffered. Used through write_access_log().
+_access_buffer = None
+
+def set_access_logfile(f, buffer_size=0, flush_interval=1.0):
+    """Direct (or redirect) access logging to a file
+
+    If buffer_size is 0, each line is written through the logging
+    module as soon as the request is done. Otherwise lines are kept
+    in memory until there are buffer_size bytes of them or they are
+    flush_interval seconds old.
+    """
+    global _access_handler, _access_buffer
+    if buffer_size:
+        new_access_buffer = BufferedAccessLog(f, buffer_size, flush_interval)
+        if _access_handler is not None:
+            _access_logger.removeHandler(_access_handler)
+            _access_handler.close()
+            _access_handler = None
+    else:
+        new_access_buffer = None
+        new_access_handler = logging.FileHandler(f)
+        new_access_handler.setFormatter(_access_log_formatter)
+        _access_logger.addHandler(new_access_handler)
+        if _access_handler is not None:
+            _access_logger.removeHandler(_access_handler)
+        _access_handler = new_access_handler
+    if _access_buffer is not None:
+        _access_buffer.close()
+    _access_buffer = new_access_buffer
+
+def write_access_log(line):
+    "Write a line (without the newline) to the access log"
+    if _access_buffer is not None:
+        _access_buffer.write(line + "\n")
+    else:
+        _access_logger.debug(line)
+
+# The optional structured (JSON lines) access log
+_structured_access_buffer = None
+
+def set_structured_access_logfile(f, buffer_size=0, flush_interval=1.0):
+    """Direct (or redirect) the structured access log to a file
+
+    Use None to stop writing it. The buffer_size and flush_interval
+    are as for set_access_logfile(). A buffer_size of 0 writes each
+    line as soon as the request is done.
+    """
+    global _structured_access_buffer
+    if f is None:
+        new_buffer = None
+    else:
+        new_buffer = BufferedAccessLog(f, buffer_size, flush_interval)
+    if _structured_access_buffer is not None:
+        _structured_access_buffer.close()
+    _structured_access_buffer = new_buffer
+
+def has_structured_access_log():
+    return _structured_access_buffer is not None
+
+def write_structured_access_log(line):
+    "Write a line (without the newline) to the structured access log"
+    if _structured_access_buffer is not None:
+        _structured_access_buffer.write(line + "\n")
+
+# Write out the buffered lines when a server exits normally. This is
+# registered once, for whichever buffers are current then.
+def _flush_access_logs():
+    for buffer in (_access_buffer, _structured_access_buffer):
+        if buffer is not None:
+            buffer.flush()
+
+atexit.register(_flush_access_logs)
+
+# A "gevent" server monkey-patches time.sleep. The flush thread is a
+# real thread so it needs the real one.
+_sleep = time.sleep
+
+class BufferedAccessLog(object):
+    """Write access log lines in blocks, not one write() per request
+
+    Each server process has its own buffer. A block is written with a
+    single os.write() to a file opened for appending, so lines from
+    different servers don't get mixed together. A thread in each
+    server writes out lines which are older than flush_interval, when
+    there are too few requests to fill the buffer.
+    """
+    def __init__(self, filename, buffer_size, flush_interval):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self._lock = threading.Lock()
+        self._lines = []
+        self._size = 0
+        # The process which has a flush thread for this buffer.
+        # A forked server needs to start its own.
+        self._flusher_pid = None
+
+    def write(self, line):
+        self._lock.acquire()
+        try:
+            self._lines.append(line)
+            self._size += len(line)
+            if self._size >= self.buffer_size:
+                self._flush()
+        finally:
+            self._lock.release()
+        if self.buffer_size and self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        if not self._lines or self._fd is None:
+            return
+        data = "".join(self._lines)
+        self._lines = []
+        self._size = 0
+        try:
+            while data:
+                n = os.write(self._fd, data)
+                data = data[n:]
+        except OSError, err:
+            _logger.error("Unable to write to the access log %r: %s" %
+                          (self.filename, err))
+
+    def _start_flusher(self):
+        self._flusher_pid = pid = os.getpid()
+        def flush_every_interval():
+            while self._fd is not None and self._flusher_pid == pid:
+                _sleep(self.flush_interval)
+                self.flush()
+        t = threading.Thread(target=flush_every_interval,
+                             name="Akara access log flusher")
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._flush()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        finally:
+            self._lock.release()
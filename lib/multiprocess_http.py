@@ -33,10 +33,18 @@ each HTTP listener subprocesses, which is also when module resource
 registration occurs.
 
 """
-import datetime
+import calendar
+import functools
+import json
+import math
 import os
+import posixpath
+import random
+import socket
 import string
+import struct
 import sys
+import threading
 import time
 import traceback
 import urllib
@@ -46,8 +54,10 @@ import logging
 from wsgiref.util import shift_path_info
 from wsgiref.simple_server import WSGIRequestHandler
 
-from akara import logger
+from akara import logger, logger_config
 from akara import registry
+from akara import scoreboard
+from akara import compression
 
 from akara.thirdparty import preforkserver, httpserver
 
@@ -83,19 +93,489 @@ access_logger = logging.getLogger("akara.access")
 # method that I can use to sneak in my exec before letting flup's
 # child mainloop run.
 
+# The downside is that every new child has to import amara and all of
+# the extension modules before it can handle its first request, and
+# flup spawns new children exactly when the load goes up. The
+# "PreloadModules" option trades the isolation for speed. The master
+# imports the modules once (see _preload_modules) and the children
+# inherit the populated registry through fork(), sharing the memory
+# pages until they are written to.
+
+# A SIGHUP restarts without closing the listening socket. The master
+# re-reads the configuration and starts a new AkaraPreforkServer,
+# which takes over the old children. They keep handling requests
+# until the new children have loaded the extension modules and
+# report that they are ready. Then the old children are told to
+# finish their current request and exit. (See "gracefulRestart" in
+# PreforkServer.)
+
+# When the master has a scoreboard (see akara.scoreboard), it gives
+# each child a slot before forking, and frees the slot once the child
+# is reaped. The child reports its state there, and the
+# dispatcher records each request.
+
+# With "ScalingPolicy" set to "load", the number of children follows
+# the measured demand instead of only the number of idle children.
+# See LoadScaler.
+
+# Besides "MaxRequestsPerServer", a child exits between requests once
+# its resident memory is over "MaxServerRSS" or it is older than
+# "MaxServerAge". The child finishes the requests in progress, like
+# for MaxRequestsPerServer, and the master spawns a replacement when
+# needed. Each child uses a random age limit between 75% and 100% of
+# MaxServerAge, so children started together aren't all replaced at
+# the same time.
+
+# The "AcceptStrategy" setting controls how the children share the
+# listening socket. See akara.conf for the details.
+#   "shared" - every idle child waits on the same socket. A new
+#       connection wakes all of them but only one gets it.
+#   "lock" - the children take turns waiting on the socket, using
+#       a lock file (like Apache's AcceptMutex).
+#   "reuseport" - the master only reserves the address. Each child
+#       binds its own SO_REUSEPORT socket and the kernel picks which
+#       child gets the connection.
+
+# With "ThreadsPerServer" larger than 1, each child hands the accepted
+# connections to a pool of that many threads (paste's ThreadPool,
+# which also knows how to kill hung threads). The child only accepts
+# a new connection when one of its threads is free, and only tells
+# the master it's busy when all of them are in use. Services which
+# mostly wait on other servers then need far fewer processes.
+
+# With "WorkerType" set to "gevent", each child runs a gevent event
+# loop instead, with one greenlet per connection, up to
+# "ConnectionsPerServer" of them. The child monkey-patches the
+# standard library so socket I/O (and the select() in
+# _waitForClient) switches to another greenlet instead of blocking.
+# Threads are not patched. Services registered with cooperative=True
+# run in the connection's greenlet. Everything else is passed to a
+# pool of "ThreadsPerServer" real threads, since an arbitrary service
+# may block the whole process. akara.request and akara.response are
+# switched to greenlet-local storage.
+
 class AkaraPreforkServer(preforkserver.PreforkServer):
     def __init__(self, settings, config,
                  minSpare=1, maxSpare=5, maxChildren=50,
-                 maxRequests=0):
+                 maxRequests=0, preloadModules=False,
+                 acceptStrategy="shared", threadsPerServer=1,
+                 threadKillLimit=1800, workerType="sync",
+                 connectionsPerServer=1000, scoreboard=None,
+                 scalingPolicy="spare", targetUtilization=0.75,
+                 maxSpawnRate=4, scaleDownDelay=30,
+                 maxServerRSS=0, maxServerAge=0):
+        if acceptStrategy == "lock":
+            acceptLock = preforkserver.FcntlAcceptLock(settings["accept_lock_file"])
+        else:
+            acceptLock = None
         preforkserver.PreforkServer.__init__(self,
                                              minSpare=minSpare, maxSpare=maxSpare,
                                              maxChildren=maxChildren, maxRequests=maxRequests,
                                              jobClass=AkaraJob,
-                                             jobArgs=(settings, config))
+                                             jobArgs=(settings, config),
+                                             acceptLock=acceptLock,
+                                             gracefulRestart=True)
         self.config = config
+        self.preload_modules = preloadModules
+        self.accept_strategy = acceptStrategy
+        self.server_address = settings["server_address"]
+        self.threads_per_server = threadsPerServer
+        self.thread_kill_limit = threadKillLimit
+        self.worker_type = workerType
+        self.connections_per_server = connectionsPerServer
+        self.status_mount_point = settings["status_mount_point"]
+        self.scoreboard = scoreboard
+        self._slots = {}  # pid -> scoreboard slot
+        self._spawnSlot = None
+        if scalingPolicy == "load":
+            self.scaler = LoadScaler(self._minSpare, self._maxSpare,
+                                     self._maxChildren, targetUtilization,
+                                     maxSpawnRate, scaleDownDelay)
+            self._tick = LoadScaler.interval
+        else:
+            self.scaler = None
+        self._listenSock = None
+        self.max_server_rss = maxServerRSS  # in bytes; 0 means no limit
+        self.max_server_age = maxServerAge  # in seconds; 0 means no limit
+        self._childDeadline = None
+
+    def _spawnChild(self, sock):
+        if self.scoreboard is not None:
+            used = set(self._slots.values())
+            for slot in range(self.scoreboard.num_slots):
+                if slot not in used:
+                    break
+            else:
+                slot = None
+            self._spawnSlot = slot
+        return preforkserver.PreforkServer._spawnChild(self, sock)
+
+    def _childSpawned(self, pid):
+        if self._spawnSlot is not None:
+            self._slots[pid] = self._spawnSlot
+
+    def _childExited(self, pid):
+        slot = self._slots.pop(pid, None)
+        if slot is not None:
+            self.scoreboard.clear(slot)
+
+    def _adoptChildren(self, previous):
+        # The scoreboard may have been replaced by a larger one. The
+        # old children keep writing to the old one, so don't clear
+        # their slots in the new one when they exit.
+        if previous.scoreboard is self.scoreboard:
+            self._slots.update(previous._slots)
+        preforkserver.PreforkServer._adoptChildren(self, previous)
+
+    def _childDone(self, requestCount):
+        if preforkserver.PreforkServer._childDone(self, requestCount):
+            return True
+        if self.max_server_rss:
+            rss = scoreboard.get_rss()
+            if rss > self.max_server_rss:
+                logger.info("Server using %d MB of memory, which is over the "
+                            "limit of %d MB. Exiting." %
+                            (rss // MB, self.max_server_rss // MB))
+                return True
+        if self._childDeadline is not None and time.time() > self._childDeadline:
+            logger.info("Server reached its maximum age. Exiting.")
+            return True
+        return False
+
     def _child(self, sock, parent):
-        _init_modules(self.config)
-        preforkserver.PreforkServer._child(self, sock, parent)
+        if self.max_server_age:
+            self._childDeadline = time.time() + (
+                self.max_server_age * random.SystemRandom().uniform(0.75, 1.0))
+        if self._spawnSlot is not None:
+            scoreboard.attach(self.scoreboard, self._spawnSlot)
+        if self.accept_strategy == "reuseport":
+            # The master's socket is bound but isn't listening, so the
+            # kernel never gives it a connection. Get one of our own.
+            sock.close()
+            sock = make_listen_socket(self.server_address, reuse_port=True)
+            sock.listen(socket.SOMAXCONN)
+            sock.setblocking(0)
+            preforkserver.setCloseOnExec(sock)
+        if not self.preload_modules:
+            _init_modules(self.config)
+        if self.status_mount_point and self.scoreboard is not None:
+            scoreboard.register_status_service(self.status_mount_point,
+                                               self.scoreboard.filename)
+        scoreboard.server_ready()
+        # Tell the master we're ready. After a restart, that's when
+        # the previous generation of children is told to exit.
+        self._notifyParent(parent, '\xff')
+        if self.worker_type == "gevent":
+            self._gevent_child(sock, parent)
+        elif self.threads_per_server > 1:
+            self._threaded_child(sock, parent)
+        else:
+            preforkserver.PreforkServer._child(self, sock, parent)
+
+    def _threaded_child(self, sock, parent):
+        self._reseedRandom()
+        pool = httpserver.ThreadPool(
+            self.threads_per_server, "Akara server %d" % (os.getpid(),),
+            daemon = True,
+            # The pool is bounded. Don't grow it when threads hang.
+            spawn_if_under = 0,
+            hung_thread_limit = min(30, self.thread_kill_limit or 30),
+            kill_thread_limit = self.thread_kill_limit,
+            logger = logging.getLogger("akara.threadpool"))
+        # Number of threads handling a request. Changes to the count and
+        # the matching status byte for the master are sent under the
+        # lock so the master always gets them in the right order.
+        busy = [0]
+        lock = threading.Condition()
+
+        def run_job(clientSock, addr):
+            try:
+                self._jobClass(clientSock, addr, *self._jobArgs).run()
+            finally:
+                lock.acquire()
+                try:
+                    busy[0] -= 1
+                    if busy[0] == self.threads_per_server - 1:
+                        # Tell parent we're free again.
+                        self._notifyParent(parent, '\xff')
+                    lock.notify()
+                finally:
+                    lock.release()
+
+        requestCount = 0
+        while True:
+            # Wait for a free thread. Check now and then for hung
+            # threads, since there are no new tasks to trigger that.
+            lock.acquire()
+            try:
+                while busy[0] >= self.threads_per_server:
+                    lock.wait(5)
+                    if busy[0] >= self.threads_per_server:
+                        pool.kill_hung_threads()
+            finally:
+                lock.release()
+
+            client = self._waitForClient(sock, parent)
+            if client is None:
+                break
+
+            lock.acquire()
+            try:
+                busy[0] += 1
+                if busy[0] == self.threads_per_server:
+                    # Notify parent we're no longer available.
+                    self._notifyParent(parent, '\x00')
+            finally:
+                lock.release()
+            pool.add_task(lambda client=client: run_job(*client))
+
+            # If we've serviced the maximum number of requests, exit.
+            requestCount += 1
+            if self._childDone(requestCount):
+                break
+
+        # Let the requests in progress finish
+        lock.acquire()
+        try:
+            while busy[0] > 0:
+                lock.wait(5)
+        finally:
+            lock.release()
+        pool.shutdown()
+
+    def _gevent_child(self, sock, parent):
+        from gevent import monkey
+        monkey.patch_all(thread=False)
+        import gevent.local, gevent.pool, gevent.socket, gevent.threadpool
+        from akara import request, response, services
+        request._local = gevent.local.local()
+        response._local = gevent.local.local()
+        self._reseedRandom()
+
+        threadpool = gevent.threadpool.ThreadPool(self.threads_per_server)
+        def call_handler(handler, environ, start_response):
+            if services.is_cooperative(handler, environ):
+                return handler(environ, start_response)
+            # Wait in this greenlet while a thread does the work
+            return _call_blocking_handler(threadpool.apply, handler,
+                                          environ, start_response)
+
+        pool = gevent.pool.Pool(self.connections_per_server)
+        def run_job(clientSock, addr):
+            try:
+                self._jobClass(clientSock, addr, *self._jobArgs,
+                               call_handler=call_handler).run()
+            finally:
+                # Still counted in the pool until this returns
+                if pool.full():
+                    # Tell parent we're free again.
+                    self._notifyParent(parent, '\xff')
+
+        requestCount = 0
+        while True:
+            pool.wait_available()
+            client = self._waitForClient(sock, parent)
+            if client is None:
+                break
+            # Use a cooperative socket for the connection. Closing the
+            # original only drops its reference to the connection.
+            clientSock, addr = client
+            client = gevent.socket.socket(_sock=clientSock._sock)
+            clientSock.close()
+            clientSock = client
+            pool.spawn(run_job, clientSock, addr)
+            if pool.full():
+                # Notify parent we're no longer available.
+                self._notifyParent(parent, '\x00')
+
+            # If we've serviced the maximum number of connections, exit.
+            requestCount += 1
+            if self._childDone(requestCount):
+                break
+
+        # Let the requests in progress finish
+        pool.join()
+        threadpool.kill()
+
+    def _balanceChildren(self, sock):
+        if self.scaler is None:
+            return preforkserver.PreforkServer._balanceChildren(self, sock)
+        now = time.time()
+        current = self._numChildren()
+        busy = current - len(self._availPids)
+        if self.scaler.needs_sample(now):
+            if self.scoreboard is not None:
+                busy_time = self.scoreboard.total_busy_time(now)
+            else:
+                busy_time = None
+            self.scaler.sample(now, busy, busy_time,
+                               accept_queue_length(self._listenSock))
+        for i in range(self.scaler.spawn_count(now, current, busy)):
+            if not self._spawnChild(sock):
+                break
+        if self.scaler.should_stop_one(now, current, busy) and self._availPids:
+            # Stop the newest of the idle children
+            self._closeChild(max(self._availPids))
+
+    def run(self, sock, previous=None):
+        self._listenSock = sock
+        try:
+            return preforkserver.PreforkServer.run(self, sock, previous)
+        finally:
+            if self._acceptLock is not None:
+                self._acceptLock.close()
+
+
+# The "load" ScalingPolicy. The demand is the average number of busy
+# children, measured from the total time the children spent handling
+# requests (from the scoreboard), smoothed with a moving average.
+# When the average is rising, its increase over the last interval is
+# added again, to spawn ahead of the ramp. Connections waiting in the
+# listen queue also count.
+#
+# The wanted number of children is demand / targetUtilization, and
+# at least minSpare more than the number of busy children. New
+# children are spawned right away, but no more than maxSpawnRate per
+# second. A few slow requests only add their own children to the
+# demand, so they can't cause a burst of spawns. Children are
+# stopped only when even the lower utilization of the hysteresis
+# band would need fewer of them, and only after that has been true
+# for scaleDownDelay seconds. Then one idle child is stopped per
+# interval.
+class LoadScaler(object):
+    interval = 1.0  # seconds between samples
+    weight = 0.5    # of the newest sample in the moving average
+    # Stop children when the utilization drops below this fraction
+    # of the target utilization
+    hysteresis = 0.7
+
+    def __init__(self, min_spare, max_spare, max_children,
+                 target_utilization=0.75, max_spawn_rate=4, scale_down_delay=30):
+        self.min_spare = min_spare
+        self.max_spare = max_spare
+        self.max_children = max_children
+        self.target_utilization = target_utilization
+        self.max_spawn_rate = max_spawn_rate
+        self.scale_down_delay = scale_down_delay
+
+        self.average = 0.0
+        self.trend = 0.0
+        self.queue = 0
+        self.last_sample = None
+        self.last_busy_time = None
+        self.spawn_tokens = float(max_spawn_rate)
+        self.last_tokens = None
+        self.below_since = None
+        self.last_stop = None
+
+    def needs_sample(self, now):
+        return self.last_sample is None or now - self.last_sample >= self.interval
+
+    def sample(self, now, busy, busy_time, queue):
+        """Update the demand estimates
+
+        busy - the number of busy children now
+        busy_time - total seconds spent on requests (see
+            Scoreboard.total_busy_time), or None if not known
+        queue - number of connections waiting to be accepted, or None
+        """
+        demand = busy
+        if busy_time is not None and self.last_busy_time is not None:
+            delta = busy_time - self.last_busy_time
+            # It can go down if the scoreboard was replaced
+            if delta >= 0 and now > self.last_sample:
+                demand = delta / (now - self.last_sample)
+        if self.last_sample is None:
+            self.average = float(demand)
+        else:
+            previous = self.average
+            self.average += self.weight * (demand - self.average)
+            self.trend = self.average - previous
+        self.queue = queue or 0
+        self.last_sample = now
+        self.last_busy_time = busy_time
+
+    def demand(self):
+        "The estimated number of children which will be busy"
+        return self.average + max(0.0, self.trend) + self.queue
+
+    def _wanted(self, busy, utilization, floor):
+        wanted = int(math.ceil(self.demand() / utilization))
+        return min(max(wanted, busy + self.min_spare, floor), self.max_children)
+
+    def spawn_count(self, now, current, busy):
+        "The number of children to spawn now"
+        if self.last_tokens is not None:
+            self.spawn_tokens = min(float(self.max_spawn_rate),
+                self.spawn_tokens + (now - self.last_tokens) * self.max_spawn_rate)
+        self.last_tokens = now
+        n = min(self._wanted(busy, self.target_utilization, self.max_spare) - current,
+                int(self.spawn_tokens))
+        if n <= 0:
+            return 0
+        self.spawn_tokens -= n
+        self.below_since = None
+        return n
+
+    def should_stop_one(self, now, current, busy):
+        "True if an idle child should be stopped now"
+        wanted = self._wanted(busy, self.target_utilization * self.hysteresis,
+                              self.max_spare)
+        if current <= wanted:
+            self.below_since = None
+            return False
+        if self.below_since is None:
+            self.below_since = now
+        if now - self.below_since < self.scale_down_delay:
+            return False
+        if self.last_stop is not None and now - self.last_stop < self.interval:
+            return False
+        self.last_stop = now
+        return True
+
+
+TCP_INFO = getattr(socket, "TCP_INFO", None)
+_TCP_LISTEN = 10
+
+def accept_queue_length(sock):
+    """Return the number of connections waiting to be accepted, or None
+
+    This uses Linux's TCP_INFO, which for a listening socket reports
+    the length of the accept queue as 'tcpi_unacked'.
+    """
+    if sock is None or TCP_INFO is None:
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, 104)
+    except socket.error:
+        return None
+    if len(info) < 28 or ord(info[0]) != _TCP_LISTEN:
+        return None
+    return struct.unpack_from("=I", info, 24)[0]
+
+
+MB = 1024 * 1024
+
+# Python 2 doesn't define SO_REUSEPORT. The value is 15 on Linux.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+if SO_REUSEPORT is None and sys.platform.startswith("linux"):
+    SO_REUSEPORT = 15
+
+def make_listen_socket(server_address, reuse_port=False):
+    "Create a socket bound to the server address. The caller must listen()"
+    sock = socket.socket()
+    # XXX Should SO_REUSEADDR be a configuration setting?
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    # Disable Nagle's algorithm, which causes problems with
+    # keep-alive. See:
+    #     http://stackoverflow.com/questions/1781766/
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind(server_address)
+    return sock
 
 
 # Once the flup PreforkServer has a request, it starts up an AkaraJob.
@@ -106,16 +586,18 @@ class AkaraPreforkServer(preforkserver.PreforkServer):
 # AkaraWSGIHandler's third parameter, which is an 
 
 class AkaraJob(object):
-    def __init__(self, sock, addr, settings, config):
+    def __init__(self, sock, addr, settings, config, call_handler=None):
         self._sock = sock
         self._addr = addr
         self.settings = settings  # parsed settings as a dict
         self.config = config      # a ConfigParser
+        self.call_handler = call_handler
     def run(self):
         self._sock.setblocking(1)
         logger.debug("Start request from address %r, local socket %r" %
                      (self._addr, self._sock.getsockname()))
-        handler = AkaraWSGIDispatcher(self.settings, self.config)
+        handler = AkaraWSGIDispatcher(self.settings, self.config,
+                                      self.call_handler)
         self.handler = AkaraWSGIHandler(self._sock, self._addr, handler)
         logger.debug("End request from address %r, local socket %r" %
                      (self._addr, self._sock.getsockname()))
@@ -132,6 +614,195 @@ class AkaraWSGIHandler(httpserver.WSGIHandler):
     def log_request(self, code='-', size='-'):
         pass
 
+    # The structured access log records the time until the headers
+    # were ready and the bytes actually sent, so it is written after
+    # the whole response, not by the dispatcher.
+    def wsgi_execute(self, environ=None):
+        if not logger_config.has_structured_access_log():
+            return httpserver.WSGIHandler.wsgi_execute(self, environ)
+        start_time = time.time()
+        try:
+            httpserver.WSGIHandler.wsgi_execute(self, environ)
+        finally:
+            self.server.save_to_structured_access_log(
+                self.wsgi_environ, start_time, time.time(),
+                self.wsgi_headers_time, self.wsgi_bytes_sent)
+
+    # With the "fast" RequestParser (the default) the two methods
+    # below handle the usual case of an HTTP/1.0 or HTTP/1.1 request
+    # for an absolute path themselves. BaseHTTPServer parses headers
+    # with mimetools.Message, and paste's wsgi_setup uses urlsplit(),
+    # normpath() and a getheaders() call for each header, which is a
+    # noticeable part of the time for a small GET. Anything unusual
+    # goes through the original code.
+
+    def parse_request(self):
+        if self.server.request_parser != "fast":
+            return httpserver.WSGIHandler.parse_request(self)
+        requestline = self.raw_requestline.rstrip("\r\n")
+        words = requestline.split()
+        if len(words) != 3 or words[2] not in ("HTTP/1.0", "HTTP/1.1"):
+            return httpserver.WSGIHandler.parse_request(self)
+        self.requestline = requestline
+        self.command, self.path, self.request_version = words
+
+        headers = _read_request_headers(self.rfile)
+        if headers is None:
+            self.close_connection = 1
+            self.send_error(400, "Bad request headers")
+            return False
+        self.headers = headers
+
+        # Same keep-alive rules as BaseHTTPRequestHandler.parse_request
+        self.close_connection = int(self.request_version != "HTTP/1.1" or
+                                    self.protocol_version < "HTTP/1.1")
+        conntype = headers.get("Connection", "").lower()
+        if conntype == "close":
+            self.close_connection = 1
+        elif conntype == "keep-alive" and self.protocol_version >= "HTTP/1.1":
+            self.close_connection = 0
+        return True
+
+    def wsgi_setup(self, environ=None):
+        headers = self.headers
+        if (environ or not isinstance(headers, _RequestHeaders) or
+            not self.path.startswith("/") or
+            hasattr(self.connection, "get_context")):
+            return httpserver.WSGIHandler.wsgi_setup(self, environ)
+
+        # The same as urlsplit() for a path, then paste's clean-up
+        path = self.path.split("#", 1)[0]
+        path, _, query = path.partition("?")
+        if "%" in path:
+            path = urllib.unquote(path)
+        if "//" in path or "/." in path:
+            endslash = path.endswith("/")
+            path = posixpath.normpath(path)
+            if endslash and path != "/":
+                path += "/"
+
+        content_length = headers.get("Content-Length", "0")
+        if (self.request_version == "HTTP/1.1" and
+            headers.get("Expect", "").lower() == "100-continue"):
+            rfile = httpserver.ContinueHook(self.rfile, self.wsgi_send)
+        else:
+            try:
+                length = int(content_length)
+            except ValueError:
+                length = 0
+            rfile = httpserver.LimitedLengthFile(self.rfile, length)
+
+        server_name, server_port = self.server.server_address
+        environ = headers.environ()
+        environ.update({
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": rfile,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": httpserver.FileWrapper,
+            "REQUEST_METHOD": self.command,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "CONTENT_TYPE": headers.get("Content-Type", ""),
+            "CONTENT_LENGTH": content_length,
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": self.request_version,
+            "REMOTE_ADDR": self.client_address[0],
+            })
+        self.wsgi_environ = environ
+        self.wsgi_curr_headers = None
+        self.wsgi_headers_sent = False
+        self.wsgi_chunked = False
+        self.wsgi_bytes_sent = 0
+        self.wsgi_headers_time = None
+
+# Limits on what _read_request_headers() accepts
+MAX_HEADER_LINE = 65536
+MAX_HEADERS = 100
+
+class _RequestHeaders(object):
+    """The request headers read by _read_request_headers()
+
+    This has the parts of the mimetools.Message API which
+    BaseHTTPServer and paste use. As with mimetools, get() returns
+    the last value of a repeated header.
+    """
+    def __init__(self, fields):
+        self.fields = fields  # list of (name, value) pairs
+        self._dict = dict((name.lower(), value) for (name, value) in fields)
+
+    def get(self, name, default=None):
+        return self._dict.get(name.lower(), default)
+    getheader = get
+
+    def __getitem__(self, name):
+        return self._dict[name.lower()]
+
+    def __contains__(self, name):
+        return name.lower() in self._dict
+    has_key = __contains__
+
+    def getheaders(self, name):
+        name = name.lower()
+        return [value for (k, value) in self.fields if k.lower() == name]
+
+    def keys(self):
+        return self._dict.keys()
+
+    def items(self):
+        return self._dict.items()
+
+    def __str__(self):
+        return "".join("%s: %s\r\n" % field for field in self.fields)
+
+    def environ(self):
+        "Return a new dictionary with the HTTP_* variables for a WSGI environ"
+        environ = {}
+        for (name, value) in self.fields:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if key in environ:
+                # Join repeated headers, like paste does
+                environ[key] += "," + value
+            else:
+                environ[key] = value
+        environ.pop("HTTP_CONTENT_TYPE", None)
+        environ.pop("HTTP_CONTENT_LENGTH", None)
+        return environ
+
+def _read_request_headers(rfile):
+    """Read the request headers, up to and including the blank line
+
+    Returns a _RequestHeaders, or None if the headers are malformed
+    or too large.
+    """
+    fields = []
+    while 1:
+        line = rfile.readline(MAX_HEADER_LINE + 1)
+        if len(line) > MAX_HEADER_LINE:
+            return None
+        if line in ("\r\n", "\n", ""):
+            break
+        if line[0] in " \t":
+            # A continuation of the previous header
+            if not fields:
+                return None
+            name, value = fields[-1]
+            fields[-1] = (name, value + " " + line.strip())
+            continue
+        name, sep, value = line.partition(":")
+        name = name.strip()
+        if not sep or not name or " " in name:
+            return None
+        if len(fields) == MAX_HEADERS:
+            return None
+        fields.append((name, value.strip()))
+    return _RequestHeaders(fields)
+
 # This is the the top-level WSGI dispatcher between paste.httpserver
 # and Akara proper. It only understand how to get the first part of
 # the path (called the "mount_point") and get the associated handler
@@ -170,34 +841,51 @@ def _send_error(start_response, code, exc_info=None):
 # This definition comes from paste.translogger. For certainty's sake:
 # (c) 2005 Ian Bicking and contributors; written for Paste (http://pythonpaste.org)
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
-ACCESS_LOG_MESSAGE = (
-    '%(REMOTE_ADDR)s - %(REMOTE_USER)s [%(start_time)s] '
-    '"%(REQUEST_METHOD)s %(REQUEST_URI)s %(HTTP_VERSION)s" '
-    '%(status)s %(bytes)s "%(HTTP_REFERER)s" "%(HTTP_USER_AGENT)s"')
+# The fields are positional, since this is formatted for every request:
+#   REMOTE_ADDR - REMOTE_USER [start_time]
+#   "REQUEST_METHOD REQUEST_URI HTTP_VERSION"
+#   status bytes "HTTP_REFERER" "HTTP_USER_AGENT"
+ACCESS_LOG_MESSAGE = '%s - %s [%s] "%s %s %s" %s %s "%s" "%s"'
 
 # This proved a lot more difficult than I thought it would be.
 # I looked at the translogger solution, but I don't think it works
 # across the change of timezones and I didn't want to use the '%b'
 # time formatter because it is locale dependant.
 
-def timetuple_to_datetime(t):
-    return datetime.datetime(t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
-
 _months = "XXX Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
-def _get_time():
-    now = time.localtime()
-    utc_time = time.gmtime()
 
-    tz_seconds = (timetuple_to_datetime(now) - timetuple_to_datetime(utc_time)).seconds
+def _format_time(t):
+    "The access log timestamp for the time t, in whole seconds since the epoch"
+    now = time.localtime(t)
+    # Seconds east of UTC, including daylight saving time
+    tz_seconds = calendar.timegm(now) - t
+    if tz_seconds < 0:
+        tz_sign = "-"
+        tz_seconds = -tz_seconds
+    else:
+        tz_sign = "+"
     # Round to the nearest minute
     tz_minutes = (tz_seconds + 30)//60
     tz_hour, tz_minute = divmod(tz_minutes, 60)
 
     # I've got the timezone component. The rest is easy
-    return "%02d/%s/%d:%02d:%02d:%02d %+03d%02d" % (
+    return "%02d/%s/%d:%02d:%02d:%02d %s%02d%02d" % (
         now.tm_year, _months[now.tm_mon], now.tm_mday,
         now.tm_hour, now.tm_min, now.tm_sec,
-        tz_hour, tz_minute)
+        tz_sign, tz_hour, tz_minute)
+
+# Many requests start in the same second. Only format the time when
+# the second changes. (A single tuple so threads can share it safely.)
+_time_cache = (None, None)
+
+def _get_time():
+    global _time_cache
+    t = int(time.time())
+    cached_t, formatted = _time_cache
+    if t != cached_t:
+        formatted = _format_time(t)
+        _time_cache = (t, formatted)
+    return formatted
 
 # Filter out empty fields, control characters, and space characters
 _illegal = ("".join(chr(i) for i in range(33)) +   # control characters up to space (=ASCII 32)
@@ -213,9 +901,71 @@ def _clean(s):
     return s.translate(_clean_table)
     
 
+# How the dispatcher calls a service's WSGI handler. A "gevent"
+# server passes in a call_handler which may run it in another thread.
+def _call_handler(handler, environ, start_response):
+    return handler(environ, start_response)
+
+# Used by "gevent" servers to call a handler in one of the threads.
+# apply(func, args) runs func in a thread and waits for the result.
+# The body is also produced in the threads, since a generator may
+# block as much as the handler itself, but a piece at a time so a
+# large or endless body is never held in memory.
+def _call_blocking_handler(apply, handler, environ, start_response):
+    result = apply(handler, (environ, start_response))
+    if isinstance(result, (str, list, tuple, httpserver.FileWrapper)):
+        # A file is sent with sendfile(), if possible, not read here
+        return result
+    return _BlockingBody(apply, result)
+
+# How much of the body one trip to a thread collects
+BLOCKING_BODY_PIECE_SIZE = 64*1024
+
+def _next_piece(iterator, size):
+    # Collect chunks up to about size bytes. An empty list is the end.
+    chunks = []
+    total = 0
+    for chunk in iterator:
+        chunks.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            break
+    return chunks
+
+class _BlockingBody(object):
+    def __init__(self, apply, result):
+        self.apply = apply
+        self.result = result
+
+    def __iter__(self):
+        iterator = self.apply(iter, (self.result,))
+        while True:
+            chunks = self.apply(_next_piece, (iterator, BLOCKING_BODY_PIECE_SIZE))
+            if not chunks:
+                break
+            for chunk in chunks:
+                yield chunk
+
+    def close(self):
+        if hasattr(self.result, "close"):
+            self.apply(self.result.close, ())
+
 class AkaraWSGIDispatcher(object):
-    def __init__(self, settings, config):
+    def __init__(self, settings, config, call_handler=None):
         self.server_address = settings["server_address"]
+        # Used by the AkaraWSGIHandler (see httpserver.CoalescingWriter)
+        self.write_buffer_size = settings["write_buffer_size"]
+        self.request_parser = settings["request_parser"]
+        if settings["compression"]:
+            self.compression = compression.Compression(
+                settings["compress_types"], settings["compress_min_size"],
+                settings["compress_level"], settings["compress_cache_dir"],
+                settings["compress_cache_max_size"])
+        else:
+            self.compression = None
+        if call_handler is None:
+            call_handler = _call_handler
+        self.call_handler = call_handler
 
     def wsgi_application(self, environ, start_response):
         # There's some sort of problem if the application
@@ -247,14 +997,23 @@ class AkaraWSGIDispatcher(object):
         # requirements for HEAD then strip out the body. This
         # follows the Apache/mod_wsgi approach. See
         # http://blog.dscpl.com.au/2009/10/wsgi-issues-with-http-head-requests.html
+        # Services can tell it's really a HEAD from "akara.head_request"
+        # and skip making the body (see the 'head' option in
+        # akara.services).
         is_head_request = environ.get("REQUEST_METHOD") == "HEAD"
         if is_head_request:
             environ["REQUEST_METHOD"] = "GET"
+            environ["akara.head_request"] = True
 
         access_data = dict(start_time = _get_time(),
                            request_uri = request_uri,
                            # Will get the following two from start_response_
                            status=None, content_length="-")
+        if logger_config.has_structured_access_log():
+            # For save_to_structured_access_log()
+            access_data["method"] = (is_head_request and "HEAD" or
+                                     environ.get("REQUEST_METHOD"))
+            environ["akara.access_data"] = access_data
 
         # Set up some middleware so I can capture the status and header
         # information used for access logging.
@@ -287,18 +1046,30 @@ class AkaraWSGIDispatcher(object):
             # Like when you use httplib directly and forget the leading '/'.
             return _send_error(start_response, 400)
         mount_point = shift_path_info(environ)
+        access_data["mount_point"] = mount_point
 
         # Call the handler, deal with any errors, do access logging
+        request_start = scoreboard.request_started(mount_point)
         try:
             try:
                 service = registry.get_service(mount_point)
             except KeyError:
                 # Not found. Report something semi-nice to the user
                 return _send_error(start_response_, 404)
+            access_data["service"] = service.ident
             try:
-                result = service.handler(environ, start_response_)
+                if self.compression is None:
+                    result = self.call_handler(service.handler, environ, start_response_)
+                else:
+                    from akara.services import get_compress
+                    result = self.compression(
+                        environ, start_response_,
+                        functools.partial(self.call_handler, service.handler),
+                        get_compress(service.handler, environ))
                 if is_head_request:
                     # successful HEAD requests MUST return an empty message-body
+                    if hasattr(result, "close"):
+                        result.close()
                     return []
                 return result
             except Exception, err:
@@ -312,23 +1083,58 @@ class AkaraWSGIDispatcher(object):
                 finally:
                     del exc_info
         finally:
+            scoreboard.request_finished(request_start)
             self.save_to_access_log(environ, access_data)
 
 
             
     def save_to_access_log(self, environ, access_data):
-        fields = dict(REMOTE_ADDR = _clean(environ.get("REMOTE_ADDR")),
-                      REMOTE_USER = _clean(environ.get("REMOTE_USER")),
-                      start_time = access_data["start_time"],
-                      REQUEST_METHOD = _clean(environ.get("REQUEST_METHOD")),
-                      REQUEST_URI = _clean(access_data["request_uri"]),
-                      HTTP_VERSION = environ.get("SERVER_PROTOCOL"),
-                      status = access_data["status"],
-                      bytes = access_data["content_length"],
-                      HTTP_REFERER = _clean(environ.get("HTTP_REFERER")),
-                      HTTP_USER_AGENT = _clean(environ.get("HTTP_USER_AGENT")),
-                      )
-        access_logger.debug(ACCESS_LOG_MESSAGE % fields)
+        get = environ.get
+        fields = (_clean(get("REMOTE_ADDR")),
+                  _clean(get("REMOTE_USER")),
+                  access_data["start_time"],
+                  _clean(get("REQUEST_METHOD")),
+                  _clean(access_data["request_uri"]),
+                  get("SERVER_PROTOCOL"),
+                  access_data["status"],
+                  access_data["content_length"],
+                  _clean(get("HTTP_REFERER")),
+                  _clean(get("HTTP_USER_AGENT")))
+        logger_config.write_access_log(ACCESS_LOG_MESSAGE % fields)
+
+    def save_to_structured_access_log(self, environ, start_time, end_time,
+                                      headers_time, bytes_sent):
+        access_data = environ.get("akara.access_data")
+        if access_data is None:
+            # Didn't get as far as the dispatcher
+            return
+        status = access_data["status"]
+        if headers_time is None:
+            ttfb = None
+        else:
+            ttfb = round(headers_time - start_time, 6)
+        # Set by akara.caching for each cache lookup during the request
+        if environ.get("akara.cache_misses"):
+            cache = "miss"
+        elif environ.get("akara.cache_hits"):
+            cache = "hit"
+        else:
+            cache = None
+        record = dict(time = round(start_time, 3),
+                      pid = os.getpid(),
+                      remote = environ.get("REMOTE_ADDR"),
+                      method = access_data["method"],
+                      uri = access_data["request_uri"],
+                      # Only missing if the server sent its own 500 response
+                      status = int(status) if status else 500,
+                      mount = access_data.get("mount_point"),
+                      service = access_data.get("service"),
+                      duration = round(end_time - start_time, 6),
+                      ttfb = ttfb,
+                      bytes = bytes_sent,
+                      cache = cache)
+        logger_config.write_structured_access_log(
+            json.dumps(record, sort_keys=True, separators=(",", ":")))
 
 
 ###### Support extension modules
@@ -340,7 +1146,7 @@ class AkaraWSGIDispatcher(object):
 # The master HTTP process uses this module to import the modules and
 # convert them into byte code with the correct globals(). It does not
 # exec the byte code. That's the job for the spawned-off HTTP listener
-# classes.
+# classes, unless the modules are preloaded.
 
 def _init_modules(config):
     try:
@@ -357,4 +1163,31 @@ def _init_modules(config):
             logger.error(
 "Unable to initialize module %r - skipping rest of module" % (module_name,),
                          exc_info = True)
-    
+
+# Used when "PreloadModules" is enabled. The master imports the
+# extension modules before any children are spawned. A failure to
+# import one module is still only logged, as in _init_modules.
+
+# A SIGHUP should reload the extension modules, but a second
+# __import__ only finds the existing entry in sys.modules. Remember
+# what the preload added so it can be forgotten before the next one.
+_preloaded = None  # (saved registry services, names of new modules)
+
+def _preload_modules(config):
+    global _preloaded
+    _unload_modules()
+    saved_services = registry._current_registry._registered_services.copy()
+    saved_module_names = set(sys.modules)
+    logger.info("Preloading extension modules in the master process")
+    _init_modules(config)
+    _preloaded = (saved_services, set(sys.modules) - saved_module_names)
+
+def _unload_modules():
+    global _preloaded
+    if _preloaded is None:
+        return
+    saved_services, module_names = _preloaded
+    for module_name in module_names:
+        sys.modules.pop(module_name, None)
+    registry._current_registry._registered_services = saved_services
+    _preloaded = None
@@ -23,11 +23,39 @@ class AkaraDefault:
     MaxSpareServers = 10
     MaxServers = 150
     MaxRequestsPerServer = 10000
+    PreloadModules = False
+    AcceptStrategy = "shared"
+    AcceptLockFile = "logs/akara.lock"
+    ThreadsPerServer = 1
+    ThreadKillLimit = 1800
+    WorkerType = "sync"
+    ConnectionsPerServer = 1000
+    ScoreboardFile = "logs/akara.scoreboard"
+    StatusMountPoint = ""
+    ScalingPolicy = "spare"
+    TargetUtilization = 0.75
+    MaxSpawnRate = 4
+    ScaleDownDelay = 30
+    MaxServerRSS = 0
+    MaxServerAge = 0
+    WriteBufferSize = 8192
+    RequestParser = "fast"
+    SpoolBodySize = 1024*1024
+    Compression = False
+    CompressTypes = ["text/*", "application/xml", "application/*+xml",
+                     "application/json", "application/javascript"]
+    CompressMinSize = 1024
+    CompressLevel = 6
+    CompressCacheDir = "compressed_cache"
+    CompressCacheMaxSize = 64*1024*1024
 
     ModuleDir = 'modules'
     ModuleCache = 'caches'
     ErrorLog = 'logs/error.log'
     AccessLog = 'logs/access.log'
+    AccessLogBufferSize = 0
+    AccessLogFlushInterval = 1.0
+    StructuredAccessLog = ''
     LogLevel = 'INFO'
 
 
@@ -191,6 +219,28 @@ def _extract_settings(config):
 
     access_log = getstring('AccessLog')
     settings["access_log"] = os.path.join(server_root, access_log)
+    access_log_buffer_size = getint("AccessLogBufferSize")
+    if access_log_buffer_size < 0:
+        raise Error(
+            "'Akara' configuration 'AccessLogBufferSize' must not be negative, not %r" %
+            (access_log_buffer_size,))
+    settings["access_log_buffer_size"] = access_log_buffer_size
+    try:
+        access_log_flush_interval = float(get("AccessLogFlushInterval"))
+    except (TypeError, ValueError):
+        access_log_flush_interval = None
+    if access_log_flush_interval is None or access_log_flush_interval <= 0:
+        raise Error(
+            "'Akara' configuration 'AccessLogFlushInterval' must be a number "
+            "greater than 0, not %r" % (get("AccessLogFlushInterval"),))
+    settings["access_log_flush_interval"] = access_log_flush_interval
+
+    structured_access_log = getstring("StructuredAccessLog")
+    if structured_access_log:
+        settings["structured_access_log"] = os.path.join(server_root,
+                                                         structured_access_log)
+    else:
+        settings["structured_access_log"] = None
 
     module_dir = getstring("ModuleDir")
     settings["module_dir"] = os.path.join(server_root, module_dir)
@@ -218,5 +268,137 @@ def _extract_settings(config):
         raise Error("MaxSpareServers (%r) must be greater than MinSpareServers (%r)" %
                     (settings["max_spare_servers"], settings["min_spare_servers"]))
     settings["max_requests_per_server"] = getpositive("MaxRequestsPerServer")
+    settings["preload_modules"] = bool(get("PreloadModules"))
+
+    accept_strategy = getstring("AcceptStrategy").lower()
+    if accept_strategy not in ("shared", "lock", "reuseport"):
+        raise Error(
+            "global setting 'AcceptStrategy' is %r but must be one of: "
+            "'shared', 'lock', 'reuseport'" % (accept_strategy,))
+    settings["accept_strategy"] = accept_strategy
+
+    accept_lock_file = getstring("AcceptLockFile")
+    settings["accept_lock_file"] = os.path.join(server_root, accept_lock_file)
+
+    settings["threads_per_server"] = getpositive("ThreadsPerServer")
+    thread_kill_limit = getint("ThreadKillLimit")
+    if thread_kill_limit < 0:
+        raise Error(
+            "'Akara' configuration 'ThreadKillLimit' must not be negative, not %r" %
+            (thread_kill_limit,))
+    settings["thread_kill_limit"] = thread_kill_limit
+
+    worker_type = getstring("WorkerType").lower()
+    if worker_type not in ("sync", "gevent"):
+        raise Error(
+            "global setting 'WorkerType' is %r but must be one of: "
+            "'sync', 'gevent'" % (worker_type,))
+    if worker_type == "gevent":
+        try:
+            import gevent
+        except ImportError:
+            raise Error("global setting 'WorkerType' is 'gevent' "
+                        "but the gevent package is not installed")
+        if accept_strategy == "lock":
+            # Waiting for the lock would stop the event loop
+            raise Error("global setting 'AcceptStrategy' cannot be 'lock' "
+                        "when 'WorkerType' is 'gevent'")
+    settings["worker_type"] = worker_type
+    settings["connections_per_server"] = getpositive("ConnectionsPerServer")
+
+    scoreboard_file = getstring("ScoreboardFile")
+    settings["scoreboard_file"] = os.path.join(server_root, scoreboard_file)
+    status_mount_point = getstring("StatusMountPoint")
+    if "/" in status_mount_point:
+        raise Error("global setting 'StatusMountPoint' may not contain a '/': %r" %
+                    (status_mount_point,))
+    settings["status_mount_point"] = status_mount_point
+
+    scaling_policy = getstring("ScalingPolicy").lower()
+    if scaling_policy not in ("spare", "load"):
+        raise Error(
+            "global setting 'ScalingPolicy' is %r but must be one of: "
+            "'spare', 'load'" % (scaling_policy,))
+    settings["scaling_policy"] = scaling_policy
+    target_utilization = get("TargetUtilization")
+    try:
+        target_utilization = float(target_utilization)
+    except (TypeError, ValueError):
+        target_utilization = None
+    if target_utilization is None or not (0.0 < target_utilization <= 1.0):
+        raise Error(
+            "'Akara' configuration 'TargetUtilization' must be a number "
+            "greater than 0 and at most 1, not %r" % (get("TargetUtilization"),))
+    settings["target_utilization"] = target_utilization
+    settings["max_spawn_rate"] = getpositive("MaxSpawnRate")
+    scale_down_delay = getint("ScaleDownDelay")
+    if scale_down_delay < 0:
+        raise Error(
+            "'Akara' configuration 'ScaleDownDelay' must not be negative, not %r" %
+            (scale_down_delay,))
+    settings["scale_down_delay"] = scale_down_delay
+
+    for key in ("MaxServerRSS", "MaxServerAge"):
+        if getint(key) < 0:
+            raise Error(
+                "'Akara' configuration %r must not be negative, not %r" %
+                (key, getint(key)))
+    # MaxServerRSS is in megabytes
+    settings["max_server_rss"] = getint("MaxServerRSS") * 1024 * 1024
+    settings["max_server_age"] = getint("MaxServerAge")
+
+    write_buffer_size = getint("WriteBufferSize")
+    if write_buffer_size < 0:
+        raise Error(
+            "'Akara' configuration 'WriteBufferSize' must not be negative, not %r" %
+            (write_buffer_size,))
+    settings["write_buffer_size"] = write_buffer_size
+
+    request_parser = getstring("RequestParser").lower()
+    if request_parser not in ("fast", "standard"):
+        raise Error(
+            "global setting 'RequestParser' is %r but must be one of: "
+            "'fast', 'standard'" % (request_parser,))
+    settings["request_parser"] = request_parser
+    # SpooledTemporaryFile never rolls over to disk with max_size=0
+    spool_body_size = getint("SpoolBodySize")
+    if spool_body_size < 1:
+        raise Error(
+            "'Akara' configuration 'SpoolBodySize' must be at least 1, not %r" %
+            (spool_body_size,))
+    settings["spool_body_size"] = spool_body_size
+
+    settings["compression"] = bool(get("Compression"))
+    compress_types = get("CompressTypes")
+    if isinstance(compress_types, basestring):
+        compress_types = [compress_types]
+    settings["compress_types"] = [t.lower() for t in compress_types]
+    settings["compress_min_size"] = getint("CompressMinSize")
+    compress_level = getint("CompressLevel")
+    if not (1 <= compress_level <= 9):
+        raise Error(
+            "'Akara' configuration 'CompressLevel' must be between 1 and 9, not %r" %
+            (compress_level,))
+    settings["compress_level"] = compress_level
+    compress_cache_dir = getstring("CompressCacheDir")
+    if compress_cache_dir:
+        compress_cache_dir = os.path.join(server_root, compress_cache_dir)
+        # A caching service could have the same directory, and the
+        # copies' cleanup would remove its files
+        cache_dir = os.path.normpath(compress_cache_dir)
+        module_cache = os.path.normpath(settings["module_cache"])
+        if (cache_dir == module_cache or
+            cache_dir.startswith(os.path.join(module_cache, "")) or
+            module_cache.startswith(os.path.join(cache_dir, ""))):
+            raise Error(
+                "'Akara' configuration 'CompressCacheDir' (%r) must not overlap "
+                "with 'ModuleCache' (%r)" % (compress_cache_dir, settings["module_cache"]))
+    settings["compress_cache_dir"] = compress_cache_dir
+    compress_cache_max_size = getint("CompressCacheMaxSize")
+    if compress_cache_max_size < 1:
+        raise Error(
+            "'Akara' configuration 'CompressCacheMaxSize' must be at least 1, not %r" %
+            (compress_cache_max_size,))
+    settings["compress_cache_max_size"] = compress_cache_max_size
 
     return settings
@@ -11,10 +11,16 @@ The following are defined if the Akara handler comes from an extension module
 
 These should all be treated as read-only constants.
 
+Each thread (or greenlet, in a "gevent" server) has its own
+'environ', so several requests may be handled at the same time in one
+process. This module is replaced in sys.modules by an object which
+has the same attributes.
+
 """
 import os as _os
+import sys as _sys
+import threading as _threading
 
-environ = None
 akara_config = None
 
 module_name = None
@@ -40,17 +46,51 @@ class _ModuleConfig(_DictMixin):
 #    def remove_option(option):
 #        return akara_config.remove_option(module_name, option)
     
+    # The settings are read from the object which replaces this
+    # module, since that is where akara_config and module_name are set
+    def __init__(self, request):
+        self._request = request
+
     # Implement a dictionary-like interface
     def __getitem__(self, key):
-        return akara_config.get(module_name, key)
+        request = self._request
+        return request.akara_config.get(request.module_name, key)
     def __setitem__(self, key, value):
-        return akara_config.set(module_name, key, value)
+        request = self._request
+        return request.akara_config.set(request.module_name, key, value)
     def __delitem__(self, key):
-        return akara_config.remove_option(module_name, key)
+        request = self._request
+        return request.akara_config.remove_option(request.module_name, key)
     def keys(self):
-        return akara_config.options(module_name)
-
-module_config = _ModuleConfig()
+        request = self._request
+        return request.akara_config.options(request.module_name)
 
 
 # Eventually add cookie support?
+
+
+class _Request(object):
+    __doc__ = __doc__
+
+    akara_config = None
+    module_name = None
+    module_config = None
+
+    def __init__(self):
+        # Holds the per-request values. A "gevent" server replaces
+        # this with greenlet-local storage.
+        self._local = _threading.local()
+
+    def _get_environ(self):
+        return getattr(self._local, "environ", None)
+    def _set_environ(self, environ):
+        self._local.environ = environ
+    environ = property(_get_environ, _set_environ)
+
+# The module's globals are cleared when it is deleted, and the
+# methods above still use them. Keep a reference to it.
+_Request._module = _sys.modules[__name__]
+_request = _Request()
+_request.module_config = module_config = _ModuleConfig(_request)
+_sys.modules[__name__] = _request
+
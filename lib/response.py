@@ -3,13 +3,43 @@
   code - the HTTP response code (default is "200 Ok")
   headers - a list of key/value pairs used for the WSGI start_response
 
+Each thread has its own values, as with akara.request.
+
 """
+import sys as _sys
+import threading as _threading
+
+class _Response(object):
+    __doc__ = __doc__
+
+    def __init__(self):
+        # Holds the per-request values. A "gevent" server replaces
+        # this with greenlet-local storage.
+        self._local = _threading.local()
 
-code = None
-headers = []
+    def _get_code(self):
+        return getattr(self._local, "code", None)
+    def _set_code(self, code):
+        self._local.code = code
+    code = property(_get_code, _set_code)
 
-def add_header(key, value):
-    """Helper function to append (key, value) to the list of response headers"""
-    headers.append( (key, value) )
+    def _get_headers(self):
+        try:
+            return self._local.headers
+        except AttributeError:
+            headers = self._local.headers = []
+            return headers
+    def _set_headers(self, headers):
+        self._local.headers = headers
+    headers = property(_get_headers, _set_headers)
+
+    def add_header(self, key, value):
+        """Helper function to append (key, value) to the list of response headers"""
+        self.headers.append( (key, value) )
 
 # Eventually add cookie support?
+
+# Replace this module with an instance, keeping a
+# reference to the module so its globals aren't cleared.
+_Response._module = _sys.modules[__name__]
+_sys.modules[__name__] = _Response()
@@ -12,8 +12,10 @@ import signal
 import akara
 from akara import read_config
 from akara import logger, logger_config
-from akara.multiprocess_http import AkaraPreforkServer
+from akara.multiprocess_http import AkaraPreforkServer, make_listen_socket
+from akara.multiprocess_http import _preload_modules, _unload_modules
 from akara import global_config
+from akara import scoreboard
 
 
 # Need this in order to install "/" as service.list_services.  I think
@@ -137,15 +139,19 @@ def main(args):
     skip_pid_check = args.skip_pid_check
 
     first_time = True
-    old_server_address = None
+    old_listen_settings = None
     sock = None
+    previous_server = None
+    score = None
     while 1:
         # This is the main loop for the flup server.
 
         # Why is it a loop? A SIGHUP sent to the server
-        # will shut down flup then reread the configuration
-        # file, reload the extension modules, and start
-        # the flup server again.
+        # will stop the flup main loop then reread the
+        # configuration file, reload the extension modules, and
+        # start the flup server again. The new server takes over
+        # the running children and retires them once its own
+        # children are ready, so no requests are refused.
 
         try:
             settings, config = read_config.read_config(config_filename)
@@ -183,8 +189,19 @@ You may want to use 'akara setup' to set up the directory structure.""" % err)
 
         # Configure the access log
         try:
-            logger_config.set_access_logfile(settings["access_log"])
-        except IOError, err:
+            # Debug mode displays the access log lines, which needs
+            # the (slower) logging module
+            if debug:
+                buffer_size = 0
+            else:
+                buffer_size = settings["access_log_buffer_size"]
+            logger_config.set_access_logfile(
+                settings["access_log"], buffer_size,
+                settings["access_log_flush_interval"])
+            logger_config.set_structured_access_logfile(
+                settings["structured_access_log"], buffer_size,
+                settings["access_log_flush_interval"])
+        except EnvironmentError, err:
             logger.fatal("""\
 Could not open the Akara access log:
    %s
@@ -218,40 +235,69 @@ Does that directory exist and is it writeable?""" % err)
         # far as we can go, then tell the parent that we're ready.
         try:
             server_address = settings["server_address"]
-            if server_address != old_server_address:
+            # With "reuseport" each child listens on its own socket. The
+            # master only binds its socket, to reserve the address and
+            # to report any problems now.
+            reuse_port = (settings["accept_strategy"] == "reuseport")
+            listen_settings = (server_address, reuse_port)
+            if listen_settings != old_listen_settings:
                 if sock is not None:
                     sock.close()
-                sock = socket.socket()
-                # XXX Should SO_REUSEADDR be a configuration setting?
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                # Disable Nagle's algorithm, which causes problems with
-                # keep-alive. See:
-                #     http://stackoverflow.com/questions/1781766/
-                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 host, port = settings["server_address"]
                 if host:
                     description = "interface %r port %r" % (host, port)
                 else:
                     description = "port %r" % (port,)
                 try:
-                    sock.bind(settings["server_address"])
+                    sock = make_listen_socket(server_address, reuse_port)
                 except socket.error, error:
                     raise SystemExit("Can not bind to " + description)
                 logger.info("Listening to " + description)
                                       
-                sock.listen(socket.SOMAXCONN)
-                old_server_address = server_address
+                if not reuse_port:
+                    sock.listen(socket.SOMAXCONN)
+                old_listen_settings = listen_settings
 
             # NOTE: StartServers not currently supported and likely won't be.
             # Why? Because the old algorithm would add/cull the server count
             # within a few check intervals (each about 1 second), so it
             # didn't have much long-term effect.
+            # With PreloadModules the children inherit the modules
+            # from here. Otherwise make sure the children don't inherit
+            # modules preloaded before a SIGHUP changed the setting.
+            if settings["preload_modules"]:
+                _preload_modules(config)
+            else:
+                _unload_modules()
+
+            # Room for the children of the previous server, which are
+            # still running while the new children start
+            num_slots = 2 * settings["max_servers"]
+            if (score is None or score.filename != settings["scoreboard_file"] or
+                score.num_slots < num_slots):
+                if score is not None:
+                    score.close(remove = (score.filename != settings["scoreboard_file"]))
+                score = scoreboard.Scoreboard(settings["scoreboard_file"], num_slots)
+
             logger.info("Akara server is running")
             server = AkaraPreforkServer(
                 minSpare = settings["min_spare_servers"],
                 maxSpare = settings["max_spare_servers"],
                 maxChildren = settings["max_servers"],
                 maxRequests = settings["max_requests_per_server"],
+                preloadModules = settings["preload_modules"],
+                acceptStrategy = settings["accept_strategy"],
+                threadsPerServer = settings["threads_per_server"],
+                threadKillLimit = settings["thread_kill_limit"],
+                workerType = settings["worker_type"],
+                connectionsPerServer = settings["connections_per_server"],
+                scoreboard = score,
+                scalingPolicy = settings["scaling_policy"],
+                targetUtilization = settings["target_utilization"],
+                maxSpawnRate = settings["max_spawn_rate"],
+                scaleDownDelay = settings["scale_down_delay"],
+                maxServerRSS = settings["max_server_rss"],
+                maxServerAge = settings["max_server_age"],
                 settings = settings,
                 config = config,
                 )
@@ -275,7 +321,7 @@ Does that directory exist and is it writeable?""" % err)
             logger_config.redirect_stdio()
 
         try:
-            hupReceived = server.run(sock)
+            hupReceived = server.run(sock, previous_server)
         except SystemExit:
             # Propogate the SystemExit through the system.  Remember,
             # this is also the root of the call tree for the child
@@ -290,4 +336,6 @@ Does that directory exist and is it writeable?""" % err)
             break
         logger.info("Akara server is restarting.")
         first_time = False
+        previous_server = server
+    score.close()
     remove_pid(pid_file)
@@ -0,0 +1,267 @@
+"""Shared-memory status of the Akara server processes
+
+This is an internal module and should not be called from other libraries.
+
+The master process creates a scoreboard file ("ScoreboardFile") with
+one fixed-size slot for each possible server process, and maps it
+into memory. The servers inherit the mapping. Each server writes its
+own state into its slot:
+
+  pid - the process id of the server
+  state - "starting", "idle" or "busy"
+  requests - the number of requests handled so far
+  active - the number of requests being handled now
+  started - when the server started (as a time.time() value)
+  request_start - when the most recent request started
+  busy_time - total seconds spent handling requests
+  rss - the resident set size of the server, in bytes
+  mount_point - the mount point of the most recent request
+
+Any other process, like "akara status --workers", can read the file
+to see what the servers are doing. The values are written without
+locking so a reader may see a partly updated slot.
+
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+from akara import logger
+
+MAGIC = "AKSCORE1"
+HEADER_FORMAT = "=8sI" # magic, number of slots
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# pid, state, requests, active, started, request_start, busy_time,
+# rss, mount_point
+SLOT_FORMAT = "=icIIdddQ64s"
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+
+STARTING = "S"
+IDLE = "_"
+BUSY = "W"
+
+STATE_NAMES = {
+    STARTING: "starting",
+    IDLE: "idle",
+    BUSY: "busy",
+    }
+
+class Scoreboard(object):
+    "The master's view of the scoreboard file"
+    def __init__(self, filename, num_slots):
+        self.filename = filename
+        self.num_slots = num_slots
+        size = HEADER_SIZE + SLOT_SIZE * num_slots
+        # Children of a previous scoreboard may still be using the old
+        # file. Truncating it would crash them (SIGBUS), so make a new
+        # file and rename it into place.
+        tmp_filename = "%s.%d" % (filename, os.getpid())
+        f = open(tmp_filename, "w+b")
+        try:
+            f.write(struct.pack(HEADER_FORMAT, MAGIC, num_slots))
+            f.write("\0" * (size - HEADER_SIZE))
+            f.flush()
+            self._map = mmap.mmap(f.fileno(), size)
+        finally:
+            f.close()
+        os.rename(tmp_filename, filename)
+
+        # busy_time of the servers which have exited
+        self._exited_busy_time = 0.0
+
+    def clear(self, slot):
+        "Forget about the server which used the slot"
+        offset = HEADER_SIZE + SLOT_SIZE * slot
+        self._exited_busy_time += struct.unpack_from(
+            SLOT_FORMAT, self._map, offset)[6]
+        self._map[offset:offset+SLOT_SIZE] = "\0" * SLOT_SIZE
+
+    def total_busy_time(self, now):
+        """Total seconds all servers have spent handling requests
+
+        This includes the requests in progress. The difference
+        between two calls, divided by the time between them, is the
+        average number of busy servers in that time.
+        """
+        total = self._exited_busy_time
+        for slot in range(self.num_slots):
+            (pid, state, requests, active, started, request_start,
+             busy_time) = struct.unpack_from(
+                SLOT_FORMAT, self._map, HEADER_SIZE + SLOT_SIZE * slot)[:7]
+            if pid == 0:
+                continue
+            total += busy_time
+            if active:
+                total += active * max(0.0, now - request_start)
+        return total
+
+    def close(self, remove=True):
+        self._map.close()
+        if not remove:
+            return
+        try:
+            os.remove(self.filename)
+        except OSError, err:
+            logger.error("Unable to remove scoreboard file %r: %s",
+                         self.filename, err)
+
+
+######## Used by the server processes
+
+# The current process's slot. Only set in a server process.
+_slot = None
+
+class _Slot(object):
+    def __init__(self, scoreboard, slot):
+        self._map = scoreboard._map
+        self._offset = HEADER_SIZE + SLOT_SIZE * slot
+        # Threads in the same server update the same slot
+        self._lock = threading.Lock()
+        self.pid = os.getpid()
+        self.state = STARTING
+        self.requests = 0
+        self.active = 0
+        self.started = time.time()
+        self.request_start = 0.0
+        self.busy_time = 0.0
+        self.rss = get_rss()
+        self.mount_point = ""
+        self.write()
+
+    def write(self):
+        struct.pack_into(SLOT_FORMAT, self._map, self._offset,
+                         self.pid, self.state, self.requests, self.active,
+                         self.started, self.request_start, self.busy_time,
+                         self.rss,
+                         self.mount_point[:64])
+
+def attach(scoreboard, slot):
+    "Called by a new server process to start reporting to the given slot"
+    global _slot
+    _slot = _Slot(scoreboard, slot)
+
+def server_ready():
+    "The server has finished loading the extension modules"
+    if _slot is None:
+        return
+    with _slot._lock:
+        _slot.state = IDLE
+        _slot.write()
+
+def request_started(mount_point):
+    "Record the start of a request. Returns the start time for request_finished()"
+    now = time.time()
+    if _slot is None:
+        return now
+    with _slot._lock:
+        _slot.state = BUSY
+        _slot.active += 1
+        _slot.request_start = now
+        _slot.mount_point = mount_point
+        _slot.write()
+    return now
+
+def request_finished(request_start):
+    if _slot is None:
+        return
+    rss = get_rss()
+    with _slot._lock:
+        _slot.requests += 1
+        _slot.busy_time += time.time() - request_start
+        _slot.active -= 1
+        if _slot.active == 0:
+            _slot.state = IDLE
+        _slot.rss = rss
+        _slot.write()
+
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def get_rss():
+    "Return the resident set size of this process, in bytes"
+    try:
+        f = open("/proc/self/statm")
+    except IOError:
+        # Not Linux. Use the maximum RSS instead, which is in
+        # kilobytes on most systems (but bytes on Mac OS X).
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        return int(f.read().split()[1]) * _page_size
+    finally:
+        f.close()
+
+
+######## Used to report on the servers
+
+def read_scoreboard(filename):
+    """Return a list of dictionaries, one for each slot in use
+
+    Raises IOError if the file cannot be read and ValueError if it
+    is not a scoreboard file.
+    """
+    f = open(filename, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if len(data) < HEADER_SIZE:
+        raise ValueError("Not an Akara scoreboard file: %r" % (filename,))
+    magic, num_slots = struct.unpack_from(HEADER_FORMAT, data)
+    if magic != MAGIC or len(data) < HEADER_SIZE + SLOT_SIZE * num_slots:
+        raise ValueError("Not an Akara scoreboard file: %r" % (filename,))
+
+    workers = []
+    for slot in range(num_slots):
+        (pid, state, requests, active, started, request_start,
+         busy_time, rss, mount_point) = struct.unpack_from(
+            SLOT_FORMAT, data, HEADER_SIZE + SLOT_SIZE * slot)
+        if pid == 0:
+            continue
+        workers.append(dict(slot = slot,
+                            pid = pid,
+                            state = STATE_NAMES.get(state, "unknown"),
+                            requests = requests,
+                            active = active,
+                            started = started,
+                            request_start = request_start,
+                            busy_time = busy_time,
+                            rss = rss,
+                            mount_point = mount_point.rstrip("\0")))
+    return workers
+
+
+######## The optional status service ("StatusMountPoint")
+
+STATUS_SERVICE_ID = "http://purl.org/xml3k/akara/services/status"
+
+def _is_local_address(addr):
+    return addr == "::1" or addr.startswith("127.") or addr.startswith("::ffff:127.")
+
+def register_status_service(path, filename):
+    "Register a service at 'path' which reports the servers in the scoreboard"
+    from amara import tree
+    from akara import request, response
+    from akara.services import simple_service
+
+    @simple_service("GET", STATUS_SERVICE_ID, path)
+    def akara_status():
+        """Status of the Akara server processes (only for local clients)"""
+        if not _is_local_address(request.environ.get("REMOTE_ADDR", "")):
+            response.code = 403
+            return "Status is only available from the local host\n"
+        now = time.time()
+        document = tree.entity()
+        workers = document.xml_append(tree.element(None, "workers"))
+        for info in read_scoreboard(filename):
+            worker = workers.xml_append(tree.element(None, "worker"))
+            for name in ("pid", "state", "requests", "active", "rss", "mount_point"):
+                worker.xml_attributes[unicode(name)] = unicode(info[name])
+            worker.xml_attributes[u"age"] = u"%.1f" % (now - info["started"])
+            if info["active"]:
+                worker.xml_attributes[u"request_time"] = (
+                    u"%.3f" % (now - info["request_start"]))
+        return document
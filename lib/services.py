@@ -6,11 +6,17 @@ module.
 """
 
 import httplib
+import os
+import stat
+import tempfile
 import warnings
 import functools
 import cgi
 import inspect
+import hashlib
 from cStringIO import StringIO
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from wsgiref.util import FileWrapper
 from xml.sax.saxutils import escape as xml_escape
 
 from BaseHTTPServer import BaseHTTPRequestHandler
@@ -19,7 +25,7 @@ del BaseHTTPRequestHandler
 
 from amara import tree, writers
 
-from akara import logger, registry
+from akara import logger, registry, global_config
 
 __all__ = ("service", "simple_service", "method_dispatcher")
 
@@ -64,8 +70,26 @@ class _HTTP405(_HTTPError):
         self.headers.append( ("Allow", ", ".join(methods)) )
 
 
+# Request bodies larger than this are spooled to a temporary file
+# when the service uses stream_body=True. The "SpoolBodySize" setting
+# in akara.conf overrides it.
+SPOOL_BODY_SIZE = 1024*1024
+
+def _spool_body(wsgi_input, request_length):
+    "Copy the request body into a file-like object, on disk if it's large"
+    max_size = getattr(global_config, "spool_body_size", SPOOL_BODY_SIZE)
+    f = tempfile.SpooledTemporaryFile(max_size=max_size, prefix="akara_body_")
+    while request_length > 0:
+        block = wsgi_input.read(min(request_length, 65536))
+        if not block:
+            break
+        f.write(block)
+        request_length -= len(block)
+    f.seek(0)
+    return f
+
 # Pull out any query arguments and set up input from any POST request
-def _get_function_args(environ, allow_repeated_args):
+def _get_function_args(environ, allow_repeated_args, stream_body=False):
     request_method = environ.get("REQUEST_METHOD")
     if request_method == "POST":
         try:
@@ -74,9 +98,12 @@ def _get_function_args(environ, allow_repeated_args):
             raise _HTTPError(httplib.LENGTH_REQUIRED)
         if request_length < 0:
             raise _HTTPError(httplib.BAD_REQUEST)
-        request_bytes = environ["wsgi.input"].read(request_length)
+        if stream_body:
+            request_body = _spool_body(environ["wsgi.input"], request_length)
+        else:
+            request_body = environ["wsgi.input"].read(request_length)
         request_content_type = environ.get("CONTENT_TYPE", None)
-        args = (request_bytes, request_content_type)
+        args = (request_body, request_content_type)
     else:
         args = ()
 
@@ -154,11 +181,184 @@ def convert_body(body, content_type, encoding, writer):
             content_type = "text/plain; charset=%s" % (encoding,)
         return [body], content_type, len(body)
 
+    if isinstance(body, file):
+        # A real file, like a caching.CacheFile. Send the rest of it
+        # through the server's wsgi.file_wrapper, which can use
+        # sendfile() instead of reading it into memory.
+        if content_type is None:
+            content_type = "text/plain"
+        return _wrap_file(body), content_type, _remaining_length(body)
+
     # Probably one of the normal WSGI responses
     if content_type is None:
         content_type = "text/plain"
     return body, content_type, None
 
+def _wrap_file(f, block_size=65536):
+    from akara import request
+    try:
+        file_wrapper = request.environ.get("wsgi.file_wrapper", FileWrapper)
+    except AttributeError:
+        # Not in a request
+        file_wrapper = FileWrapper
+    return file_wrapper(f, block_size)
+
+def _remaining_length(f):
+    "The number of bytes left to read in a regular file, or None"
+    try:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return max(0, st.st_size - f.tell())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+###### Conditional GET and HEAD (the 'etag', 'validator' and 'head' options)
+
+# The dispatcher sends a HEAD request through as a GET, and sets this
+# key in the environ. The response body is discarded.
+HEAD_REQUEST = "akara.head_request"
+
+def _response_header(name):
+    "The value of the named header in akara.response.headers, or None"
+    from akara import response
+    name = name.lower()
+    for k, v in response.headers:
+        if k.lower() == name:
+            return v
+    return None
+
+def _make_etag(body):
+    "A strong ETag for the list of byte strings"
+    h = hashlib.sha1()
+    for block in body:
+        h.update(block)
+    return '"%s"' % (h.hexdigest(),)
+
+def _parse_http_date(s):
+    "Seconds since the epoch for an HTTP date, or None if it can't be parsed"
+    try:
+        t = parsedate_tz(s)
+        if t is None:
+            return None
+        return mktime_tz(t)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def _add_validators(value):
+    """Add the ETag and Last-Modified from a validator to akara.response.headers
+
+    The value is an ETag string, a Last-Modified time in seconds
+    since the epoch, or an (etag, last_modified) tuple where either
+    may be None. Headers the service already set are kept.
+    """
+    from akara import response
+    if isinstance(value, tuple):
+        etag, last_modified = value
+    elif isinstance(value, basestring):
+        etag, last_modified = value, None
+    else:
+        etag, last_modified = None, value
+    if etag is not None and _response_header("ETag") is None:
+        etag = str(etag)
+        if not etag.endswith('"'):
+            etag = '"%s"' % (etag,)
+        response.headers.append( ("ETag", etag) )
+    if last_modified is not None and _response_header("Last-Modified") is None:
+        response.headers.append(
+            ("Last-Modified", formatdate(last_modified, usegmt=True)) )
+
+def _etag_matches(if_none_match, etag):
+    # GET uses the weak comparison, so W/"x" matches "x"
+    if if_none_match.strip() == "*":
+        return True
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+def _is_not_modified(environ):
+    """Does the client already have the response?
+
+    Compares the request's If-None-Match and If-Modified-Since with
+    the ETag and Last-Modified in akara.response.headers.
+    """
+    from akara import response
+    if not str(response.code).startswith("200"):
+        return False
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when there is an If-None-Match
+        etag = _response_header("ETag")
+        return etag is not None and _etag_matches(if_none_match, etag)
+    if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+    last_modified = _response_header("Last-Modified")
+    if if_modified_since and last_modified:
+        since = _parse_http_date(if_modified_since)
+        modified = _parse_http_date(last_modified)
+        return since is not None and modified is not None and modified <= since
+    return False
+
+def _send_not_modified(start_response):
+    "Send a 304 response using akara.response.headers, less the entity headers"
+    from akara import response
+    headers = [(k, v) for (k, v) in response.headers
+                   if k.lower() not in ("content-type", "content-length")]
+    start_response("304 Not Modified", headers)
+    return []
+
+def _call_simple(func, args, kwargs, environ, start_response,
+                 content_type, encoding, writer, etag, validator, head):
+    """Call a simple_service or simple_method function and send its headers
+
+    Returns (result, no_body). With 'validator', the function is
+    not called if the client's copy is current. With 'etag', the ETag
+    is a hash of the serialized response. With 'head', a HEAD request
+    calls it instead of the function. A 304 or a response from 'head'
+    has an empty result and no_body is True.
+    """
+    if validator is not None:
+        _add_validators(validator(*args, **kwargs))
+        if _is_not_modified(environ):
+            return _send_not_modified(start_response), True
+
+    if head is not None and environ.get(HEAD_REQUEST):
+        # _check_head_content_type() makes sure there is a
+        # content_type, which convert_body() also uses as-is
+        clength = head(*args, **kwargs)
+        send_headers(start_response, content_type, clength)
+        return [], True
+
+    result = func(*args, **kwargs)
+    result, ctype, clength = convert_body(result, content_type, encoding, writer)
+
+    if etag and isinstance(result, list) and _response_header("ETag") is None:
+        from akara import response
+        response.headers.append( ("ETag", _make_etag(result)) )
+    if (etag or validator is not None) and _is_not_modified(environ):
+        if hasattr(result, "close"):
+            result.close()
+        return _send_not_modified(start_response), True
+
+    send_headers(start_response, ctype, clength)
+    return result, False
+
+def _check_get_only_options(method, etag, validator, head):
+    if method != "GET" and (etag or validator is not None or head is not None):
+        raise ValueError("'etag', 'validator' and 'head' are only supported for GET")
+
+def _check_head_content_type(content_type, head):
+    # The content type of a GET response can depend on what the
+    # function returns (see convert_body), which a HEAD doesn't call.
+    if head is not None and content_type is None:
+        raise ValueError("'head' needs a 'content_type' so a HEAD has the same Content-Type as a GET")
+
 
 # The HTTP spec says a method can be and 1*CHAR, where CHAR is a
 # US-ASCII character excepting control characters and "punctuation".
@@ -221,7 +421,11 @@ def _handle_notify_before(environ, body, service_list):
         return
     if body is FROM_ENVIRON:
         body = environ["wsgi.input"].read()
-    f = StringIO(body)
+    if hasattr(body, "read"):
+        # Already a file (from stream_body=True)
+        f = body
+    else:
+        f = StringIO(body)
     environ["wsgi.input"] = f
     _handle_notify(environ, f, service_list)
     f.seek(0)
@@ -254,11 +458,19 @@ def service(service_id, path=None,
             query_template = None,
             wsgi_wrapper=None,
             notify_before = None,
-            notify_after = None):
+            notify_after = None,
+            cooperative=False,
+            compress=None,
+            head=None):
     _no_slashes(path)
     def service_wrapper(func):
         @functools.wraps(func)
         def wrapper(environ, start_response):
+            if head is not None and environ.get(HEAD_REQUEST):
+                # A WSGI handler which only sends the headers
+                new_request(environ)
+                head(environ, start_response)
+                return []
             _handle_notify_before(environ, FROM_ENVIRON, notify_before)
             # 'service' passes the WSGI request straight through
             # to the handler so there's almost no point in
@@ -280,6 +492,10 @@ def service(service_id, path=None,
         # If an outer WSGI wrapper was specified, place it around the service wrapper being created
         if wsgi_wrapper:
             wrapper = wsgi_wrapper(wrapper)
+        if cooperative:
+            wrapper.cooperative = True
+        if compress is not None:
+            wrapper.compress = compress
 
         registry.register_service(service_id, pth, wrapper, query_template=query_template)
         return wrapper
@@ -297,7 +513,9 @@ def simple_service(method, service_id, path=None,
                    allow_repeated_args=False,
                    query_template=None,
                    wsgi_wrapper=None,
-                   notify_before=None, notify_after=None):
+                   notify_before=None, notify_after=None,
+                   cooperative=False, stream_body=False,
+                   compress=None, etag=False, validator=None, head=None):
     _no_slashes(path)
     """Add the function as an Akara resource
 
@@ -328,6 +546,56 @@ def simple_service(method, service_id, path=None,
           contains no repeated arguments, as in "?a=x&b=w". If
           allow_repeated_args is True then the function is called as
           as "f(a=['x'], b=['w'])" and if False, like "f(a='x', b='w')".
+
+    This affects how a POST body is passed to the function
+      stream_body - If False (the default), the first parameter is the
+          body as a string. If True, it is a file-like object instead,
+          positioned at the start of the body. Bodies larger than
+          SpoolBodySize bytes (see akara.conf) are kept in a temporary
+          file, so large uploads don't have to fit in memory.
+
+    This affects how a "gevent" server (see WorkerType) runs the function
+      cooperative - If True, call the function in the server's event
+          loop, where it shares the process with many other requests.
+          Use it for functions which mostly wait for other web servers.
+          Their socket I/O, including urllib2 requests, lets the other
+          requests run while waiting. The function must not block in
+          other ways, like with long computations or C libraries doing
+          their own I/O. If False (the default), a thread from a
+          thread pool calls the function, which is always safe.
+          Other servers ignore this setting.
+
+    This affects the gzip/deflate compression of the response, if the
+    server has "Compression" turned on (see akara.conf)
+      compress - If None (the default), compress the response if the
+          client accepts it and the content type is in CompressTypes.
+          If True, compress whatever the content type. If False,
+          never compress.
+
+    These let a GET service answer a conditional request
+    (If-None-Match or If-Modified-Since) with "304 Not Modified"
+      etag - If True, add an ETag which is a hash of the response
+          body, unless the function set its own ETag in
+          akara.response.headers. The function is still called, but
+          the body is not sent when the client already has it. Only
+          used for a body returned as a string, Unicode or Amara tree.
+      validator - A function called with the same parameters as the
+          service function, before it. It returns the ETag for the
+          response (a string), its Last-Modified time (in seconds
+          since the epoch), a tuple (etag, last_modified), or None if
+          it can't tell. If these show that the client's copy is
+          current then the service function is not called at all.
+          Use it when the ETag or modification time is cheap to find,
+          like from a file's mtime or a database version number.
+
+    This lets a GET service answer a HEAD request without making the body
+      head - A function called with the same parameters as the service
+          function, instead of it, for a HEAD request. It returns the
+          Content-Length, or None if it isn't known, and may set other
+          headers through akara.response. It needs 'content_type' to
+          be set, since the Content-Type of a GET can depend on what
+          the service function returns. Without it, a HEAD calls the
+          service function and discards the body.
     
     A simple_service decorated function can get request information from
     akara.request and use akara.response to set the HTTP reponse code
@@ -390,6 +658,8 @@ def simple_service(method, service_id, path=None,
     if method not in ("GET", "POST"):
         raise ValueError(
             "simple_service only supports GET and POST methods, not %s" % (method,))
+    _check_get_only_options(method, etag, validator, head)
+    _check_head_content_type(content_type, head)
 
     def service_wrapper(func):
         @functools.wraps(func)
@@ -400,7 +670,8 @@ def simple_service(method, service_id, path=None,
                         raise _HTTP405(["GET"])
                     else:
                         raise _HTTP405(["POST"])
-                args, kwargs = _get_function_args(environ, allow_repeated_args)
+                args, kwargs = _get_function_args(environ, allow_repeated_args,
+                                                  stream_body)
             except _HTTPError, err:
                 return err.make_wsgi_response(environ, start_response)
             if args:
@@ -410,11 +681,11 @@ def simple_service(method, service_id, path=None,
             _handle_notify_before(environ, body, notify_before)
 
             new_request(environ)
-            result = func(*args, **kwargs)
-
-            result, ctype, clength = convert_body(result, content_type, encoding, writer)
-            send_headers(start_response, ctype, clength)
-            result = _handle_notify_after(environ, result, notify_after)
+            result, no_body = _call_simple(
+                func, args, kwargs, environ, start_response,
+                content_type, encoding, writer, etag, validator, head)
+            if not no_body:
+                result = _handle_notify_after(environ, result, notify_after)
             return result
 
         pth = path
@@ -431,6 +702,10 @@ def simple_service(method, service_id, path=None,
         # If an wsgi_wrapper was given, wrapper the service wrapper with it
         if wsgi_wrapper:
            wrapper = wsgi_wrapper(wrapper)
+        if cooperative:
+            wrapper.cooperative = True
+        if compress is not None:
+            wrapper.compress = compress
 
         registry.register_service(service_id, pth, wrapper, query_template=qt) 
         return wrapper
@@ -462,7 +737,7 @@ class service_method_dispatcher(object):
         self.path = path
         self.method_table = {}
         self.wsgi_wrapper = wsgi_wrapper
-    def add_handler(self, method, handler):
+    def add_handler(self, method, handler, cooperative=False, compress=None):
         if method in self.method_table:
             logger.warn("Replacing %r method handler for %r"  %
                         (method, self.path))
@@ -472,6 +747,10 @@ class service_method_dispatcher(object):
         # If an outer WSGI wrapper was specified, wrap it around the handler method
         if self.wsgi_wrapper:
             handler = self.wsgi_wrapper(handler)
+        if cooperative:
+            handler.cooperative = True
+        if compress is not None:
+            handler.compress = compress
 
         self.method_table[method] = handler
     def __call__(self, environ, start_response):
@@ -479,14 +758,22 @@ class service_method_dispatcher(object):
         handler = self.method_table.get(method, None)
         if handler is not None:
             return handler(environ, start_response)
+        if method == "HEAD":
+            # Akara's own dispatcher already turned a HEAD into a GET,
+            # but another WSGI server may call this directly.
+            return self.head_method(environ, start_response)
         err = _HTTP405(sorted(self.method_table.keys()))
         return err.make_wsgi_response(environ, start_response)
     
     def head_method(self, environ, start_response):
         handler = self.method_table.get("GET",None)
         if handler is not None:
-            handler(environ, start_response)
-            return ['']
+            environ["REQUEST_METHOD"] = "GET"
+            environ[HEAD_REQUEST] = True
+            result = handler(environ, start_response)
+            if hasattr(result, "close"):
+                result.close()
+            return []
         err = _HTTP405(sorted(self.method_table.keys()))
         return err.make_wsgi_response(environ, start_response)
 
@@ -563,7 +850,8 @@ class service_dispatcher_decorator(object):
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
 
-    def method(self, method, encoding="utf-8", writer="xml"):
+    def method(self, method, encoding="utf-8", writer="xml", cooperative=False,
+               compress=None, head=None):
         """Register a function as a resource handler for a given HTTP method
 
           method - the relevant HTTP method
@@ -571,6 +859,13 @@ class service_dispatcher_decorator(object):
               to the bytes used in the HTTP response
           writer - Used to serialize the Amara tree for the HTTP response.
               This must be a name which can be used as an Amara.writer.lookup.
+          cooperative - If True, a "gevent" server calls the function in
+              its event loop (see simple_service)
+          compress - True or False to always or never compress the
+              response; None to decide by content type (see simple_service)
+          head - For a GET method, a WSGI function called instead of
+              the decorated function for a HEAD request. It must call
+              start_response; any body it returns is ignored.
 
         The decorated function must take the normal WSGI parameters
         (environ, start_response) and it must call start_response with
@@ -580,9 +875,14 @@ class service_dispatcher_decorator(object):
         'encoding' options.
         """
         _check_is_valid_method(method)
+        _check_get_only_options(method, False, None, head)
         def service_dispatch_decorator_method_wrapper(func):
             @functools.wraps(func)
             def method_wrapper(environ, start_response):
+                if head is not None and environ.get(HEAD_REQUEST):
+                    new_request(environ)
+                    head(environ, start_response)
+                    return []
                 # 'method' passes the WSGI request straight through
                 # to the handler so there's almost no point in
                 # setting up the environment. However, I can conceive
@@ -595,33 +895,39 @@ class service_dispatcher_decorator(object):
                 result, ctype, clength = convert_body(result, None, encoding, writer)
                 return result
 
-            self.dispatcher.add_handler(method, method_wrapper)
+            self.dispatcher.add_handler(method, method_wrapper, cooperative,
+                                        compress)
             return method_wrapper
         return service_dispatch_decorator_method_wrapper
 
     def simple_method(self, method, content_type=None,
-                      encoding="utf-8", writer="xml", allow_repeated_args=False):
+                      encoding="utf-8", writer="xml", allow_repeated_args=False,
+                      cooperative=False, stream_body=False, compress=None,
+                      etag=False, validator=None, head=None):
         _check_is_valid_method(method)
         if method not in ("GET", "POST"):
             raise ValueError(
                 "simple_method only supports GET and POST methods, not %s" %
                 (method,))
+        _check_get_only_options(method, etag, validator, head)
+        _check_head_content_type(content_type, head)
         
         def service_dispatch_decorator_simple_method_wrapper(func):
             @functools.wraps(func)
             def simple_method_wrapper(environ, start_response):
                 try:
-                    args, kwargs = _get_function_args(environ, allow_repeated_args)
+                    args, kwargs = _get_function_args(environ, allow_repeated_args,
+                                                      stream_body)
                 except _HTTPError, err:
                     return err.make_wsgi_response(environ, start_response)
                 new_request(environ)
-                result = func(*args, **kwargs)
-
-                result, ctype, clength = convert_body(result, content_type, encoding, writer)
-                send_headers(start_response, ctype, clength)
+                result, no_body = _call_simple(
+                    func, args, kwargs, environ, start_response,
+                    content_type, encoding, writer, etag, validator, head)
                 return result
 
-            self.dispatcher.add_handler(method, simple_method_wrapper)
+            self.dispatcher.add_handler(method, simple_method_wrapper, cooperative,
+                                        compress)
             return simple_method_wrapper
         return service_dispatch_decorator_simple_method_wrapper
 
@@ -629,9 +935,33 @@ class service_dispatcher_decorator(object):
     #def xml_method(self, method="POST", content_type="text/xml"):
     # ...
 
+def is_cooperative(handler, environ):
+    """Can a "gevent" server call the WSGI handler in its event loop?
+
+    True if the handler for the request was registered with
+    cooperative=True. A hand-written WSGI handler can set its own
+    'cooperative' attribute.
+    """
+    return getattr(_method_handler(handler, environ), "cooperative", False)
+
+def get_compress(handler, environ):
+    """The 'compress' setting of the handler for the request
+
+    None unless the handler was registered with compress=True or
+    compress=False. A hand-written WSGI handler can set its own
+    'compress' attribute.
+    """
+    return getattr(_method_handler(handler, environ), "compress", None)
+
+def _method_handler(handler, environ):
+    "For a method dispatcher, the handler for the request's method"
+    if isinstance(handler, service_method_dispatcher):
+        handler = handler.method_table.get(environ.get("REQUEST_METHOD"))
+    return handler
+
 # Install some built-in services
 @simple_service("GET", "http://purl.org/xml3k/akara/services/registry", "",
-                allow_repeated_args=False)
+                allow_repeated_args=False, etag=True)
 def list_services(service=None):
     return registry.list_services(ident=service) # XXX 'ident' or 'service' ?
 
@@ -1,3 +1,4 @@
 # 'preforkserver.py' comes from flup
 # 'httpserver.py' comes from paste
 # 'argparse.py' is argparse
+# 'killthread.py' comes from paste
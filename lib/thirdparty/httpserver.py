@@ -14,9 +14,6 @@ if pyOpenSSL is installed, it also provides SSL capabilities.
 # @@: add in protection against HTTP/1.0 clients who claim to
 #     be 1.1 but do not send a Content-Length
 
-# @@: add support for chunked encoding, this is not a 1.1 server
-#     till this is completed.
-
 import atexit
 import traceback
 import socket, sys, threading, urlparse, Queue, urllib
@@ -24,7 +21,11 @@ import posixpath
 import time
 import thread
 import os
+import errno
+import select
+import stat
 from itertools import count
+from wsgiref.util import FileWrapper
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from SocketServer import ThreadingMixIn
 
@@ -34,8 +35,11 @@ import logging
 try:
     from paste.util import killthread
 except ImportError:
-    # Not available, probably no ctypes
-    killthread = None
+    # Use Akara's copy, if ctypes is available
+    try:
+        from akara.thirdparty import killthread
+    except ImportError:
+        killthread = None
 
 __all__ = ['WSGIHandlerMixin', 'WSGIServer', 'WSGIHandler', 'serve']
 __version__ = "0.5"
@@ -99,6 +103,90 @@ class ContinueHook(object):
         self._ContinueFile_send()
         return self._ContinueFile_rfile.readlines(sizehint)
 
+class CoalescingWriter(object):
+    """
+    A write-only file object for a socket which collects small writes
+    and sends them together.
+
+    BaseHTTPRequestHandler writes the status line and each header with
+    its own write() call, and an application which yields many small
+    strings gives one write() for each. With an unbuffered file (and
+    TCP_NODELAY) each of those is a separate system call and packet.
+    This buffers writes until there are at least ``bufsize`` bytes,
+    then sends everything with one ``sendall()``. A large write is
+    sent together with whatever is already in the buffer. Call
+    flush() at the end of each response.
+    """
+
+    def __init__(self, sock, bufsize=8192):
+        self._sock = sock
+        self.bufsize = bufsize
+        self._buf = []
+        self._buflen = 0
+        self.closed = False
+
+    def write(self, data):
+        data = str(data)
+        if not data:
+            return
+        if self._buflen + len(data) < self.bufsize:
+            self._buf.append(data)
+            self._buflen += len(data)
+            return
+        if self._buf:
+            self._buf.append(data)
+            data = "".join(self._buf)
+            self._buf = []
+            self._buflen = 0
+        self._sock.sendall(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self._buf:
+            data = "".join(self._buf)
+            self._buf = []
+            self._buflen = 0
+            self._sock.sendall(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+            finally:
+                self.closed = True
+                self._sock = None
+
+# os.sendfile() only exists in Python 3. On Linux call the C library
+# function through ctypes; elsewhere (and for SSL connections) file
+# responses are sent by reading the file in blocks.
+sendfile = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes, ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendfile = getattr(_libc, 'sendfile64', None) or _libc.sendfile
+        _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        _sendfile.restype = ctypes.c_ssize_t
+    except (ImportError, OSError, AttributeError):
+        pass
+    else:
+        def sendfile(out_fd, in_fd, offset, count):
+            """
+            Send up to ``count`` bytes of the file ``in_fd``, starting
+            at ``offset``, to the socket ``out_fd``. Returns the number
+            of bytes sent; raises OSError on failure.
+            """
+            c_offset = ctypes.c_int64(offset)
+            sent = _sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+            if sent < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return sent
+
 class WSGIHandlerMixin:
     """
     WSGI mix-in for HTTPRequestHandler
@@ -142,29 +230,85 @@ class WSGIHandlerMixin:
                 "Content returned before start_response called")
         if not self.wsgi_headers_sent:
             self.wsgi_headers_sent = True
+            self.wsgi_headers_time = time.time()
             (status, headers) = self.wsgi_curr_headers
             code, message = status.split(" ", 1)
             self.send_response(int(code), message)
             #
-            # HTTP/1.1 compliance; either send Content-Length or
-            # signal that the connection is being closed.
+            # HTTP/1.1 compliance; either send Content-Length, use
+            # the chunked transfer-coding, or signal that the
+            # connection is being closed.
             #
             send_close = True
             for (k, v) in  headers:
                 lk = k.lower()
                 if 'content-length' == lk:
                     send_close = False
+                if 'transfer-encoding' == lk:
+                    # The application did its own framing
+                    send_close = False
                 if 'connection' == lk:
                     if 'close' == v.lower():
                         self.close_connection = 1
                         send_close = False
                 self.send_header(k, v)
-            if send_close:
+            if send_close and self.wsgi_can_chunk(code):
+                self.wsgi_chunked = True
+                self.send_header('Transfer-Encoding', 'chunked')
+            elif send_close:
                 self.close_connection = 1
                 self.send_header('Connection', 'close')
 
             self.end_headers()
-        self.wfile.write(chunk)
+        self.wsgi_bytes_sent += len(chunk)
+        if self.wsgi_chunked:
+            # An empty chunk would end the response
+            if chunk:
+                self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+        else:
+            self.wfile.write(chunk)
+
+    def wsgi_can_chunk(self, code):
+        """
+        Return True if a response without a Content-Length can use
+        the chunked transfer-coding instead of closing the connection.
+        This needs an HTTP/1.1 client and a response which has a body.
+        """
+        return (self.protocol_version >= 'HTTP/1.1' and
+                self.request_version >= 'HTTP/1.1' and
+                self.command != 'HEAD' and
+                not code.startswith('1') and
+                code not in ('204', '304'))
+
+    def wsgi_finish_chunks(self):
+        """ Send the last (empty) chunk of a chunked response """
+        if self.wsgi_chunked:
+            self.wsgi_chunked = False
+            self.wfile.write("0\r\n\r\n")
+
+    def wsgi_body_short(self):
+        """
+        Return True if fewer bytes of the body were sent than the
+        response's Content-Length header gave. HEAD, 204 and 304
+        responses have no body.
+        """
+        if self.command == 'HEAD' or not self.wsgi_curr_headers:
+            return False
+        status, headers = self.wsgi_curr_headers
+        if status[:3] in ('204', '304'):
+            return False
+        for (k, v) in headers:
+            if k.lower() == 'content-length':
+                try:
+                    return self.wsgi_bytes_sent < int(v)
+                except ValueError:
+                    return False
+        return False
+
+    def wsgi_send(self, data):
+        """ Write data to the client now, with anything already buffered """
+        self.wfile.write(data)
+        self.wfile.flush()
 
     def wsgi_start_response(self, status, response_headers, exc_info=None):
         if exc_info:
@@ -205,7 +349,7 @@ class WSGIHandlerMixin:
         rfile = self.rfile
         if 'HTTP/1.1' == self.protocol_version and \
                 '100-continue' == self.headers.get('Expect','').lower():
-            rfile = ContinueHook(rfile, self.wfile.write)
+            rfile = ContinueHook(rfile, self.wsgi_send)
         else:
             # We can put in the protection to keep from over-reading the
             # file
@@ -228,6 +372,7 @@ class WSGIHandlerMixin:
                ,'wsgi.multithread': True
                ,'wsgi.multiprocess': False
                ,'wsgi.run_once': False
+               ,'wsgi.file_wrapper': FileWrapper
                # CGI variables required by PEP-333
                ,'REQUEST_METHOD': self.command
                ,'SCRIPT_NAME': '' # application is root of server
@@ -284,6 +429,10 @@ class WSGIHandlerMixin:
 
         self.wsgi_curr_headers = None
         self.wsgi_headers_sent = False
+        self.wsgi_chunked = False
+        # Body bytes written, and when the headers were ready to send
+        self.wsgi_bytes_sent = 0
+        self.wsgi_headers_time = None
 
     def wsgi_connection_drop(self, exce, environ=None):
         """
@@ -292,6 +441,73 @@ class WSGIHandlerMixin:
         """
         pass
 
+    def wsgi_sendfile(self, result):
+        """
+        If ``result`` is a ``wsgi.file_wrapper`` for a regular file,
+        send the rest of the file with sendfile() and return True.
+        Adds a Content-Length header if the application did not.
+        Otherwise return False, and the file is read like any other
+        iterable. That includes a Content-Length larger than the rest
+        of the file.
+        """
+        if (sendfile is None or not isinstance(result, FileWrapper) or
+            self.wsgi_headers_sent or hasattr(self.connection, 'get_context')):
+            return False
+        filelike = result.filelike
+        try:
+            in_fd = filelike.fileno()
+            st = os.fstat(in_fd)
+            offset = filelike.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        if not self.wsgi_curr_headers:
+            raise RuntimeError(
+                "Content returned before start_response called")
+
+        count = max(0, st.st_size - offset)
+        status, headers = self.wsgi_curr_headers
+        for (k, v) in headers:
+            if k.lower() == 'content-length':
+                try:
+                    length = int(v)
+                except ValueError:
+                    return False
+                if length > count:
+                    return False
+                count = length
+                break
+        else:
+            headers = list(headers)
+            headers.append(('Content-Length', str(count)))
+            self.wsgi_curr_headers = (status, headers)
+        # Send the headers (and anything buffered) first
+        self.wsgi_write_chunk('')
+        self.wfile.flush()
+
+        out_fd = self.connection.fileno()
+        while count > 0:
+            try:
+                sent = sendfile(out_fd, in_fd, offset, min(count, 0x40000000))
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno == errno.EAGAIN:
+                    # A non-blocking socket (as with gevent) is full
+                    select.select([], [out_fd], [])
+                    continue
+                raise socket.error(err.errno, err.strerror)
+            if sent == 0:
+                # The file got shorter. The client can't tell where
+                # the response ends.
+                self.close_connection = 1
+                break
+            offset += sent
+            count -= sent
+            self.wsgi_bytes_sent += sent
+        return True
+
     def wsgi_execute(self, environ=None):
         """
         Invoke the server's ``wsgi_application``.
@@ -303,18 +519,28 @@ class WSGIHandlerMixin:
             result = self.server.wsgi_application(self.wsgi_environ,
                                                   self.wsgi_start_response)
             try:
-                for chunk in result:
-                    self.wsgi_write_chunk(chunk)
+                if not self.wsgi_sendfile(result):
+                    for chunk in result:
+                        self.wsgi_write_chunk(chunk)
                 if not self.wsgi_headers_sent:
                     self.wsgi_write_chunk('')
+                self.wsgi_finish_chunks()
+                if self.wsgi_body_short():
+                    # The client would wait for the rest
+                    self.close_connection = 1
             finally:
                 if hasattr(result,'close'):
                     result.close()
                 result = None
         except socket.error, exce:
+            self.close_connection = 1
             self.wsgi_connection_drop(exce, environ)
             return
         except:
+            if self.wsgi_chunked:
+                # Leave out the last chunk so the client can tell
+                # the response is incomplete
+                self.close_connection = 1
             if not self.wsgi_headers_sent:
                 error_msg = "Internal Server Error\n"
                 self.wsgi_curr_headers = (
@@ -452,6 +678,18 @@ class WSGIHandler(WSGIHandlerMixin, BaseHTTPRequestHandler):
     """
     server_version = 'PasteWSGIServer/' + __version__
 
+    # Coalesce writes smaller than this many bytes (see CoalescingWriter).
+    # The server can override this with a ``write_buffer_size``
+    # attribute. Use 0 to write each piece as soon as it is produced.
+    write_buffer_size = 8192
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        bufsize = getattr(self.server, 'write_buffer_size',
+                          self.write_buffer_size)
+        if bufsize > 0:
+            self.wfile = CoalescingWriter(self.connection, bufsize)
+
     def handle_one_request(self):
         """Handle a single HTTP request.
 
@@ -464,9 +702,13 @@ class WSGIHandler(WSGIHandlerMixin, BaseHTTPRequestHandler):
         if not self.raw_requestline:
             self.close_connection = 1
             return
-        if not self.parse_request(): # An error code has been sent, just exit
-            return
-        self.wsgi_execute()
+        try:
+            if not self.parse_request(): # An error code has been sent, just exit
+                return
+            self.wsgi_execute()
+        finally:
+            # Send the rest of the response before reading the next request
+            self.wfile.flush()
 
     def handle(self):
         # don't bother logging disconnects while handling a request
@@ -39,6 +39,7 @@ import time
 try:
     import fcntl
 except ImportError:
+    fcntl = None
     def setCloseOnExec(sock):
         pass
 else:
@@ -64,6 +65,124 @@ if not hasattr(socket, 'socketpair'):
 
     socket.socketpair = socketpair
 
+# The parent waits for status bytes from all of its children. select()
+# needs the full list of sockets on every call, which gets expensive
+# as the number of children grows. Use epoll where it's available.
+class _SelectPoller(object):
+    """Wait for readable file descriptors using select()."""
+    def __init__(self):
+        self._fds = set()
+
+    def register(self, fd):
+        self._fds.add(fd)
+
+    def unregister(self, fd):
+        self._fds.discard(fd)
+
+    def poll(self, timeout=None):
+        """Return a list of the readable file descriptors."""
+        try:
+            r, w, e = select.select(list(self._fds), [], [], timeout)
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            return []
+        return r
+
+    def close(self):
+        self._fds.clear()
+
+class _EpollPoller(object):
+    """Wait for readable file descriptors using epoll (Linux only)."""
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def register(self, fd):
+        self._epoll.register(fd, select.EPOLLIN)
+
+    def unregister(self, fd):
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass
+
+    def poll(self, timeout=None):
+        """Return a list of the readable file descriptors."""
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError, e:
+            if e[0] != errno.EINTR:
+                raise
+            return []
+        # EPOLLHUP and EPOLLERR are reported even if not requested.
+        # The following recv() returns '' for those.
+        return [fd for fd, event in events]
+
+    def close(self):
+        self._epoll.close()
+
+if hasattr(select, 'epoll'):
+    Poller = _EpollPoller
+else:
+    Poller = _SelectPoller
+
+# A signal handler which only interrupts the system call in progress
+def _ignoreSignal(signum, frame):
+    pass
+
+# All of the idle children wait on the same listening socket. When a
+# connection arrives they all wake up and race to accept() it, and all
+# but one get EAGAIN. An accept lock makes sure that only one child at
+# a time waits on the socket, just like Apache's AcceptMutex.
+class FcntlAcceptLock(object):
+    """Cross-process accept lock based on fcntl.lockf() of a lock file."""
+    def __init__(self, filename):
+        if fcntl is None:
+            raise ValueError("fcntl locking is not supported on this platform")
+        self.filename = filename
+        # POSIX record locks are owned by the process, not the file
+        # descriptor, so the children can share this one.
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.fcntl(self._fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    def acquire(self, timeout=None):
+        """
+        Waits for the lock. With a timeout (in seconds), returns False
+        if the lock wasn't acquired in about that time or the wait was
+        interrupted by a signal, else True. The timeout uses SIGALRM,
+        so this must be called from the main thread.
+        """
+        if timeout is None:
+            while True:
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX)
+                    return True
+                except IOError, e:
+                    if e[0] != errno.EINTR:
+                        raise
+        # The timer repeats, in case it fires just before lockf() waits
+        oldSIGALRM = signal.signal(signal.SIGALRM, _ignoreSignal)
+        signal.setitimer(signal.ITIMER_REAL, timeout, timeout)
+        try:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX)
+                return True
+            except IOError, e:
+                if e[0] != errno.EINTR:
+                    raise
+                return False
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, oldSIGALRM)
+
+    def release(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        os.close(self._fd)
+
 class PreforkServer(object):
     """
     A preforked server model conceptually similar to Apache httpd(2). At
@@ -83,22 +202,70 @@ class PreforkServer(object):
     jobClass should have a run() method (taking no arguments) that does
     the actual work. When run() returns, the request is considered
     complete and the child process moves to idle state.
+
+    If acceptLock is not None, it must have acquire() and release()
+    methods which work across processes (see FcntlAcceptLock). A child
+    only waits on the listening socket while it holds the lock. The
+    acquire() method must take a timeout and return False when it
+    runs out, so a waiting child sees when its parent wants it to exit.
+
+    If gracefulRestart is True, the children are left running when
+    run() returns because of SIGHUP. Pass the server to the next
+    server's run() as 'previous'. The old children keep handling
+    requests until the new children are ready (each has sent its first
+    status byte) or retireTimeout seconds have passed. Then they are
+    told to finish their current request and exit.
     """
     def __init__(self, minSpare=1, maxSpare=5, maxChildren=50,
-                 maxRequests=0, jobClass=None, jobArgs=()):
+                 maxRequests=0, jobClass=None, jobArgs=(), acceptLock=None,
+                 gracefulRestart=False, retireTimeout=60):
         self._minSpare = minSpare
         self._maxSpare = maxSpare
         self._maxChildren = max(maxSpare, maxChildren)
         self._maxRequests = maxRequests
         self._jobClass = jobClass
         self._jobArgs = jobArgs
+        self._acceptLock = acceptLock
+        # The parent sends _acceptLockSignal to a child when it closes
+        # the child's socket, since a child waiting for the accept lock
+        # can't see the socket. Its default action is to do nothing,
+        # and a child only handles it while waiting for the lock. The
+        # signal may come just before lockf() waits, so the child also
+        # checks every _acceptLockTimeout seconds. This is kept
+        # long, because a waiting child which is interrupted wakes the
+        # ones queued behind it.
+        self._acceptLockSignal = signal.SIGWINCH
+        self._acceptLockTimeout = 5.0
+        self._gracefulRestart = gracefulRestart
+        self._retireTimeout = retireTimeout
 
         # Internal state of children. Maps pids to dictionaries with two
         # members: 'file' and 'avail'. 'file' is the socket to that
         # individidual child and 'avail' is whether or not the child is
-        # free to process requests.
+        # free to process requests. 'ready' is set once the child has
+        # sent a status byte.
         self._children = {}
 
+        # Reverse map from the file descriptor of a child's socket to
+        # its pid, and the set of pids for the available children.
+        # These are kept in sync with self._children by _setAvail()
+        # and _closeChild() so the main loop doesn't need to search.
+        self._fdToPid = {}
+        self._availPids = set()
+        self._poller = None
+
+        # Children of the previous server (after a graceful restart)
+        # which haven't exited yet. They are in self._children but
+        # are never available and don't count towards the limits.
+        # They are told to exit when the new children are ready or
+        # at _retireDeadline, after which it is None.
+        self._retiring = set()
+        self._retireDeadline = None
+
+        # Wake up the main loop at least this often (in seconds), if
+        # not None, for policies which need to check on the load.
+        self._tick = None
+
         self._children_to_purge = []
         self._last_purge = 0
 
@@ -107,11 +274,15 @@ class PreforkServer(object):
         if maxSpare < minSpare:
             raise ValueError("maxSpare must be greater than, or equal to, minSpare!")
 
-    def run(self, sock):
+    def run(self, sock, previous=None):
         """
         The main loop. Pass a socket that is ready to accept() client
         connections. Return value will be True or False indiciating whether
         or not the loop was exited due to SIGHUP.
+
+        previous is the server whose run() returned because of a SIGHUP,
+        if it was created with gracefulRestart. This server takes over
+        its children and retires them.
         """
         # Set up signal handlers.
         self._keepGoing = True
@@ -123,7 +294,11 @@ class PreforkServer(object):
 
         # Set close-on-exec
         setCloseOnExec(sock)
-        
+
+        self._poller = Poller()
+        if previous is not None:
+            self._adoptChildren(previous)
+
         # Main loop.
         while self._keepGoing:
             # Maintain minimum number of children. Note that we are checking
@@ -131,94 +306,64 @@ class PreforkServer(object):
             # children. We explicitly test against _maxSpare to maintain
             # an *optimistic* absolute minimum. The number of children will
             # always be in the range [_maxSpare, _maxChildren].
-            while len(self._children) < self._maxSpare:
+            while self._numChildren() < self._maxSpare:
                 if not self._spawnChild(sock): break
 
-            # Wait on any socket activity from live children.
-            r = [x['file'] for x in self._children.values()
-                 if x['file'] is not None]
-
-            if len(r) == len(self._children) and not self._children_to_purge:
+            if len(self._fdToPid) == len(self._children) and \
+                   not self._children_to_purge and self._retireDeadline is None:
                 timeout = None
             else:
                 # There are dead children that need to be reaped, ensure
                 # that they are by timing out, if necessary. Or there are some
                 # children that need to die.
                 timeout = 2
-
-            w = []
-            if (time.time() > self._last_purge + 10):
-                w = [x for x in self._children_to_purge if x.fileno() != -1]
-            try:
-                r, w, e = select.select(r, w, [], timeout)
-            except select.error, e:
-                if e[0] != errno.EINTR:
-                    raise
-
-            # Scan child sockets and tend to those that need attention.
-            for child in r:
+            if self._tick is not None and (timeout is None or self._tick < timeout):
+                timeout = self._tick
+
+            if self._children_to_purge and time.time() > self._last_purge + 10:
+                self._purgeChild()
+
+            # Wait on any socket activity from live children, then
+            # tend to those that need attention.
+            for fd in self._poller.poll(timeout):
+                pid = self._fdToPid.get(fd)
+                if pid is None:
+                    # Already closed
+                    continue
                 # Receive status byte.
                 try:
-                    state = child.recv(1)
+                    state = self._children[pid]['file'].recv(1)
                 except socket.error, e:
                     if e[0] in (errno.EAGAIN, errno.EINTR):
                         # Guess it really didn't need attention?
                         continue
                     raise
-                # Try to match it with a child. (Do we need a reverse map?)
-                for pid,d in self._children.items():
-                    if child is d['file']:
-                        if state:
-                            # Set availability status accordingly.
-                            self._children[pid]['avail'] = state != '\x00'
-                        else:
-                            # Didn't receive anything. Child is most likely
-                            # dead.
-                            d = self._children[pid]
-                            d['file'].close()
-                            d['file'] = None
-                            d['avail'] = False
-
-            for child in w:
-                # purging child
-                child.send('bye, bye')
-                del self._children_to_purge[self._children_to_purge.index(child)]
-                self._last_purge = time.time()
-
-                # Try to match it with a child. (Do we need a reverse map?)
-                for pid,d in self._children.items():
-                    if child is d['file']:
-                        d['file'].close()
-                        d['file'] = None
-                        d['avail'] = False
-                break
+                if state:
+                    # Set availability status accordingly.
+                    self._children[pid]['ready'] = True
+                    self._setAvail(pid, state != '\x00')
+                else:
+                    # Didn't receive anything. Child is most likely
+                    # dead.
+                    self._closeChild(pid)
 
             # Reap children.
             self._reapChildren()
 
-            # See who and how many children are available.
-            availList = filter(lambda x: x[1]['avail'], self._children.items())
-            avail = len(availList)
-
-            if avail < self._minSpare:
-                # Need to spawn more children.
-                while avail < self._minSpare and \
-                      len(self._children) < self._maxChildren:
-                    if not self._spawnChild(sock): break
-                    avail += 1
-            elif avail > self._maxSpare:
-                # Too many spares, kill off the extras.
-                pids = [x[0] for x in availList]
-                pids.sort()
-                pids = pids[self._maxSpare:]
-                for pid in pids:
-                    d = self._children[pid]
-                    d['file'].close()
-                    d['file'] = None
-                    d['avail'] = False
-
-        # Clean up all child processes.
-        self._cleanupChildren()
+            # Once the new children are ready, the old ones can go.
+            if self._retireDeadline is not None and \
+                   (self._childrenReady() or time.time() > self._retireDeadline):
+                self._retireChildren()
+
+            self._balanceChildren(sock)
+
+        # Clean up all child processes, unless the next server
+        # takes them over.
+        if not (self._hupReceived and self._gracefulRestart):
+            self._cleanupChildren()
+
+        self._poller.close()
+        self._poller = None
 
         # Restore signal handlers.
         self._restoreSignalHandlers()
@@ -226,6 +371,113 @@ class PreforkServer(object):
         # Return bool based on whether or not SIGHUP was received.
         return self._hupReceived
 
+    def _balanceChildren(self, sock):
+        """
+        Spawns or stops children depending on the load. This is called
+        after every change in the status of the children, and every
+        self._tick seconds if that is not None. By default the goal is
+        to have between minSpare and maxSpare available children.
+        """
+        # See how many children are available.
+        avail = len(self._availPids)
+
+        if avail < self._minSpare:
+            # Need to spawn more children.
+            while avail < self._minSpare and \
+                  self._numChildren() < self._maxChildren:
+                if not self._spawnChild(sock): break
+                avail += 1
+        elif avail > self._maxSpare:
+            # Too many spares, kill off the extras.
+            pids = sorted(self._availPids)
+            pids = pids[self._maxSpare:]
+            for pid in pids:
+                self._closeChild(pid)
+
+    def _numChildren(self):
+        """Number of children, not counting the retiring ones."""
+        return len(self._children) - len(self._retiring)
+
+    def _childrenReady(self):
+        """True if all of the (non-retiring) children are ready."""
+        current = [d for pid, d in self._children.items()
+                   if pid not in self._retiring]
+        return bool(current) and all(d['ready'] for d in current)
+
+    def _adoptChildren(self, previous):
+        """Takes over the children of the previous server as retiring."""
+        for pid, d in previous._children.items():
+            d['avail'] = False
+            self._children[pid] = d
+            self._retiring.add(pid)
+            if d['file'] is not None:
+                fd = d['file'].fileno()
+                self._fdToPid[fd] = pid
+                self._poller.register(fd)
+        previous._children = {}
+        previous._fdToPid = {}
+        previous._availPids = set()
+        if self._retiring:
+            self._retireDeadline = time.time() + self._retireTimeout
+
+    def _retireChildren(self):
+        """
+        Tells the retiring children to exit. Like with an idle child
+        which isn't needed, the socket is closed. A busy child exits
+        after its current request.
+        """
+        for pid in self._retiring:
+            self._closeChild(pid)
+        self._retireDeadline = None
+
+    def _setAvail(self, pid, avail):
+        """Record whether or not the child is free to process requests."""
+        if pid in self._retiring:
+            avail = False
+        self._children[pid]['avail'] = avail
+        if avail:
+            self._availPids.add(pid)
+        else:
+            self._availPids.discard(pid)
+
+    def _closeChild(self, pid):
+        """
+        Closes the socket to a child, which tells an idle child to exit.
+        The child is no longer considered available.
+        """
+        d = self._children[pid]
+        if d['file'] is not None:
+            fd = d['file'].fileno()
+            self._poller.unregister(fd)
+            del self._fdToPid[fd]
+            d['file'].close()
+            d['file'] = None
+            if self._acceptLock is not None:
+                # It may be waiting for the accept lock
+                try:
+                    os.kill(pid, self._acceptLockSignal)
+                except OSError, e:
+                    if e[0] != errno.ESRCH:
+                        raise
+        self._setAvail(pid, False)
+
+    def _purgeChild(self):
+        """Asks one of the children listed by SIGUSR1 to exit."""
+        while self._children_to_purge:
+            pid = self._children_to_purge.pop(0)
+            d = self._children.get(pid)
+            if d is None or d['file'] is None:
+                # Already gone
+                continue
+            try:
+                d['file'].send('bye, bye')
+            except socket.error, e:
+                if e[0] not in (errno.EAGAIN, errno.EPIPE):
+                    raise
+            self._closeChild(pid)
+            self._last_purge = time.time()
+            break
+
     def _cleanupChildren(self):
         """
         Closes all child sockets (letting those that are available know
@@ -236,10 +488,9 @@ class PreforkServer(object):
         """
         # Let all children know it's time to go.
         for pid,d in self._children.items():
-            if d['file'] is not None:
-                d['file'].close()
-                d['file'] = None
-            if not d['avail']:
+            busy = not d['avail']
+            self._closeChild(pid)
+            if busy:
                 # Child is unavailable. SIGINT it.
                 try:
                     os.kill(pid, signal.SIGINT)
@@ -264,6 +515,7 @@ class PreforkServer(object):
                     break
             if self._children.has_key(pid):
                 del self._children[pid]
+                self._childExited(pid)
 
         signal.signal(signal.SIGALRM, oldSIGALRM)
 
@@ -287,10 +539,10 @@ class PreforkServer(object):
             if pid <= 0:
                 break
             if self._children.has_key(pid): # Sanity check.
-                if self._children[pid]['file'] is not None:
-                    self._children[pid]['file'].close()
-                    self._children[pid]['file'] = None
+                self._closeChild(pid)
                 del self._children[pid]
+                self._retiring.discard(pid)
+                self._childExited(pid)
 
     def _spawnChild(self, sock):
         """
@@ -322,6 +574,11 @@ class PreforkServer(object):
                       if x['file'] is not None]:
                 f.close()
             self._children = {}
+            self._fdToPid = {}
+            self._availPids = set()
+            # The copy of the parent's poller isn't needed either.
+            self._poller.close()
+            self._poller = None
             try:
                 # Enter main loop.
                 self._child(sock, parent)
@@ -333,9 +590,21 @@ class PreforkServer(object):
             parent.close()
             d = self._children[pid] = {}
             d['file'] = child
-            d['avail'] = True
+            d['ready'] = False
+            self._fdToPid[child.fileno()] = pid
+            self._poller.register(child.fileno())
+            self._setAvail(pid, True)
+            self._childSpawned(pid)
             return True
 
+    def _childSpawned(self, pid):
+        """Override to keep track of the children. Called in the parent."""
+        pass
+
+    def _childExited(self, pid):
+        """Called once a child has been reaped."""
+        pass
+
     def _isClientAllowed(self, addr):
         """Override to provide access control."""
         return True
@@ -355,11 +624,8 @@ class PreforkServer(object):
                 else:
                     raise
                 
-    def _child(self, sock, parent):
-        """Main loop for children."""
-        requestCount = 0
-
-        # Re-seed random module
+    def _reseedRandom(self):
+        """Re-seed random module"""
         preseed = ''
         # urandom only exists in Python >= 2.4
         if hasattr(os, 'urandom'):
@@ -371,25 +637,49 @@ class PreforkServer(object):
         random.seed('%s%s%s' % (preseed, os.getpid(), time.time()))
         del preseed
 
+    def _waitForClient(self, sock, parent):
+        """
+        Waits for and accepts the next allowed client connection.
+        Returns (clientSock, addr), or None if the parent wants us to
+        exit.
+        """
         while True:
-            # Wait for any activity on the main socket or parent socket.
-            r, w, e = select.select([sock, parent], [], [])
+            if self._acceptLock is not None:
+                oldHandler = signal.signal(self._acceptLockSignal, _ignoreSignal)
+                try:
+                    # The signal may have come before the handler was set
+                    while True:
+                        r, w, e = select.select([parent], [], [], 0)
+                        if r:
+                            return None
+                        if self._acceptLock.acquire(self._acceptLockTimeout):
+                            break
+                finally:
+                    signal.signal(self._acceptLockSignal, oldHandler)
+            try:
+                # Wait for any activity on the main socket or parent socket.
+                r, w, e = select.select([sock, parent], [], [])
 
-            for f in r:
-                # If there's any activity on the parent socket, it
-                # means the parent wants us to die or has died itself.
-                # Either way, exit.
-                if f is parent:
-                    return
+                for f in r:
+                    # If there's any activity on the parent socket, it
+                    # means the parent wants us to die or has died itself.
+                    # Either way, exit.
+                    if f is parent:
+                        return None
 
-            # Otherwise, there's activity on the main socket...
-            try:
-                clientSock, addr = sock.accept()
-            except socket.error, e:
-                if e[0] == errno.EAGAIN:
-                    # Or maybe not.
-                    continue
-                raise
+                # Otherwise, there's activity on the main socket...
+                try:
+                    clientSock, addr = sock.accept()
+                except socket.error, e:
+                    if e[0] == errno.EAGAIN:
+                        # Or maybe not.
+                        continue
+                    raise
+            finally:
+                # Let the next child wait for a connection while this
+                # one handles the request.
+                if self._acceptLock is not None:
+                    self._acceptLock.release()
 
             setCloseOnExec(clientSock)
             
@@ -398,6 +688,20 @@ class PreforkServer(object):
                 clientSock.close()
                 continue
 
+            return clientSock, addr
+
+    def _child(self, sock, parent):
+        """Main loop for children."""
+        requestCount = 0
+
+        self._reseedRandom()
+
+        while True:
+            client = self._waitForClient(sock, parent)
+            if client is None:
+                return
+            clientSock, addr = client
+
             # Notify parent we're no longer available.
             self._notifyParent(parent, '\x00')
 
@@ -405,15 +709,21 @@ class PreforkServer(object):
             self._jobClass(clientSock, addr, *self._jobArgs).run()
 
             # If we've serviced the maximum number of requests, exit.
-            if self._maxRequests > 0:
-                requestCount += 1
-                if requestCount >= self._maxRequests:
-                    break
+            requestCount += 1
+            if self._childDone(requestCount):
+                break
                 
             # Tell parent we're free again.
             if not self._notifyParent(parent, '\xff'):
                 return # Parent is gone.
 
+    def _childDone(self, requestCount):
+        """
+        Called by a child between requests. Return True if the child
+        should exit (after finishing any requests in progress).
+        """
+        return self._maxRequests > 0 and requestCount >= self._maxRequests
+
     # Signal handlers
 
     def _hupHandler(self, signum, frame):
@@ -428,7 +738,7 @@ class PreforkServer(object):
         pass
 
     def _usr1Handler(self, signum, frame):
-        self._children_to_purge = [x['file'] for x in self._children.values()
+        self._children_to_purge = [pid for pid, x in self._children.items()
                                    if x['file'] is not None]
 
     def _installSignalHandlers(self):
@@ -0,0 +1,123 @@
+"""Measure the context switches per request for each AcceptStrategy
+
+For each accept strategy and each pool size it starts an Akara server
+with that many idle children, makes the requests one at a time, and
+reports the number of context switches in the children per request.
+With the "shared" strategy every idle child wakes up for every new
+connection, so the count grows with the number of children.
+
+It only runs on Linux, as it reads /proc.
+"""
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+# python_support is in the test directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import python_support
+
+STRATEGIES = ("shared", "lock", "reuseport")
+POOL_SIZES = (5, 50, 150)
+
+CONFIG_TEMPLATE = """
+class Akara:
+  ServerRoot = %(server_root)r
+  Listen = 'localhost:%(port)s'
+  LogLevel = 'WARN'
+  MinSpareServers = %(num_children)d
+  MaxSpareServers = %(num_children)d
+  MaxServers = %(num_children)d
+  MaxRequestsPerServer = 1000000
+  AcceptStrategy = %(strategy)r
+
+MODULES = []
+"""
+
+def get_children(pid):
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            f = open("/proc/%s/stat" % name)
+            fields = f.read().rsplit(")", 1)[1].split()
+            f.close()
+        except IOError:
+            continue
+        # The field after the state is the parent pid
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return children
+
+def count_context_switches(pids):
+    total = 0
+    for pid in pids:
+        try:
+            f = open("/proc/%d/status" % pid)
+        except IOError:
+            continue
+        for line in f:
+            if line.startswith(("voluntary_ctxt_switches",
+                                "nonvoluntary_ctxt_switches")):
+                total += int(line.split()[1])
+        f.close()
+    return total
+
+def run_benchmark(strategy, num_children, num_requests):
+    server_root = tempfile.mkdtemp(prefix="akara_bench_")
+    os.mkdir(os.path.join(server_root, "logs"))
+    port = python_support.find_unused_port()
+    config_filename = os.path.join(server_root, "akara.conf")
+    f = open(config_filename, "w")
+    f.write(CONFIG_TEMPLATE % dict(server_root=server_root, port=port,
+                                   num_children=num_children,
+                                   strategy=strategy))
+    f.close()
+    result = subprocess.call(["akara", "-f", config_filename, "start"])
+    if result != 0:
+        raise AssertionError("Could not start the Akara server")
+    pid = int(open(os.path.join(server_root, "logs", "akara.pid")).read())
+    try:
+        url = "http://localhost:%d/" % port
+        # Wait for the pool to fill and warm up every child
+        for i in range(100):
+            children = get_children(pid)
+            if len(children) >= num_children:
+                break
+            time.sleep(0.1)
+        for i in range(num_children * 2):
+            urllib2.urlopen(url).read()
+        time.sleep(0.5)
+
+        children = get_children(pid)
+        before = count_context_switches(children)
+        t1 = time.time()
+        for i in range(num_requests):
+            urllib2.urlopen(url).read()
+        t2 = time.time()
+        after = count_context_switches(children)
+        return (after - before) / float(num_requests), (t2 - t1) / num_requests
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        time.sleep(0.5)
+        shutil.rmtree(server_root)
+
+def main(argv):
+    num_requests = 500
+    if len(argv) > 1:
+        num_requests = int(argv[1])
+    print "%-10s %8s %16s %12s" % ("strategy", "children", "switches/request", "ms/request")
+    for strategy in STRATEGIES:
+        for num_children in POOL_SIZES:
+            switches, seconds = run_benchmark(strategy, num_children, num_requests)
+            print "%-10s %8d %16.1f %12.2f" % (strategy, num_children,
+                                                switches, seconds * 1000)
+
+if __name__ == "__main__":
+    main(sys.argv)
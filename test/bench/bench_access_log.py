@@ -0,0 +1,70 @@
+"""Measure the access logging overhead per request
+
+It times what the dispatcher does to log a request: get the request's
+start time and write the access log line. The log files are in a
+temporary directory. The error log is set up as in a server, since
+unbuffered access log lines also pass through its handler.
+
+  unbuffered - AccessLogBufferSize = 0 (the default), the time
+               formatted for each request
+  buffered   - AccessLogBufferSize = 65536, the time formatted once
+               a second
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from akara import logger_config
+from akara import multiprocess_http
+
+ENVIRON = {
+    "REMOTE_ADDR": "127.0.0.1",
+    "REQUEST_METHOD": "GET",
+    "SERVER_PROTOCOL": "HTTP/1.1",
+    "HTTP_REFERER": "http://localhost:8880/",
+    "HTTP_USER_AGENT": ("Mozilla/5.0 (X11; Linux x86_64; rv:78.0) "
+                        "Gecko/20100101 Firefox/78.0"),
+    }
+
+def _format_now():
+    return multiprocess_http._format_time(int(time.time()))
+
+def run_benchmark(dirname, buffer_size, get_time, num_requests):
+    access_log = os.path.join(dirname, "access_%d.log" % (buffer_size,))
+    logger_config.set_access_logfile(access_log, buffer_size, 1.0)
+    save_to_access_log = multiprocess_http.AkaraWSGIDispatcher.save_to_access_log.im_func
+    t1 = time.time()
+    for i in xrange(num_requests):
+        access_data = dict(start_time = get_time(),
+                           request_uri = "/bench?i=1",
+                           status = "200",
+                           content_length = "1234")
+        save_to_access_log(None, ENVIRON, access_data)
+    t2 = time.time()
+    logger_config.set_access_logfile(access_log, 0)
+    return (t2 - t1) / num_requests
+
+def main(argv):
+    num_requests = 50000
+    if len(argv) > 1:
+        num_requests = int(argv[1])
+    dirname = tempfile.mkdtemp(prefix="akara_bench_")
+    try:
+        logger_config.set_logfile(os.path.join(dirname, "error.log"))
+        logger_config.remove_logging_to_stderr()
+        logging.getLogger("akara").setLevel(logging.INFO)
+        print "%-12s %14s" % ("access log", "us/request")
+        for name, buffer_size, get_time in (
+            ("unbuffered", 0, _format_now),
+            ("buffered", 65536, multiprocess_http._get_time)):
+            seconds = run_benchmark(dirname, buffer_size, get_time, num_requests)
+            print "%-12s %14.1f" % (name, seconds * 1000000)
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == "__main__":
+    main(sys.argv)
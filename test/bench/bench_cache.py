@@ -0,0 +1,95 @@
+"""Measure the time for a caching.cache hit
+
+The cache is in a temporary directory and its opener returns a 4KB
+body without any network access. Each lookup reads the whole body.
+
+  disk   - memory_size = 0, every hit opens and unpickles the cache file
+  lru    - as "disk", also counting the use for the eviction index
+  memory - memory_size = 1MB, hits come from the memory tier
+
+Then it times misses in a full cache of 65536 entries, where each miss
+has to remove an entry:
+
+  scan   - eviction = None, the oldest file of the subdirectory
+  lru    - eviction = "lru", chosen with the SQLite index
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+
+from akara import caching
+
+BODY = "x" * 4096
+
+class Response(object):
+    def __init__(self, url):
+        self.url = url
+        self.read = StringIO(BODY).read
+    def info(self):
+        return {"Content-Type": "text/plain"}
+
+def make_cache(dirname, **kwargs):
+    c = caching.cache("http://example.com/bench", opener=Response, **kwargs)
+    class Service(object):
+        path = "bench"
+    c.serv = Service()
+    c.baseurl = "http://localhost:8880/bench"
+    c.cachedir = dirname
+    c._open_shared_files()
+    c.initialized = True
+    return c
+
+def run_benchmark(dirname, kwargs, num_lookups):
+    c = make_cache(dirname, **kwargs)
+    # The first lookup fills the cache
+    c.get(q="python").read()
+    t1 = time.time()
+    for i in xrange(num_lookups):
+        f = c.get(q="python")
+        f.read()
+        f.close()
+    t2 = time.time()
+    return (t2 - t1) / num_lookups, c.memory_stats()
+
+def run_miss_benchmark(dirname, eviction, num_misses):
+    c = make_cache(dirname, eviction=eviction)
+    for i in xrange(c.maxentries):
+        c.get(fill=i).close()
+    t1 = time.time()
+    for i in xrange(num_misses):
+        c.get(miss=i).close()
+    t2 = time.time()
+    return (t2 - t1) / num_misses
+
+def main(argv):
+    num_lookups = 20000
+    if len(argv) > 1:
+        num_lookups = int(argv[1])
+    dirname = tempfile.mkdtemp(prefix="akara_bench_")
+    try:
+        print "%-8s %14s %10s" % ("tier", "us/lookup", "hit ratio")
+        for name, kwargs in (("disk", {}),
+                             ("lru", dict(eviction="lru")),
+                             ("memory", dict(memory_size=1024*1024))):
+            seconds, stats = run_benchmark(dirname, kwargs, num_lookups)
+            if stats is None:
+                hit_ratio = "-"
+            else:
+                hit_ratio = "%.3f" % (stats["hit_ratio"],)
+            print "%-8s %14.1f %10s" % (name, seconds * 1000000, hit_ratio)
+        print
+        print "%-8s %14s" % ("eviction", "us/miss")
+        for eviction in (None, "lru"):
+            cachedir = os.path.join(dirname, str(eviction))
+            os.mkdir(cachedir)
+            seconds = run_miss_benchmark(cachedir, eviction, 2000)
+            print "%-8s %14.1f" % (eviction or "scan", seconds * 1000000)
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == "__main__":
+    main(sys.argv)
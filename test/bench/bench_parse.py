@@ -0,0 +1,77 @@
+"""Compare the "fast" and "standard" RequestParser settings
+
+It runs the Akara request handler and dispatcher in this process on
+keep-alive GET requests, with typical browser headers, for a small
+simple_service. The connection is simulated in memory so the numbers
+are only the time spent parsing the request, building the WSGI
+environ, calling the service and formatting the response.
+"""
+
+import sys
+import time
+from cStringIO import StringIO
+
+from akara.services import simple_service
+from akara.multiprocess_http import AkaraWSGIHandler, AkaraWSGIDispatcher
+
+@simple_service("GET", "http://example.com/bench_parse", "bench_parse")
+def bench_parse(name="world"):
+    return "Hello, %s!\n" % (name,)
+
+REQUEST = (
+    "GET /bench_parse?name=Akara HTTP/1.1\r\n"
+    "Host: localhost:8880\r\n"
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:78.0) Gecko/20100101 Firefox/78.0\r\n"
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    "Accept-Language: en-US,en;q=0.5\r\n"
+    "Accept-Encoding: gzip, deflate\r\n"
+    "Referer: http://localhost:8880/\r\n"
+    "Connection: keep-alive\r\n"
+    "Cache-Control: max-age=0\r\n"
+    "\r\n")
+
+class Connection(object):
+    "Enough of a socket for the handler, with the requests in memory"
+    def __init__(self, data):
+        self.data = data
+        self.sent = 0
+    def makefile(self, mode, bufsize=-1):
+        if "r" in mode:
+            return StringIO(self.data)
+        return self
+    def sendall(self, data):
+        self.sent += len(data)
+    # Used if the handler writes through the "wb" file
+    write = sendall
+    def flush(self):
+        pass
+    def close(self):
+        pass
+    closed = False
+
+def run_benchmark(request_parser, num_requests):
+    settings = dict(server_address=("localhost", 8880),
+                    write_buffer_size=8192,
+                    request_parser=request_parser,
+                    compression=False)
+    dispatcher = AkaraWSGIDispatcher(settings, None)
+    connection = Connection(REQUEST * num_requests)
+    t1 = time.time()
+    AkaraWSGIHandler(connection, ("127.0.0.1", 12345), dispatcher)
+    t2 = time.time()
+    return (t2 - t1) / num_requests
+
+def main(argv):
+    num_requests = 20000
+    if len(argv) > 1:
+        num_requests = int(argv[1])
+    # Keep the access log quiet
+    import logging
+    logging.getLogger("akara.access").setLevel(logging.WARN)
+    print "%-10s %14s" % ("parser", "us/request")
+    for request_parser in ("standard", "fast"):
+        seconds = run_benchmark(request_parser, num_requests)
+        print "%-10s %14.1f" % (request_parser, seconds * 1000000)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,93 @@
+"""Measure the send calls per response for different WriteBufferSize values
+
+It runs the Akara request handler in this process, over a socket
+pair, with a WSGI application which yields its body in many small
+pieces (like a service returning a generator). For each buffer size
+it reports the number of send calls the handler made per response,
+which is also the number of send() system calls, and the time per
+response. A buffer size of 0 writes each piece as it is produced.
+"""
+
+import socket
+import sys
+import threading
+import time
+
+from akara.thirdparty import httpserver
+
+BUFFER_SIZES = (0, 1024, 8192)
+# (number of pieces, bytes per piece)
+BODIES = ((1, 100), (20, 50), (200, 50), (10, 20000))
+
+REQUEST = "GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+
+class CountingSocket(object):
+    "Count the calls which send data on the wrapped socket"
+    def __init__(self, sock):
+        self._sock = sock
+        self.sends = 0
+    def sendall(self, data, *args):
+        self.sends += 1
+        return self._sock.sendall(data, *args)
+    def send(self, data, *args):
+        self.sends += 1
+        return self._sock.send(data, *args)
+    def makefile(self, mode="r", bufsize=-1):
+        return socket._fileobject(self, mode, bufsize)
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+class Handler(httpserver.WSGIHandler):
+    protocol_version = "HTTP/1.1"
+    def log_request(self, code='-', size='-'):
+        pass
+
+class Server(object):
+    def __init__(self, write_buffer_size, num_pieces, piece_size):
+        self.write_buffer_size = write_buffer_size
+        self.piece = "x" * piece_size
+        self.num_pieces = num_pieces
+        self.server_address = ("localhost", 8880)
+    def wsgi_application(self, environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        for i in xrange(self.num_pieces):
+            yield self.piece
+
+def read_all(sock):
+    while sock.recv(65536):
+        pass
+    sock.close()
+
+def run_benchmark(write_buffer_size, num_pieces, piece_size, num_responses):
+    server = Server(write_buffer_size, num_pieces, piece_size)
+    sends = 0
+    t1 = time.time()
+    for i in range(num_responses):
+        client, conn = socket.socketpair()
+        client.sendall(REQUEST)
+        reader = threading.Thread(target=read_all, args=(client,))
+        reader.start()
+        counting = CountingSocket(conn)
+        Handler(counting, ("127.0.0.1", 0), server)
+        conn.shutdown(socket.SHUT_WR)
+        conn.close()
+        reader.join()
+        sends += counting.sends
+    t2 = time.time()
+    return sends / float(num_responses), (t2 - t1) / num_responses
+
+def main(argv):
+    num_responses = 500
+    if len(argv) > 1:
+        num_responses = int(argv[1])
+    print "%8s %14s %12s %14s" % ("buffer", "body", "sends/resp", "ms/response")
+    for num_pieces, piece_size in BODIES:
+        for write_buffer_size in BUFFER_SIZES:
+            sends, seconds = run_benchmark(write_buffer_size, num_pieces,
+                                           piece_size, num_responses)
+            print "%8d %14s %12.1f %14.3f" % (
+                write_buffer_size, "%d x %d" % (num_pieces, piece_size),
+                sends, seconds * 1000)
+
+if __name__ == "__main__":
+    main(sys.argv)
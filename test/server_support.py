@@ -66,6 +66,7 @@ class Akara:
   # These affect test_server.py:test_restart
   MaxServers = 5
   MaxRequestsPerServer = 5
+  Compression = 1
 
 class atomtools:
   entries = %(atom_entries)r
@@ -0,0 +1,420 @@
+# Test akara.caching
+
+# A caching.cache for the service at "svc" which stores into 'dirname'
+# and fetches with 'opener', without needing a running server
+def _make_test_cache(dirname, opener, **kwargs):
+    from akara import caching
+    c = caching.cache("http://example.com/svc", opener=opener, **kwargs)
+    class Service(object):
+        path = "svc"
+    c.serv = Service()
+    c.baseurl = "http://localhost:8880/svc"
+    c.cachedir = dirname
+    c._open_shared_files()
+    c.initialized = True
+    return c
+
+class _FakeResponse(object):
+    def __init__(self, url, body, headers):
+        from StringIO import StringIO
+        self.url = url
+        self.read = StringIO(body).read
+        self.headers = headers
+    def info(self):
+        return self.headers
+
+def test_cache_memory_tier():
+    import os, shutil, tempfile
+    from akara import caching
+    fetched = []
+    def opener(url):
+        fetched.append(url)
+        return _FakeResponse(url, "Body of " + url, {"Content-Type": "text/plain"})
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    try:
+        c = _make_test_cache(dirname, opener, memory_size=120)
+        f = c.get(q="a")
+        assert isinstance(f, caching.MemoryCacheFile), f
+        assert f.read() == "Body of http://localhost:8880/svc?q=a"
+        assert f.info() == {"Content-Type": "text/plain"}
+        assert f.geturl() == "http://localhost:8880/svc?q=a"
+        # Served from memory even if the disk entry is gone
+        shutil.rmtree(dirname)
+        f = c.get(q="a")
+        assert f.read() == "Body of http://localhost:8880/svc?q=a"
+        assert fetched == ["http://localhost:8880/svc?q=a"]
+        stats = c.memory_stats()
+        assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1), stats
+        assert stats["hit_ratio"] == 0.5
+        assert stats["size"] == len("q=a") + len("Body of http://localhost:8880/svc?q=a")
+
+        # The least recently used entries are dropped to stay within memory_size
+        os.mkdir(dirname)
+        c.get(q="b")
+        c.get(q="c")
+        c.get(q="a")
+        c.get(q="d")
+        assert c.memory.entries.keys() == ["q=c", "q=a", "q=d"], c.memory.entries.keys()
+        assert c.memory_stats()["size"] <= 120
+
+        # Expired entries aren't used
+        c.expires = 0
+        c.get(q="d")
+        assert fetched[-1] == "http://localhost:8880/svc?q=d"
+        assert len(fetched) == 5, fetched
+
+        # No memory tier by default
+        c = _make_test_cache(dirname, opener)
+        assert isinstance(c.get(q="a"), caching.CacheFile)
+        assert c.memory_stats() is None
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+
+def test_cache_eviction_index():
+    import os, shutil, tempfile
+    import cPickle as pickle
+    def opener(url):
+        return _FakeResponse(url, "x" * 1000, {})
+    # query -> cache file name, relative to the cache directory
+    def cached(cachedir):
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(cachedir):
+            for name in filenames:
+                if name.endswith(".p"):
+                    query = pickle.load(open(os.path.join(dirpath, name), "rb"))[0]
+                    result[query] = os.path.basename(dirpath) + "/" + name
+        return result
+    def make_cache(name, **kwargs):
+        cachedir = os.path.join(dirname, name)
+        os.mkdir(cachedir)
+        return _make_test_cache(cachedir, opener, **kwargs)
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    try:
+        try:
+            make_cache("bad", eviction="fifo")
+            raise AssertionError("unknown policy was accepted")
+        except ValueError:
+            pass
+        try:
+            make_cache("bad2", max_bytes=10000)
+            raise AssertionError("max_bytes without a policy was accepted")
+        except ValueError:
+            pass
+
+        # Least recently used
+        c = make_cache("lru", maxentries=3, eviction="lru")
+        for q in ("aaa", "bbb", "ccc", "aaa", "ddd"):
+            c.get(q=q).close()
+        assert sorted(cached(c.cachedir)) == ["q=aaa", "q=ccc", "q=ddd"], cached(c.cachedir)
+
+        # Least frequently used
+        c = make_cache("lfu", maxentries=3, eviction="lfu")
+        for q in ("aaa", "aaa", "bbb", "bbb", "ccc", "ddd"):
+            c.get(q=q).close()
+        assert sorted(cached(c.cachedir)) == ["q=aaa", "q=bbb", "q=ddd"], cached(c.cachedir)
+
+        # Total size. Expired entries are removed first.
+        c = make_cache("bytes", eviction="lru", max_bytes=3500)
+        for q in ("aaa", "bbb", "ccc"):
+            c.get(q=q).close()
+        conn = c.index._connect()
+        conn.execute("UPDATE entries SET expires = 0 WHERE key = ?",
+                     (cached(c.cachedir)["q=bbb"],))
+        conn.commit()
+        c.get(q="ddd").close()
+        assert sorted(cached(c.cachedir)) == ["q=aaa", "q=ccc", "q=ddd"], cached(c.cachedir)
+        count, total = conn.execute("SELECT * FROM totals").fetchone()
+        assert count == 3
+        assert 3000 < total <= 3500, total
+
+        # A file removed because it is for another query (a hash
+        # collision) is removed from the index too
+        key = cached(c.cachedir)["q=aaa"]
+        path = os.path.join(c.cachedir, key)
+        f = open(path, "rb")
+        metadata = pickle.load(f)
+        body = f.read()
+        f.close()
+        f = open(path, "wb")
+        pickle.dump(("q=zzz",) + metadata[1:], f, -1)
+        f.write(body)
+        f.close()
+        assert c._open_entry(path, "q=aaa", key) is None
+        assert not os.path.exists(path)
+        assert conn.execute("SELECT count(*) FROM entries WHERE key = ?",
+                            (key,)).fetchone()[0] == 0
+        c.get(q="aaa").close()
+
+        # Hits are written to the index in batches
+        c.get(q="aaa").close()
+        assert c.index._uses == {cached(c.cachedir)["q=aaa"]: 1}, c.index._uses
+
+        # Enabling eviction for a cache with entries indexes them
+        c = make_cache("existing")
+        for q in ("aaa", "bbb", "ccc"):
+            c.get(q=q).close()
+        c = _make_test_cache(c.cachedir, opener, maxentries=3, eviction="lru")
+        c.get(q="ddd").close()
+        assert len(cached(c.cachedir)) == 3, cached(c.cachedir)
+        assert "q=ddd" in cached(c.cachedir)
+
+        # A damaged index is rebuilt
+        c.index._conn.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(c.index.filename + suffix):
+                os.remove(c.index.filename + suffix)
+        open(c.index.filename, "w").write("This is not an SQLite file" * 100)
+        c = _make_test_cache(c.cachedir, opener, maxentries=3, eviction="lru")
+        c.get(q="eee").close()  # Can't update the index, but works
+        assert len(cached(c.cachedir)) == 4, cached(c.cachedir)
+        # The new index includes "eee"
+        c.get(q="fff").close()
+        assert len(cached(c.cachedir)) == 3, cached(c.cachedir)
+        assert "q=fff" in cached(c.cachedir)
+    finally:
+        shutil.rmtree(dirname)
+
+def test_in_process_opener():
+    import os, shutil, tempfile, urllib2
+    from akara import caching, registry, request, response, services
+    @services.simple_service("GET", "http://example.com/test_in_process",
+                             "test_in_process", "text/plain")
+    def test_in_process(name="world"):
+        response.add_header("X-Test", "yes")
+        return "Hello, " + name
+    def crash(environ, start_response):
+        raise ValueError("crash")
+    registry.register_service("http://example.com/test_in_process_crash",
+                              "test_in_process_crash", crash)
+    def no_start_response(environ, start_response):
+        return ["no status"]
+    registry.register_service("http://example.com/test_in_process_no_start",
+                              "test_in_process_no_start", no_start_response)
+    registered = registry._current_registry._registered_services
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    outer_environ = {"PATH_INFO": "/outer"}
+    request.environ = outer_environ
+    response.code = "201 Created"
+    response.headers = [("X-Outer", "1")]
+    try:
+        url = "http://localhost:8880/test_in_process?name=Akara"
+        u = caching.in_process_opener(url)
+        assert u.read() == "Hello, Akara"
+        assert u.getcode() == 200
+        assert u.msg == "OK"
+        assert u.geturl() == url
+        assert u.info()["Content-Type"] == "text/plain"
+        assert u.info()["X-Test"] == "yes"
+        # The request being handled still has its own akara.request/response
+        assert request.environ is outer_environ
+        assert response.code == "201 Created"
+        assert response.headers == [("X-Outer", "1")]
+
+        for path, code in (("test_in_process_crash", 500),
+                           ("test_in_process_no_start", 500),
+                           ("missing", 404)):
+            try:
+                caching.in_process_opener("http://localhost:8880/" + path)
+                raise AssertionError("no HTTPError")
+            except urllib2.HTTPError, err:
+                assert err.code == code, (path, err.code)
+
+        # Used by a cache, which stores the response
+        c = _make_test_cache(dirname, caching.in_process_opener)
+        c.baseurl = "http://localhost:8880/test_in_process"
+        assert c.get(name="cache").read() == "Hello, cache"
+        f = c.get(name="cache")
+        assert isinstance(f, caching.CacheFile)
+        assert f.read() == "Hello, cache"
+        assert f.info()["X-Test"] == "yes"
+    finally:
+        request.environ = None
+        del registered["test_in_process"]
+        del registered["test_in_process_crash"]
+        del registered["test_in_process_no_start"]
+        shutil.rmtree(dirname)
+
+def test_cache_miss_lock():
+    import os, shutil, tempfile, time
+    # The child process fetches slowly. The parent process misses the
+    # same entry meanwhile and waits for the child's result.
+    def slow_opener(url):
+        time.sleep(0.5)
+        return _FakeResponse(url, "from child", {})
+    fetched = []
+    def opener(url):
+        fetched.append(url)
+        return _FakeResponse(url, "from parent", {})
+    def fetch_in_child(c):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                c.opener = slow_opener
+                c.get(q="slow").close()
+            finally:
+                os._exit(0)
+        time.sleep(0.2)
+        return pid
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    try:
+        c = _make_test_cache(dirname, opener)
+        # Set up the lock file before the fork
+        c.get(q="first").close()
+        pid = fetch_in_child(c)
+        try:
+            t1 = time.time()
+            assert c.get(q="slow").read() == "from child"
+            assert time.time() - t1 < 2
+            assert fetched == ["http://localhost:8880/svc?q=first"], fetched
+        finally:
+            os.waitpid(pid, 0)
+
+        # Don't wait for longer than lock_timeout
+        c = _make_test_cache(os.path.join(dirname, "timeout"), opener,
+                             lock_timeout=0.1)
+        os.mkdir(c.cachedir)
+        pid = fetch_in_child(c)
+        try:
+            assert c.get(q="slow").read() == "from parent"
+        finally:
+            os.waitpid(pid, 0)
+    finally:
+        shutil.rmtree(dirname)
+
+# POSIX locks don't exclude each other within a process, so two cache
+# objects for the same directory must share the process's lock table
+def test_cache_miss_lock_threads():
+    import shutil, tempfile, threading, time
+    fetched = []
+    def slow_opener(url):
+        fetched.append(url)
+        time.sleep(0.5)
+        return _FakeResponse(url, "from the first", {})
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    try:
+        c1 = _make_test_cache(dirname, slow_opener)
+        c2 = _make_test_cache(dirname, slow_opener)
+        results = []
+        def fetch(c):
+            results.append(c.get(q="slow").read())
+        t = threading.Thread(target=fetch, args=(c1,))
+        t.start()
+        time.sleep(0.1)
+        t1 = time.time()
+        fetch(c2)
+        # Waited for the first fetch, not for lock_timeout
+        assert time.time() - t1 < 1
+        t.join()
+        assert results == ["from the first"] * 2, results
+        assert fetched == ["http://localhost:8880/svc?q=slow"], fetched
+    finally:
+        shutil.rmtree(dirname)
+
+def test_cache_expired_entries():
+    import os, shutil, tempfile, time, urllib2
+    from StringIO import StringIO
+    from akara import caching, registry, services
+    requests = []
+    version = ["v1"]
+    def opener(req):
+        if isinstance(req, urllib2.Request):
+            url = req.get_full_url()
+            headers = dict(req.header_items())
+        else:
+            url = req
+            headers = {}
+        requests.append(headers)
+        if version[0] == "down":
+            raise urllib2.URLError("connection refused")
+        if version[0] == "404":
+            raise urllib2.HTTPError(url, 404, "Not Found", {}, StringIO(""))
+        etag = '"%s"' % (version[0],)
+        if headers.get("If-none-match") == etag:
+            raise urllib2.HTTPError(url, 304, "Not Modified",
+                                    {"Date": "Sun, 18 Oct 2026 12:00:00 GMT"},
+                                    StringIO(""))
+        return _FakeResponse(url, "Body " + version[0],
+                             {"ETag": etag, "Date": "Sat, 17 Oct 2026 12:00:00 GMT"})
+    def string_opener(url):
+        assert isinstance(url, str), url
+        requests.append(url)
+        return _FakeResponse(url, "Body " + version[0], {"ETag": '"x"'})
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    try:
+        # An opener which isn't known to take a urllib2.Request only gets URLs
+        c = _make_test_cache(os.path.join(dirname, "plain"), string_opener, expires=0)
+        os.mkdir(c.cachedir)
+        assert c.get(q="a").read() == "Body v1"
+        assert c.get(q="a").read() == "Body v1"
+        assert len(requests) == 2
+        del requests[:]
+
+        # Entries always expire. Revalidated with If-None-Match.
+        c = _make_test_cache(dirname, opener, expires=0, revalidate=True)
+        assert c.get(q="a").read() == "Body v1"
+        assert requests == [{}]
+        f = c.get(q="a")
+        assert f.read() == "Body v1"
+        assert requests[-1] == {"If-none-match": '"v1"'}, requests
+        # The headers of the 304 response are stored with the entry
+        assert f.info()["Date"] == "Sun, 18 Oct 2026 12:00:00 GMT", f.info()
+        assert f.info()["ETag"] == '"v1"'
+        version[0] = "v2"
+        assert c.get(q="a").read() == "Body v2"
+        assert len(requests) == 3
+
+        # Errors
+        version[0] = "down"
+        try:
+            c.get(q="a")
+            raise AssertionError("no error")
+        except urllib2.URLError:
+            pass
+        c.stale_if_error = 60
+        assert c.get(q="a").read() == "Body v2"
+        version[0] = "404"
+        try:
+            c.get(q="a")
+            raise AssertionError("4xx errors don't use the expired entry")
+        except urllib2.HTTPError, err:
+            assert err.code == 404
+
+        # The expired entry is used while it is refreshed
+        c.stale_while_revalidate = 60
+        version[0] = "v3"
+        num_requests = len(requests)
+        assert c.get(q="a").read() == "Body v2"
+        for i in range(100):
+            if len(requests) > num_requests:
+                break
+            time.sleep(0.01)
+        time.sleep(0.1)
+        assert c.get(q="a").read() == "Body v3"
+
+        # A service with etag=True answers the conditional GET
+        @services.simple_service("GET", "http://example.com/test_revalidate",
+                                 "test_revalidate", "text/plain", etag=True)
+        def test_revalidate(name):
+            calls.append(name)
+            return "Hello, " + name
+        calls = []
+        errors = []
+        def in_process_opener(req):
+            try:
+                return caching.in_process_opener(req)
+            except urllib2.HTTPError, err:
+                errors.append(err.code)
+                raise
+        c = _make_test_cache(os.path.join(dirname, "in_process"),
+                             in_process_opener, expires=0, revalidate=True)
+        os.mkdir(c.cachedir)
+        c.baseurl = "http://localhost:8880/test_revalidate"
+        assert c.get(name="a").read() == "Hello, a"
+        f = c.get(name="a")
+        assert f.read() == "Hello, a"
+        assert f.info()["ETag"]
+        assert calls == ["a", "a"]
+        assert errors == [304]
+    finally:
+        registry._current_registry._registered_services.pop("test_revalidate", None)
+        shutil.rmtree(dirname)
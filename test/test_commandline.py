@@ -135,6 +135,34 @@ def test_status(server_root):
     # I can't think of a good way to test for a PID which does not exist.
     # That test is done manually.
 
+def test_summarize_access_log():
+    lines = ['{"service":"svc","mount":"a","status":200,"duration":0.010,'
+             '"ttfb":0.002,"bytes":100,"cache":"hit"}\n'] * 98
+    lines.append('{"service":"svc","mount":"a","status":503,"duration":1.0,'
+                 '"ttfb":null,"bytes":0,"cache":"miss"}\n')
+    lines.append('{"service":"svc","mount":"a","status":200,"duration":2.0,'
+                 '"ttfb":0.5,"bytes":0,"cache":null}\n')
+    lines.append('{"service":null,"mount":"missing","status":404,'
+                 '"duration":0.001,"ttfb":0.001,"bytes":10,"cache":null}\n')
+    lines.append('{"service":"svc","mou')
+    stats, bad_lines = commandline.summarize_access_log(iter(lines))
+    assert bad_lines == 1
+    assert sorted(stats) == ["/missing", "svc"], sorted(stats)
+    s = stats["svc"]
+    assert s.requests == 100
+    assert s.server_errors == 1
+    assert s.bytes == 9800
+    assert (s.cache_lookups, s.cache_hits) == (99, 98)
+    # Within 5%
+    def close(value, expected):
+        return expected <= value <= expected * 1.05
+    assert close(s.duration.percentile(50), 0.010), s.duration.percentile(50)
+    assert close(s.duration.percentile(99), 1.0), s.duration.percentile(99)
+    assert close(s.duration.percentile(100), 2.0), s.duration.percentile(100)
+    assert close(s.ttfb.percentile(50), 0.002), s.ttfb.percentile(50)
+    assert stats["/missing"].requests == 1
+    assert stats["/missing"].cache_lookups == 0
+
 @tmpdir
 def test_setup_config_file(server_root):
     config_file = os.path.join(server_root, "blah_subdir", "test_config.ini")
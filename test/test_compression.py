@@ -0,0 +1,136 @@
+# Test akara.compression
+
+def test_choose_encoding():
+    from akara.compression import choose_encoding
+    assert choose_encoding(None) is None
+    assert choose_encoding("") is None
+    assert choose_encoding("gzip, deflate") == "gzip"
+    assert choose_encoding("deflate") == "deflate"
+    assert choose_encoding("x-gzip") == "gzip"
+    assert choose_encoding("gzip;q=0.5, deflate") == "deflate"
+    assert choose_encoding("gzip;q=0, deflate;q=0") is None
+    assert choose_encoding("*") == "gzip"
+    assert choose_encoding("*;q=0, identity") is None
+    assert choose_encoding("br, compress") is None
+
+def test_compression():
+    import os, shutil, tempfile, zlib
+    from wsgiref.util import FileWrapper
+    from akara.compression import Compression
+    compression = Compression(["text/*"], min_size=100)
+    body = "Akara compresses text. " * 100
+    def call(app, accept_encoding="gzip", compress=None, head=False):
+        environ = {"HTTP_ACCEPT_ENCODING": accept_encoding}
+        if head:
+            environ["akara.head_request"] = True
+        responses = []
+        def start_response(status, headers, exc_info=None):
+            responses.append((status, dict(headers)))
+        result = compression(environ, start_response, app, compress)
+        data = "".join(result)
+        status, headers = responses[0]
+        return headers, data
+
+    def text_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain"),
+                                  ("Content-Length", str(len(body))),
+                                  ("ETag", '"v1"')])
+        return [body]
+    headers, data = call(text_app)
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Vary"] == "Accept-Encoding"
+    assert headers["ETag"] == '"v1-gz"'
+    assert int(headers["Content-Length"]) == len(data) < len(body)
+    assert zlib.decompress(data, 16 + zlib.MAX_WBITS) == body
+
+    headers, data = call(text_app, "deflate")
+    assert zlib.decompress(data) == body
+    # Not accepted, but still varies by Accept-Encoding
+    headers, data = call(text_app, "identity")
+    assert "Content-Encoding" not in headers and data == body
+    assert headers["Vary"] == "Accept-Encoding"
+    headers, data = call(text_app, compress=False)
+    assert "Content-Encoding" not in headers and "Vary" not in headers
+
+    def xml_generator_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/xml")])
+        return iter(["<a>", body, "</a>"])
+    headers, data = call(xml_generator_app)
+    assert "Content-Encoding" not in headers
+    headers, data = call(xml_generator_app, compress=True)
+    assert headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in headers
+    assert zlib.decompress(data, 16 + zlib.MAX_WBITS) == "<a>" + body + "</a>"
+    # A HEAD with an unknown compressed length isn't compressed
+    headers, data = call(xml_generator_app, compress=True, head=True)
+    assert "Content-Encoding" not in headers
+    assert headers["Vary"] == "Accept-Encoding"
+
+    # Files are compressed once into the cache directory
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    try:
+        compression.cache_dir = os.path.join(dirname, "compressed")
+        filename = os.path.join(dirname, "static.txt")
+        f = open(filename, "wb")
+        f.write(body)
+        f.close()
+        def file_app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return FileWrapper(open(filename, "rb"))
+        headers, data = call(file_app)
+        assert int(headers["Content-Length"]) == len(data)
+        assert zlib.decompress(data, 16 + zlib.MAX_WBITS) == body
+        def copies():
+            return sorted(os.path.join(dirpath, name) for (dirpath, dirnames, filenames)
+                          in os.walk(compression.cache_dir) for name in filenames
+                          if dirpath != compression.cache_dir)
+        cached, = copies()
+        mtime = os.path.getmtime(cached)
+        headers, data2 = call(file_app)
+        assert data2 == data
+        # A HEAD has the length of the stored copy
+        headers, data2 = call(file_app, head=True)
+        assert headers["Content-Encoding"] == "gzip"
+        assert int(headers["Content-Length"]) == len(data)
+        assert data2 == ""
+        assert os.path.getmtime(cached) == mtime
+        # A changed file is compressed again
+        f = open(filename, "ab")
+        f.write("More text.")
+        f.close()
+        headers, data = call(file_app)
+        assert zlib.decompress(data, 16 + zlib.MAX_WBITS) == body + "More text."
+        assert copies() == [cached]
+
+        # The copies are limited to cache_max_size. The least recently
+        # used are removed first.
+        compression.cache_max_size = len(data) * 2 + 200
+        compression._index = None
+        def make_file_app(name):
+            filename = os.path.join(dirname, name)
+            f = open(filename, "wb")
+            f.write(body)
+            f.close()
+            def file_app(environ, start_response):
+                start_response("200 OK", [("Content-Type", "text/plain")])
+                return FileWrapper(open(filename, "rb"))
+            return file_app
+        file_app2 = make_file_app("static2.txt")
+        call(file_app2)
+        assert len(copies()) == 2
+        call(file_app)
+        call(make_file_app("static3.txt"))
+        assert len(copies()) == 2
+        headers, data = call(file_app)
+        assert zlib.decompress(data, 16 + zlib.MAX_WBITS) == body + "More text."
+        assert cached in copies()
+
+        # Copies of removed files are removed
+        os.remove(os.path.join(dirname, "static.txt"))
+        os.remove(os.path.join(dirname, "static3.txt"))
+        compression._next_orphan_check = 0
+        call(file_app2)
+        assert len(copies()) == 1, copies()
+        assert cached not in copies()
+    finally:
+        shutil.rmtree(dirname)
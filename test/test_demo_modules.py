@@ -193,8 +193,16 @@ def test_static():
     assert "Poster Boy @ Flickr" in s
 
     url = server() + "static/README"
-    s = urllib2.urlopen(url).read()
+    response = urllib2.urlopen(url)
+    s = response.read()
     assert "SECRET MESSAGE" in s
+    assert response.headers["Content-Length"] == str(len(s))
+
+    # Larger files are sent with sendfile(), if available
+    url = server() + "resource/widefinder_100.apache_log"
+    expected = open(os.path.join(RESOURCE_DIR, "widefinder_100.apache_log"), "rb").read()
+    s = urllib2.urlopen(url).read()
+    assert s == expected, (len(s), len(expected))
 
     # Check that that leading "/" is trimmed
     url = server() + "//static////README"
@@ -38,3 +38,649 @@ def test_convert_body_list():
     result = convert_body(["blah"], None, None, None)
     assert result == (["blah"], "text/plain", None), result
 
+def test_convert_body_file():
+    # A file goes to the server's wsgi.file_wrapper, from its current position
+    import tempfile
+    from wsgiref.util import FileWrapper
+    f = tempfile.TemporaryFile()
+    f.write("header|body")
+    f.seek(7)
+    result, content_type, length = convert_body(f, None, None, None)
+    assert isinstance(result, FileWrapper), result
+    assert (content_type, length) == ("text/plain", 4), (content_type, length)
+    assert "".join(result) == "body"
+    result.close()
+    assert f.closed
+
+
+# stream_body=True services get the POST body as a file, on disk if large
+def test_spool_body():
+    from cStringIO import StringIO
+    from akara import global_config
+    from akara.services import _spool_body
+    global_config.spool_body_size = 100
+    try:
+        f = _spool_body(StringIO("x" * 50), 50)
+        assert not f._rolled
+        assert f.read() == "x" * 50
+        # Only reads up to the content length
+        f = _spool_body(StringIO("y" * 300), 250)
+        assert f._rolled
+        assert f.read() == "y" * 250
+    finally:
+        del global_config.spool_body_size
+
+def test_is_not_modified():
+    from akara import response
+    from akara.services import new_request, _add_validators, _is_not_modified
+    new_request({})
+    _add_validators(('W/"abc"', 1262304000))
+    assert response.headers == [("ETag", 'W/"abc"'),
+                                ("Last-Modified", "Fri, 01 Jan 2010 00:00:00 GMT")]
+    # Weak comparison
+    assert _is_not_modified({"HTTP_IF_NONE_MATCH": '"xyz", "abc"'})
+    assert _is_not_modified({"HTTP_IF_NONE_MATCH": '*'})
+    assert not _is_not_modified({"HTTP_IF_NONE_MATCH": '"abcd"'})
+    assert _is_not_modified(
+        {"HTTP_IF_MODIFIED_SINCE": "Fri, 01 Jan 2010 00:00:00 GMT"})
+    assert not _is_not_modified(
+        {"HTTP_IF_MODIFIED_SINCE": "Thu, 31 Dec 2009 23:59:59 GMT"})
+    assert not _is_not_modified({"HTTP_IF_MODIFIED_SINCE": "yesterday"})
+    # Only for a successful response
+    response.code = 404
+    assert not _is_not_modified({"HTTP_IF_NONE_MATCH": '*'})
+
+    # An unquoted ETag is quoted. A header set by the service is kept.
+    new_request({})
+    response.add_header("Last-Modified", "Sat, 02 Jan 2010 00:00:00 GMT")
+    _add_validators(("abc", 1262304000))
+    assert response.headers == [("Last-Modified", "Sat, 02 Jan 2010 00:00:00 GMT"),
+                                ("ETag", '"abc"')]
+
+
+# The master imports the extension modules when "PreloadModules" is
+# set. A SIGHUP must be able to forget about them again.
+def test_preload_and_unload_modules():
+    import sys
+    from akara import multiprocess_http, registry
+    config = {"MODULES": ["akara.demo.echo", "akara.demo.does_not_exist"]}
+    multiprocess_http._preload_modules(config)
+    try:
+        assert "akara.demo.echo" in sys.modules
+        assert registry.get_service("akara.echo") is not None
+    finally:
+        multiprocess_http._unload_modules()
+    assert "akara.demo.echo" not in sys.modules
+    try:
+        registry.get_service("akara.echo")
+        raise AssertionError("akara.echo should have been removed")
+    except KeyError:
+        pass
+    # The built-in services are still there
+    assert registry.get_service("") is not None
+
+# akara.request and akara.response are per-thread
+def test_request_context_per_thread():
+    import threading
+    from akara import request, response
+    from akara.services import new_request
+    results = {}
+    ready = threading.Event()
+    def handle(name):
+        new_request({"PATH_INFO": name})
+        response.add_header("X-Name", name)
+        if name == "first":
+            ready.wait(5)
+        else:
+            ready.set()
+        results[name] = (request.environ["PATH_INFO"], response.headers)
+    threads = [threading.Thread(target=handle, args=(name,))
+               for name in ("first", "second")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results["first"] == ("first", [("X-Name", "first")]), results
+    assert results["second"] == ("second", [("X-Name", "second")]), results
+
+# request.module_config uses the settings made on akara.request
+def test_request_module_config():
+    from ConfigParser import RawConfigParser
+    from akara import request
+    config = RawConfigParser()
+    config.add_section("spam")
+    config.set("spam", "eggs", "1")
+    old = request.akara_config, request.module_name
+    request.akara_config = config
+    request.module_name = "spam"
+    try:
+        assert request.module_config["eggs"] == "1"
+        request.module_config["ham"] = "2"
+        assert sorted(request.module_config.keys()) == ["eggs", "ham"]
+        del request.module_config["eggs"]
+        assert config.items("spam") == [("ham", "2")]
+    finally:
+        request.akara_config, request.module_name = old
+
+# A "gevent" server asks which handlers may run in its event loop
+def test_is_cooperative():
+    from akara.services import is_cooperative, service_method_dispatcher
+    def handler(environ, start_response):
+        pass
+    assert not is_cooperative(handler, {})
+    handler.cooperative = True
+    assert is_cooperative(handler, {})
+
+    dispatcher = service_method_dispatcher("spam")
+    dispatcher.add_handler("GET", lambda environ, start_response: None,
+                           cooperative=True)
+    dispatcher.add_handler("POST", lambda environ, start_response: None)
+    assert is_cooperative(dispatcher, {"REQUEST_METHOD": "GET"})
+    assert not is_cooperative(dispatcher, {"REQUEST_METHOD": "POST"})
+    assert not is_cooperative(dispatcher, {"REQUEST_METHOD": "PUT"})
+
+# A method dispatcher called directly with a HEAD uses the GET handler
+def test_dispatcher_head():
+    from akara.services import service_method_dispatcher
+    seen = []
+    def get_handler(environ, start_response):
+        seen.append((environ["REQUEST_METHOD"], environ.get("akara.head_request")))
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return ["body"]
+    dispatcher = service_method_dispatcher("spam")
+    dispatcher.add_handler("GET", get_handler)
+    responses = []
+    def start_response(status, headers, exc_info=None):
+        responses.append((status, headers))
+    result = dispatcher({"REQUEST_METHOD": "HEAD"}, start_response)
+    assert result == [], result
+    assert seen == [("GET", True)], seen
+    assert responses == [("200 OK", [("Content-Type", "text/plain")])], responses
+
+# A 'head' function can't know the inferred Content-Type of a GET
+def test_head_needs_content_type():
+    from akara.services import simple_service
+    def head(size="100"):
+        return int(size)
+    try:
+        simple_service("GET", "http://example.com/spam", head=head)
+    except ValueError, err:
+        assert "content_type" in str(err), err
+    else:
+        raise AssertionError("'head' without 'content_type' was accepted")
+    simple_service("GET", "http://example.com/spam",
+                   content_type="text/plain", head=head)
+
+# A blocking handler's body is produced in the threads a piece at a time
+def test_call_blocking_handler():
+    from akara import multiprocess_http
+    calls = []
+    def apply(func, args):
+        calls.append(func)
+        return func(*args)
+    produced = []
+    closed = []
+    def body():
+        try:
+            for i in range(100):
+                produced.append(i)
+                yield "x" * 4096
+        finally:
+            closed.append(True)
+    def handler(environ, start_response):
+        start_response("200 OK", [])
+        return body()
+    started = []
+    result = multiprocess_http._call_blocking_handler(
+        apply, handler, {}, lambda status, headers: started.append(status))
+    assert started == ["200 OK"]
+    assert produced == []
+    it = iter(result)
+    it.next()
+    # Only the first 64KB are produced
+    assert len(produced) == 16, len(produced)
+    assert sum(1 for chunk in it) == 99
+    result.close()
+    assert closed == [True]
+    assert calls[0] is handler
+    # handler, iter, 7 pieces and the end, close
+    assert len(calls) == 1 + 1 + 8 + 1, calls
+
+    # Strings and lists are returned as they are
+    result = multiprocess_http._call_blocking_handler(
+        apply, lambda environ, start_response: ["a", "b"], {}, None)
+    assert result == ["a", "b"]
+
+# After a SIGHUP the new server takes over the old children and only
+# retires them once its own children are ready
+def test_prefork_adopt_children():
+    import socket
+    from akara.thirdparty import preforkserver
+    previous = preforkserver.PreforkServer(gracefulRestart=True)
+    server = preforkserver.PreforkServer(gracefulRestart=True)
+    server._poller = preforkserver.Poller()
+    sockets = []
+    try:
+        for pid in (101, 102):
+            parent, child = socket.socketpair()
+            sockets.append(parent)
+            previous._children[pid] = {"file": child, "avail": True, "ready": True}
+            previous._fdToPid[child.fileno()] = pid
+            previous._availPids.add(pid)
+        server._adoptChildren(previous)
+        assert previous._children == {}
+        assert server._retiring == set([101, 102])
+        assert server._numChildren() == 0
+        assert not server._availPids
+        assert server._retireDeadline is not None
+        # No new children yet
+        assert not server._childrenReady()
+
+        parent, child = socket.socketpair()
+        sockets.append(parent)
+        server._children[201] = {"file": child, "avail": True, "ready": False}
+        server._fdToPid[child.fileno()] = 201
+        server._setAvail(201, True)
+        server._setAvail(101, True)
+        assert server._availPids == set([201])
+        assert not server._childrenReady()
+        server._children[201]["ready"] = True
+        assert server._childrenReady()
+
+        server._retireChildren()
+        assert server._retireDeadline is None
+        assert server._children[101]["file"] is None
+        assert server._children[102]["file"] is None
+        assert server._children[201]["file"] is not None
+        # The retired children see the end of their parent socket
+        assert sockets[0].recv(1) == ""
+    finally:
+        server._poller.close()
+        for s in sockets:
+            s.close()
+
+# A child waiting for the accept lock still exits when its parent
+# socket is closed, woken by a signal or else by the timeout
+def test_accept_lock_exit():
+    import os, shutil, socket, tempfile, time
+    from akara.thirdparty import preforkserver
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(5)
+    lock = preforkserver.FcntlAcceptLock(os.path.join(dirname, "accept.lock"))
+    server = preforkserver.PreforkServer(acceptLock=lock)
+    def start_child():
+        parent, child = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent.close()
+            try:
+                server._waitForClient(sock, child)
+            finally:
+                os._exit(0)
+        child.close()
+        return pid, parent
+    def wait_exit(pid):
+        for i in range(300):
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                return True
+            time.sleep(0.01)
+        return False
+    children = []
+    try:
+        for timeout, send_signal in ((0.1, False), (60, True)):
+            server._acceptLockTimeout = timeout
+            # The first child holds the lock, the second one waits for it
+            children.append(start_child())
+            time.sleep(0.05)
+            children.append(start_child())
+            time.sleep(0.05)
+            t1 = time.time()
+            assert not lock.acquire(0.1)
+            assert time.time() - t1 < 1
+            for pid, parent in reversed(children[:]):
+                parent.close()
+                if send_signal:
+                    os.kill(pid, server._acceptLockSignal)
+                assert wait_exit(pid), "child did not exit"
+                children.remove((pid, parent))
+            assert lock.acquire(0.1)
+            lock.release()
+    finally:
+        for pid, parent in children:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+        lock.close()
+        sock.close()
+        shutil.rmtree(dirname)
+
+# The servers report their status through the shared scoreboard
+def test_scoreboard():
+    import os, shutil, tempfile
+    from akara import scoreboard
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    filename = os.path.join(dirname, "akara.scoreboard")
+    score = scoreboard.Scoreboard(filename, 4)
+    try:
+        assert scoreboard.read_scoreboard(filename) == []
+        scoreboard.attach(score, 2)
+        try:
+            workers = scoreboard.read_scoreboard(filename)
+            assert len(workers) == 1, workers
+            assert workers[0]["slot"] == 2
+            assert workers[0]["pid"] == os.getpid()
+            assert workers[0]["state"] == "starting"
+
+            scoreboard.server_ready()
+            request_start = scoreboard.request_started("spam")
+            worker, = scoreboard.read_scoreboard(filename)
+            assert worker["state"] == "busy"
+            assert worker["active"] == 1
+            assert worker["mount_point"] == "spam"
+            assert worker["request_start"] >= worker["started"]
+
+            scoreboard.request_finished(request_start)
+            worker, = scoreboard.read_scoreboard(filename)
+            assert worker["state"] == "idle"
+            assert worker["active"] == 0
+            assert worker["requests"] == 1
+            assert worker["rss"] > 0
+            assert worker["busy_time"] >= 0.0
+        finally:
+            scoreboard._slot = None
+        score.clear(2)
+        assert scoreboard.read_scoreboard(filename) == []
+    finally:
+        score.close()
+        assert not os.path.exists(filename)
+        shutil.rmtree(dirname)
+
+# The "load" ScalingPolicy
+def test_load_scaler():
+    from akara.multiprocess_http import LoadScaler
+    scaler = LoadScaler(1, 2, 20, target_utilization=0.5,
+                        max_spawn_rate=4, scale_down_delay=10)
+    # Idle: keep the MaxSpareServers minimum
+    scaler.sample(0.0, 0, 0.0, 0)
+    assert scaler.spawn_count(0.0, 2, 0) == 0
+    assert not scaler.should_stop_one(0.0, 2, 0)
+
+    # On average 4 children were busy in the last second. Want 8
+    # children plus a bit for the rising load, but only 4 per second.
+    scaler.sample(1.0, 4, 4.0, 0)
+    assert scaler.demand() > 2.0
+    assert scaler.spawn_count(1.0, 2, 4) == 4
+    assert scaler.spawn_count(1.0, 6, 4) == 0
+    assert scaler.spawn_count(1.5, 6, 4) == 2
+
+    # A steady load of 4 busy children needs 8 children
+    for t in range(2, 10):
+        scaler.sample(float(t), 4, 4.0 * t, 0)
+    assert abs(scaler.demand() - 4.0) < 0.1, scaler.demand()
+    assert scaler.spawn_count(10.0, 8, 4) == 0
+    assert not scaler.should_stop_one(10.0, 8, 4)
+
+    # Waiting connections count as demand
+    scaler.sample(11.0, 4, 44.0, 2)
+    assert scaler.spawn_count(11.0, 8, 4) > 0
+
+    # One long request doesn't need many children
+    scaler.queue = 0
+    for t in range(12, 20):
+        scaler.sample(float(t), 1, 44.0 + (t - 11), 0)
+    assert scaler.spawn_count(20.0, 8, 1) == 0
+    # Too many children, but only stop them after the delay
+    assert not scaler.should_stop_one(20.0, 8, 1)
+    assert not scaler.should_stop_one(29.0, 8, 1)
+    assert scaler.should_stop_one(30.0, 8, 1)
+    # and then one per interval
+    assert not scaler.should_stop_one(30.5, 7, 1)
+    assert scaler.should_stop_one(31.0, 7, 1)
+    # but never below MaxSpareServers
+    assert not scaler.should_stop_one(40.0, 2, 0)
+
+def test_access_log_time():
+    import os, time
+    from akara import multiprocess_http
+    old_tz = os.environ.get("TZ")
+    try:
+        for tz, expected in (("UTC0", "2010/Jan/1:00:00:00 +0000"),
+                             ("EST5", "2009/Dec/31:19:00:00 -0500"),
+                             ("IST-5:30", "2010/Jan/1:05:30:00 +0530")):
+            os.environ["TZ"] = tz
+            time.tzset()
+            s = multiprocess_http._format_time(1262304000)
+            assert s == expected, (tz, s)
+    finally:
+        if old_tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = old_tz
+        time.tzset()
+    # Cached for the rest of the second
+    t = multiprocess_http._get_time()
+    assert multiprocess_http._time_cache[1] == t
+
+def test_buffered_access_log():
+    import os, shutil, tempfile
+    from akara.logger_config import BufferedAccessLog
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirname, "access.log")
+        log = BufferedAccessLog(filename, 100, 60.0)
+        log.write("x" * 40 + "\n")
+        log.write("y" * 40 + "\n")
+        assert open(filename).read() == ""
+        # Written out once the buffer is full
+        log.write("z" * 40 + "\n")
+        assert open(filename).read() == "x"*40 + "\n" + "y"*40 + "\n" + "z"*40 + "\n"
+        log.write("Last line\n")
+        log.close()
+        assert open(filename).read().endswith("\nLast line\n")
+
+        # The buffers in use are flushed at exit, by one atexit handler
+        import atexit
+        from akara import logger_config
+        num_handlers = len(atexit._exithandlers)
+        filename = os.path.join(dirname, "access2.log")
+        for i in range(3):
+            logger_config.set_access_logfile(filename, 100, 60.0)
+        assert len(atexit._exithandlers) == num_handlers
+        logger_config.write_access_log("Pending")
+        assert open(filename).read() == ""
+        logger_config._flush_access_logs()
+        assert open(filename).read() == "Pending\n"
+        logger_config._access_buffer.close()
+        logger_config._access_buffer = None
+    finally:
+        shutil.rmtree(dirname)
+
+def test_structured_access_log():
+    import json, os, shutil, tempfile
+    from akara import logger_config
+    from akara.multiprocess_http import AkaraWSGIDispatcher
+    save = AkaraWSGIDispatcher.save_to_structured_access_log.im_func
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirname, "access.jsonl")
+        logger_config.set_structured_access_logfile(filename)
+        access_data = dict(request_uri="/test_etag?x=1", status="200",
+                           method="HEAD", mount_point="test_etag",
+                           service="http://example.com/test_etag")
+        environ = {"REMOTE_ADDR": "127.0.0.1",
+                   "akara.access_data": access_data,
+                   "akara.cache_hits": 2}
+        save(None, environ, 1000.0, 1000.25, 1000.125, 1234)
+        # No record if the dispatcher wasn't reached
+        save(None, {}, 1000.0, 1000.25, None, 0)
+        access_data["status"] = None
+        environ["akara.cache_misses"] = 1
+        save(None, environ, 1000.0, 1000.25, None, 0)
+        logger_config.set_structured_access_logfile(None)
+        records = [json.loads(line) for line in open(filename)]
+    finally:
+        logger_config.set_structured_access_logfile(None)
+        shutil.rmtree(dirname)
+    assert len(records) == 2, records
+    assert records[0] == dict(time=1000.0, pid=os.getpid(), remote="127.0.0.1",
+                              method="HEAD", uri="/test_etag?x=1", status=200,
+                              mount="test_etag",
+                              service="http://example.com/test_etag",
+                              duration=0.25, ttfb=0.125, bytes=1234,
+                              cache="hit"), records[0]
+    assert records[1]["status"] == 500
+    assert records[1]["ttfb"] is None
+    assert records[1]["cache"] == "miss"
+
+# Servers exit between requests when too old or too big
+def test_child_done():
+    import time
+    from akara import scoreboard
+    from akara.multiprocess_http import AkaraPreforkServer
+    settings = dict(server_address=("localhost", 0), status_mount_point="")
+    server = AkaraPreforkServer(settings, None, maxRequests=10)
+    assert not server._childDone(9)
+    assert server._childDone(10)
+
+    server._childDeadline = time.time() - 1
+    assert server._childDone(1)
+    server._childDeadline = time.time() + 60
+    assert not server._childDone(1)
+
+    server.max_server_rss = scoreboard.get_rss() // 2
+    assert server._childDone(1)
+    server.max_server_rss = scoreboard.get_rss() * 2
+    assert not server._childDone(1)
+
+# Small response writes are sent together
+def test_coalescing_writer():
+    from akara.thirdparty.httpserver import CoalescingWriter
+    class Sock(object):
+        def __init__(self):
+            self.sent = []
+        def sendall(self, data):
+            self.sent.append(data)
+    sock = Sock()
+    f = CoalescingWriter(sock, 10)
+    f.write("HTTP")
+    f.write("")
+    f.write("/1.1")
+    assert sock.sent == []
+    f.write(" 200")
+    assert sock.sent == ["HTTP/1.1 200"], sock.sent
+    f.write("OK")
+    f.write("a" * 20)
+    assert sock.sent == ["HTTP/1.1 200", "OK" + "a" * 20], sock.sent
+    f.write("end")
+    f.flush()
+    f.flush()
+    assert sock.sent[2:] == ["end"], sock.sent
+    f.write("x")
+    f.close()
+    assert sock.sent[3:] == ["x"], sock.sent
+    assert f.closed
+
+# A response shorter than its Content-Length closes the connection,
+# so a keep-alive client doesn't wait for the rest
+def test_short_response_closes():
+    import os, shutil, socket, tempfile
+    from akara.thirdparty import httpserver
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    filename = os.path.join(dirname, "data")
+    f = open(filename, "wb")
+    f.write("x" * 1000)
+    f.close()
+    class Handler(httpserver.WSGIHandler):
+        # Don't handle a request on creation
+        def __init__(self, app):
+            self.server = self
+            self.wsgi_application = app
+            self.connection, self.peer = socket.socketpair()
+            self.wfile = self.connection.makefile("wb")
+            self.request_version = "HTTP/1.1"
+            self.command = "GET"
+            self.close_connection = 0
+        def wsgi_setup(self, environ=None):
+            self.wsgi_environ = {}
+            self.wsgi_curr_headers = None
+            self.wsgi_headers_sent = False
+            self.wsgi_chunked = False
+            self.wsgi_bytes_sent = 0
+            self.wsgi_headers_time = None
+        def log_request(self, *args):
+            pass
+        def response(self):
+            self.wfile.close()
+            self.connection.shutdown(socket.SHUT_WR)
+            self.connection.close()
+            data = "".join(iter(lambda: self.peer.recv(65536), ""))
+            self.peer.close()
+            return data.split("\r\n\r\n", 1)[1]
+    def app_for(length, wrap):
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Length", str(length))])
+            return wrap(open(filename, "rb"))
+        return app
+    as_list = lambda f: [f.read()]
+    try:
+        for length, wrap, closed in (
+            (1000, httpserver.FileWrapper, 0),
+            (500, httpserver.FileWrapper, 0),
+            (2000, httpserver.FileWrapper, 1),
+            (1000, as_list, 0),
+            (2000, as_list, 1)):
+            handler = Handler(app_for(length, wrap))
+            handler.wsgi_execute()
+            body = handler.response()
+            assert handler.close_connection == closed, (length, wrap)
+            assert body == "x" * min(length, 1000), (length, len(body))
+    finally:
+        shutil.rmtree(dirname)
+
+# The "fast" RequestParser must build the same environ as paste
+def test_fast_request_parser():
+    from cStringIO import StringIO
+    from akara.multiprocess_http import AkaraWSGIHandler
+    class Server(object):
+        server_address = ("localhost", 8880)
+    class Handler(AkaraWSGIHandler):
+        # Don't handle the request on creation
+        def __init__(self):
+            pass
+    request = ("GET /spam/a%20b//./c/?x=1&y=%20#frag HTTP/1.1\r\n"
+               "Host: localhost:8880\r\n"
+               "Accept: text/html\r\n"
+               "accept: text/plain\r\n"
+               "X-Folded: one\r\n"
+               " two\r\n"
+               "Content-Type: text/plain\r\n"
+               "Content-Length: 3\r\n"
+               "\r\n"
+               "abc")
+    environs = {}
+    for parser in ("fast", "standard"):
+        handler = Handler()
+        handler.server = Server()
+        handler.server.request_parser = parser
+        handler.connection = None
+        handler.client_address = ("127.0.0.1", 12345)
+        handler.rfile = StringIO(request)
+        handler.raw_requestline = handler.rfile.readline()
+        assert handler.parse_request()
+        assert handler.close_connection == 0
+        handler.wsgi_setup()
+        environ = handler.wsgi_environ
+        assert environ.pop("wsgi.input").read() == "abc"
+        environs[parser] = environ
+    fast = environs["fast"]
+    assert fast["PATH_INFO"] == "/spam/a b/c/", fast["PATH_INFO"]
+    assert fast["QUERY_STRING"] == "x=1&y=%20"
+    assert fast["HTTP_ACCEPT"] == "text/html,text/plain", fast["HTTP_ACCEPT"]
+    assert fast["CONTENT_LENGTH"] == "3"
+    assert "HTTP_CONTENT_TYPE" not in fast
+    # mimetools keeps the line break in a folded header
+    standard = environs["standard"]
+    assert fast.pop("HTTP_X_FOLDED") == "one two"
+    assert standard.pop("HTTP_X_FOLDED") == "one\n two"
+    assert fast == standard, (fast, standard)
@@ -91,6 +91,21 @@ When the hurlyburly's done,
 When the battle's lost and won.
 """, body
 
+# A response without a Content-Length uses the chunked encoding so
+# HTTP/1.1 clients can keep the connection open
+def test_iterator_keep_alive():
+    h = httplib_server()
+    for i in range(2):
+        h.request("GET", "/test_iterator")
+        r = h.getresponse()
+        assert r.status == 200, r.status
+        assert r.getheader("transfer-encoding") == "chunked", r.getheaders()
+        assert r.getheader("connection") is None, r.getheaders()
+        body = r.read()
+        assert body.startswith("When shall we three meet again?\n"), body
+        assert h.sock is not None, "connection was closed"
+    h.close()
+
 
 def test_args1():
     body = GET("test_args", dict(a="Andrew"))
@@ -170,6 +185,95 @@ def test_large_echo():
     assert "Body:\n'0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, " in body, body[:100]
     assert body.endswith(", 99996, 99997, 99998, 99999'\n"), repr(body[-50:])
 
+def test_compressed_echo():
+    import zlib
+    data = ", ".join(map(str, range(100000)))
+    request = urllib2.Request(server() + "test_echo_simple_post", data,
+                              {"Accept-Encoding": "gzip"})
+    f = urlopen(request)
+    assert f.headers["Content-Encoding"] == "gzip"
+    assert f.headers["Vary"] == "Accept-Encoding"
+    body = zlib.decompress(f.read(), 16 + zlib.MAX_WBITS)
+    assert body.endswith(", 99996, 99997, 99998, 99999'\n"), repr(body[-50:])
+
+def _conditional_GET(name, headers):
+    h = httplib_server()
+    h.request("GET", "/" + name, headers=headers)
+    response = h.getresponse()
+    body = response.read()
+    h.close()
+    return response.status, response, body
+
+def test_etag():
+    code, headers, body = GET3("test_etag")
+    etag = headers["ETag"]
+    assert etag.startswith('"') and etag.endswith('"'), etag
+    status, response, body = _conditional_GET("test_etag", {"If-None-Match": etag})
+    assert status == 304, status
+    assert body == "", body
+    assert response.getheader("ETag") == etag
+    assert response.getheader("Content-Type") is None
+
+    # A different body has a different ETag
+    status, response, body = _conditional_GET("test_etag?word=Python",
+                                              {"If-None-Match": etag})
+    assert status == 200, status
+    assert response.getheader("ETag") != etag
+    assert body.startswith("Python! ")
+
+def test_etag_compressed():
+    # The compressed ETag (with its "-gz" suffix) also matches
+    status, response, body = _conditional_GET("test_etag",
+                                              {"Accept-Encoding": "gzip"})
+    assert status == 200, status
+    assert response.getheader("Content-Encoding") == "gzip"
+    etag = response.getheader("ETag")
+    assert etag.endswith('-gz"'), etag
+    status, response, body = _conditional_GET(
+        "test_etag", {"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert status == 304, status
+    assert response.getheader("ETag") == etag
+    assert response.getheader("Vary") == "Accept-Encoding"
+
+def test_validator():
+    code, headers, body = GET3("test_validator")
+    assert body == "Version: 1\n", body
+    assert headers["ETag"] == '"v1"', headers["ETag"]
+    assert headers["Last-Modified"] == "Fri, 01 Jan 2010 00:00:00 GMT"
+
+    # The service function would raise an exception if called
+    status, response, body = _conditional_GET("test_validator?version=skip",
+                                              {"If-None-Match": '"v1", "vskip"'})
+    assert status == 304, status
+    assert response.getheader("ETag") == '"vskip"'
+    status, response, body = _conditional_GET(
+        "test_validator?version=skip",
+        {"If-Modified-Since": "Sat, 02 Jan 2010 10:00:00 GMT"})
+    assert status == 304, status
+
+    # Modified since then
+    status, response, body = _conditional_GET(
+        "test_validator", {"If-Modified-Since": "Thu, 31 Dec 2009 10:00:00 GMT"})
+    assert status == 200, status
+    assert body == "Version: 1\n", body
+    # If-None-Match has priority over If-Modified-Since
+    status, response, body = _conditional_GET(
+        "test_validator", {"If-None-Match": '"v2"',
+                           "If-Modified-Since": "Sat, 02 Jan 2010 10:00:00 GMT"})
+    assert status == 200, status
+
+    # The validator doesn't know
+    status, response, body = _conditional_GET("test_validator?version=none",
+                                              {"If-None-Match": "*"})
+    assert status == 200, status
+    assert response.getheader("ETag") is None
+    assert body == "Version: none\n", body
+
+def test_stream_body():
+    data = "Akara! " * 400000
+    body = GET("test_stream_body", data=data)
+    assert body == "Length: 2800000\nStart: 'Akara! Akara! Akara!'\n", body
+
 def test_echo_simple_post_with_GET():
     try:
         GET("test_echo_simple_post")
@@ -390,6 +494,38 @@ def test_head_vs_get():
 
     assert get_headers == head_headers, (get_headers, head_headers)
 
+def _HEAD(name, headers={}):
+    h = httplib_server()
+    h.request("HEAD", "/" + name, headers=headers)
+    r = h.getresponse()
+    body = r.read()
+    h.close()
+    assert body == "", body
+    return r
+
+def test_head_function():
+    # The service function raises an exception for a HEAD
+    r = _HEAD("test_head?size=5000")
+    assert r.status == 200, r.status
+    assert r.getheader("Content-Length") == "5000"
+    assert r.getheader("Content-Type") == "text/plain"
+    body = GET("test_head", dict(size=5000))
+    assert body == "x" * 5000
+
+    # The compressed length isn't known, so it isn't compressed
+    r = _HEAD("test_head?size=5000", {"Accept-Encoding": "gzip"})
+    assert r.status == 200, r.status
+    assert r.getheader("Content-Encoding") is None
+    assert r.getheader("Vary") == "Accept-Encoding"
+    assert r.getheader("Content-Length") == "5000"
+
+def test_head_method():
+    r = _HEAD("test_dispatching_head")
+    assert r.status == 200, r.status
+    assert r.getheader("X-Akara-Head") == "yes"
+    body = GET("test_dispatching_head")
+    assert body == "Full body", body
+
 
 # Unicode and XML encoding
 def test_method_unicode_latin1():